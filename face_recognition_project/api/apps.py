@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Load face models at startup instead of on the first request
+        if getattr(settings, 'FACE_ENGINE_PREWARM', False):
+            from .engine import get_engine
+            get_engine().warm()
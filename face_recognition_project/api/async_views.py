@@ -0,0 +1,151 @@
+import functools
+import io
+import logging
+import os
+import time
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from .enrollment import enroll, expected_dim, validate_embeddings
+from .inference import InferenceBusy, get_inference_pool
+from .metrics import REQUEST_SECONDS, timed
+from .pipeline import (RESULT_FIELDS, RecognitionError, asave_upload, recognize_image, record_recognized,
+                       run_batch_recognition, save_batch_results)
+from .uploads import read_upload
+
+logger = logging.getLogger(__name__)
+
+
+def api_response(code, msg, data=None):
+    return JsonResponse({'code': code, 'msg': msg, 'data': data}, status=code)
+
+
+def async_endpoint(name):
+    """POST-only async view: CSRF exempt like the DRF views, timed, and errors mapped to API responses
+
+    A full inference queue is answered with 429 and a Retry-After header.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            started = time.perf_counter()
+            if request.method != 'POST':
+                response = api_response(405, f'Method {request.method} not allowed')
+            else:
+                try:
+                    response = await view(request, *args, **kwargs)
+                except InferenceBusy as e:
+                    response = api_response(429, f'Server busy, retry later ({str(e)})')
+                    response['Retry-After'] = str(getattr(settings, 'INFERENCE_RETRY_AFTER', 1))
+                except RecognitionError as e:
+                    response = api_response(e.code, e.msg)
+                except Exception as e:
+                    logger.error(f"Error in async {name}: {str(e)}")
+                    import traceback
+                    logger.error(traceback.format_exc())
+                    response = api_response(500, str(e))
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=f'async_{name}',
+                                    code=response.status_code)
+            return response
+
+        # Django 4.2's csrf_exempt wraps views synchronously, so mark the async view directly
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+async def uploaded_files(request, *names):
+    """Files of the first field that has any; parsing the multipart body reads the spooled upload"""
+    def getlist():
+        for name in names:
+            files = request.FILES.getlist(name)
+            if files:
+                return files
+        return []
+
+    return await sync_to_async(getlist, thread_sensitive=False)()
+
+
+@async_endpoint('test_image')
+async def test_image(request):
+    """Test an image against the global model; inference runs on the bounded pool"""
+    image_files = await uploaded_files(request, 'image')
+    if not image_files:
+        return api_response(400, 'No image provided')
+
+    pool = get_inference_pool()
+    with pool.reserve():
+        test_image, image_data = await asave_upload(image_files[0])
+        timings = {}
+        data = await pool.run(recognize_image, test_image, timings=timings, image_data=image_data)
+        # The image column may still be filled in by a background upload write
+        with timed(timings, 'db_save'):
+            await test_image.asave(update_fields=RESULT_FIELDS)
+        record_recognized(test_image, data)
+
+    return api_response(200, 'Image processed successfully', data)
+
+
+@async_endpoint('test_images')
+async def test_images(request):
+    """Several photos of one room merged into one attendance list, see run_batch_recognition"""
+    image_files = await uploaded_files(request, 'images', 'image')
+    if not image_files:
+        return api_response(400, 'No images provided')
+
+    max_images = getattr(settings, 'BATCH_MAX_IMAGES', 20)
+    if len(image_files) > max_images:
+        return api_response(400, f'Too many images, at most {max_images} per request')
+
+    pool = get_inference_pool()
+    with pool.reserve():
+        uploads = [await asave_upload(image_file) for image_file in image_files]
+        test_images = [test_image for test_image, _ in uploads]
+        data = await pool.run(run_batch_recognition, test_images,
+                              image_data=[image_data for _, image_data in uploads], save=False)
+        await sync_to_async(save_batch_results)(test_images)
+
+    return api_response(200, f'{len(test_images)} images processed successfully', data)
+
+
+def enroll_files(ids, vectors):
+    """Validate and enroll uploaded embeddings in one transaction; returns (result, rejected)"""
+    accepted, templates, rejected = validate_embeddings(ids, vectors, expected_dim())
+    if rejected or not accepted:
+        return None, rejected
+    return enroll(accepted, templates), []
+
+
+@async_endpoint('receive_embeddings')
+async def receive_embeddings(request):
+    """Receive one .npy file per student, named after the student ID, and update the model"""
+    files = await uploaded_files(request, 'embedding_files')
+    if not files:
+        return api_response(400, 'No embedding files provided')
+
+    ids, vectors = [], []
+    for file in files:
+        ids.append(os.path.splitext(file.name)[0])
+        try:
+            data = await sync_to_async(read_upload, thread_sensitive=False)(file)
+            vectors.append(np.load(io.BytesIO(data), allow_pickle=False))
+        except Exception as e:
+            vectors.append(e)
+
+    pool = get_inference_pool()
+    with pool.reserve():
+        result, rejected = await pool.run(enroll_files, ids, vectors)
+    if result is None:
+        return api_response(400, 'Invalid embedding files', {'rejected': rejected})
+
+    global_model, created, updated = result
+    return api_response(200, 'Embeddings received and model updated successfully', {
+        'model_id': global_model.id,
+        'total_students': global_model.num_students,
+        'created': created,
+        'updated': updated,
+        'processed_files': [file.name for file in files]
+    })
@@ -0,0 +1,247 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from .engine import EnginePool, install_engine
+from .gallery import get_gallery_cache
+from .matching import normalize_rows
+
+
+def face_palette(count):
+    """`count` saturated RGB colors far enough apart to survive JPEG, one per synthetic face"""
+    hues = np.linspace(0, 180, count, endpoint=False).astype(np.uint8)
+    values = np.where(np.arange(count) % 2, 255, 190).astype(np.uint8)
+    hsv = np.stack([hues, np.full(count, 255, np.uint8), values], axis=1)[np.newaxis]
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)[0].astype(np.float32)
+
+
+def synthetic_photo(rng, palette, width=1920, height=1080, face_fraction=0.05):
+    """JPEG bytes of a class photo: every palette color as one square 'face' on a noisy gray background
+
+    Faces sit on a jittered grid in a random order, so every photo has a
+    new content hash and a fresh layout.
+    """
+    img = rng.integers(100, 160, size=(height, width), dtype=np.uint8)
+    img = np.repeat(img[:, :, np.newaxis], 3, axis=2)
+
+    side = int(face_fraction * width)
+    cols = max(1, int(np.ceil(np.sqrt(len(palette) * width / height))))
+    rows = int(np.ceil(len(palette) / cols))
+    cell_w, cell_h = width // cols, height // max(rows, 1)
+    side = max(8, min(side, cell_w - 4, cell_h - 4))
+    for cell, color in zip(rng.permutation(rows * cols), palette[rng.permutation(len(palette))]):
+        x = (cell % cols) * cell_w + int(rng.integers(0, cell_w - side + 1))
+        y = (cell // cols) * cell_h + int(rng.integers(0, cell_h - side + 1))
+        img[y:y + side, x:x + side] = color.astype(np.uint8)
+
+    ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+
+def stub_landmarks(box):
+    """Five FaceAnalysis-style landmarks (eyes, nose, mouth corners) inside a box"""
+    x1, y1, x2, y2 = box
+    w, h = x2 - x1, y2 - y1
+    return np.array([[x1 + .3 * w, y1 + .4 * h], [x1 + .7 * w, y1 + .4 * h], [x1 + .5 * w, y1 + .6 * h],
+                     [x1 + .35 * w, y1 + .8 * h], [x1 + .65 * w, y1 + .8 * h]], dtype=np.float32)
+
+
+class StubDetector:
+    """Finds the saturated squares of synthetic_photo, at the cost of a connected-components pass"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def detect(self, img, input_size=None, max_num=0, metric='default'):
+        if self.delay:
+            # Stands in for model time; like onnxruntime it does not hold the GIL
+            time.sleep(self.delay)
+        saturation = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)[:, :, 1]
+        count, _, stats, _ = cv2.connectedComponentsWithStats((saturation > 100).astype(np.uint8))
+        boxes = [(x, y, x + w, y + h) for x, y, w, h, area in stats[1:count] if area >= 16]
+        if not boxes:
+            return np.zeros((0, 5), dtype=np.float32), np.zeros((0, 5, 2), dtype=np.float32)
+        bboxes = np.array([box + (0.99,) for box in boxes], dtype=np.float32)
+        return bboxes, np.stack([stub_landmarks(box) for box in boxes])
+
+
+class StubRecognizer:
+    """Maps the color of an aligned crop to the embedding of the student wearing it"""
+
+    input_size = (112, 112)
+
+    def __init__(self, palette, embeddings, delay_per_face=0.0):
+        self.palette = palette
+        self.embeddings = embeddings
+        self.delay_per_face = delay_per_face
+
+    def get_feat(self, crops):
+        if self.delay_per_face:
+            time.sleep(self.delay_per_face * len(crops))
+        centers = np.array([crop[40:72, 40:72].reshape(-1, 3).mean(axis=0) for crop in crops], dtype=np.float32)
+        nearest = np.argmin(((centers[:, np.newaxis] - self.palette[np.newaxis]) ** 2).sum(axis=2), axis=1)
+        return self.embeddings[nearest]
+
+
+class StubFaceAnalysis:
+    """Deterministic, CPU-only stand-in for an insightface FaceAnalysis session
+
+    Only the parts the pipeline uses: det_model.detect and the
+    'recognition' model's get_feat. `detect_ms` and `embed_ms` (per face)
+    simulate model latency.
+    """
+
+    def __init__(self, palette, embeddings, detect_ms=0.0, embed_ms=0.0):
+        self.det_model = StubDetector(detect_ms / 1000)
+        self.models = {'recognition': StubRecognizer(palette, embeddings, embed_ms / 1000)}
+
+
+def class_embeddings(rng, gallery_rows, spread=0.3):
+    """Embeddings the stub reports for a class: the students' gallery rows plus some noise"""
+    dim = gallery_rows.shape[1]
+    return normalize_rows(gallery_rows + (spread / np.sqrt(dim)) * rng.standard_normal(
+        gallery_rows.shape, dtype=np.float32))
+
+
+def install_stub_engine(palette, embeddings, size=2, detect_ms=0.0, embed_ms=0.0):
+    """Replace the process engine with a pool of StubFaceAnalysis sessions; returns the previous pool"""
+    pool = EnginePool(size=size, session_factory=lambda: StubFaceAnalysis(
+        palette, embeddings, detect_ms=detect_ms, embed_ms=embed_ms))
+    return install_engine(pool)
+
+
+def npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+@contextmanager
+def isolated_environment():
+    """Throwaway database and MEDIA_ROOT, so runs neither see nor touch the real data
+
+    The test database is a file, not SQLite's in-memory default, so the
+    load driver's threads share it.
+    """
+    media_root = tempfile.mkdtemp(prefix='bench_media_')
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    previous_name = test_settings.get('NAME')
+    if connection.vendor == 'sqlite':
+        test_settings['NAME'] = os.path.join(media_root, 'bench.sqlite3')
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        # DEBUG would keep every query of the load run in memory
+        with override_settings(MEDIA_ROOT=media_root, DEBUG=False):
+            yield media_root
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = previous_name
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+def reset_data():
+    """Empty the benchmark database between runs, so every gallery size starts from nothing"""
+    from core.models import GlobalModel, Student, TestImage
+
+    TestImage.objects.all().delete()
+    GlobalModel.objects.all().delete()
+    Student.objects.all().delete()
+    get_gallery_cache().invalidate()
+
+
+def summarize(latencies, errors=0, wall_seconds=None):
+    """Latency percentiles in milliseconds and throughput of one measured series"""
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    summary = {
+        'requests': int(len(latencies)),
+        'errors': int(errors),
+    }
+    if len(latencies):
+        summary.update({
+            'mean_ms': round(float(latencies.mean()), 3),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'max_ms': round(float(latencies.max()), 3),
+        })
+    wall_seconds = wall_seconds if wall_seconds is not None else float(latencies.sum() / 1000)
+    summary['requests_per_second'] = round(len(latencies) / wall_seconds, 2) if wall_seconds else None
+    return summary
+
+
+def timed_request(client, method, path, data=None, ok=(200,)):
+    """One request through the test client; returns (seconds, response, failed)"""
+    start = time.perf_counter()
+    response = getattr(client, method)(path, data) if data is not None else getattr(client, method)(path)
+    if getattr(response, 'streaming', False):
+        # File responses are only produced while they are read
+        b''.join(response.streaming_content)
+    return time.perf_counter() - start, response, response.status_code not in ok
+
+
+def run_load(make_request, total, concurrency):
+    """Send `total` requests from `concurrency` threads, each with its own client and connection
+
+    `make_request(client, n)` sends request number n and returns
+    (seconds, response, failed).
+    """
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        client = Client()
+        try:
+            while True:
+                with lock:
+                    n = next(counter, None)
+                if n is None:
+                    return
+                seconds, _, failed = make_request(client, n)
+                with lock:
+                    latencies.append(seconds)
+                    errors.append(failed)
+        finally:
+            connections.close_all()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    wall = time.perf_counter() - start
+    return {'concurrency': concurrency, **summarize(latencies, sum(errors), wall)}
+
+
+def environment_info():
+    """What a result depends on besides the code, recorded with every run"""
+    import platform
+
+    import django
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'django': django.get_version(),
+        'settings': {name: getattr(settings, name, None) for name in (
+            'ANN_INDEX_BACKEND', 'GALLERY_MATCH_DTYPE', 'TEMPLATE_POOLING', 'RESULT_IMAGE_MODE',
+            'UPLOAD_PERSIST', 'EMBEDDING_CACHE_ENABLED', 'FACE_EMBED_BATCH_SIZE')},
+    }
@@ -0,0 +1,261 @@
+import io
+import logging
+import math
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# cv2.imread flags that decode JPEGs at 1/2, 1/4 and 1/8 scale straight from the DCT
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class DetectionPlan:
+    """How one image is decoded and fed to the detector"""
+
+    def __init__(self, width, height, reduction=1, det_long_side=640, tiled=False, tile_size=None):
+        self.width = width
+        self.height = height
+        self.reduction = reduction
+        self.det_long_side = det_long_side
+        self.tiled = tiled
+        self.tile_size = tile_size
+
+    def input_size(self, width, height):
+        """Detector input (w, h) matching the image aspect, in multiples of 32"""
+        scale = self.det_long_side / max(width, height)
+        return (max(32, int(math.ceil(width * scale / 32)) * 32),
+                max(32, int(math.ceil(height * scale / 32)) * 32))
+
+    def as_dict(self):
+        return {
+            'original_size': [self.width, self.height],
+            'reduction': self.reduction,
+            'det_long_side': self.det_long_side,
+            'tiled': self.tiled,
+            'tile_size': self.tile_size,
+        }
+
+
+def is_image_data(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+
+def image_size(source):
+    """Width and height from the image header of a path or in-memory bytes, without decoding pixels"""
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(source) if is_image_data(source) else source) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+def plan_detection(width, height, min_face_fraction=None, min_face_px=None, det_size_min=None,
+                   det_size_max=None, decode_min_side=None, tiling=None):
+    """Choose decode reduction, detector input size and tiling for an image
+
+    The detector needs the smallest expected face (a fraction of the long
+    side) to be at least `min_face_px` pixels at its input. When that needs
+    a larger input than `det_size_max` the image is cut into overlapping
+    tiles instead, so small faces in wide lecture-hall shots survive.
+    """
+    min_face_fraction = min_face_fraction or getattr(settings, 'FACE_MIN_SIZE_FRACTION', 0.03)
+    min_face_px = min_face_px or getattr(settings, 'DET_MIN_FACE_PX', 20)
+    det_size_min = det_size_min or getattr(settings, 'DET_SIZE_MIN', 320)
+    det_size_max = det_size_max or getattr(settings, 'DET_SIZE_MAX', 960)
+    decode_min_side = decode_min_side or getattr(settings, 'IMAGE_DECODE_MIN_SIDE', 1600)
+    tiling = getattr(settings, 'DET_TILING', True) if tiling is None else tiling
+
+    long_side = max(width, height)
+    needed = min(long_side, int(math.ceil(min_face_px / min_face_fraction)))
+    det_long_side = int(np.clip(needed, det_size_min, det_size_max))
+    tiled = tiling and needed > det_size_max
+
+    # Largest JPEG reduction that still leaves enough pixels for detection and recognition crops
+    keep = max(decode_min_side, needed if tiled else det_long_side)
+    reduction = 1
+    for factor in (8, 4, 2):
+        if long_side / factor >= keep:
+            reduction = factor
+            break
+
+    return DetectionPlan(width, height, reduction=reduction, det_long_side=needed if tiled else det_long_side,
+                         tiled=tiled, tile_size=det_size_max if tiled else None)
+
+
+def decode_image(source, plan=None):
+    """Decode an image path or in-memory upload bytes as RGB at the plan's reduced scale
+
+    Returns (img, scale), where original coordinates are img coordinates
+    times scale.
+    """
+    if plan is None:
+        size = image_size(source)
+        plan = plan_detection(*size) if size else DetectionPlan(0, 0)
+
+    flags = REDUCED_DECODE_FLAGS.get(plan.reduction, cv2.IMREAD_COLOR)
+    if is_image_data(source):
+        # Straight from the upload buffer, no write and read back through the media volume
+        img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+    else:
+        img = cv2.imread(source, flags)
+    if img is None:
+        return None, 1.0
+
+    # Colour conversion happens on the reduced image, not the full upload
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    # Long sides, so EXIF rotation applied by imread does not matter
+    scale = max(plan.width, plan.height) / max(img.shape[:2]) if plan.width else 1.0
+    return img, scale
+
+
+def box_iou(boxes_a, boxes_b):
+    """Pairwise IoU of two (n x 4) arrays of x1, y1, x2, y2 boxes"""
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-6), 0.0)
+
+
+def nms(boxes, scores, iou_threshold=0.4):
+    """Indices of boxes kept by greedy non-maximum suppression, best first"""
+    order = np.argsort(-scores)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        x1 = np.maximum(boxes[best, 0], boxes[rest, 0])
+        y1 = np.maximum(boxes[best, 1], boxes[rest, 1])
+        x2 = np.minimum(boxes[best, 2], boxes[rest, 2])
+        y2 = np.minimum(boxes[best, 3], boxes[rest, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        iou = intersection / np.maximum(areas[best] + areas[rest] - intersection, 1e-6)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.intp)
+
+
+def tile_origins(length, tile, overlap):
+    """Start offsets of overlapping tiles covering [0, length)"""
+    if length <= tile:
+        return [0]
+    step = max(1, int(tile * (1 - overlap)))
+    origins = list(range(0, length - tile, step))
+    origins.append(length - tile)
+    return origins
+
+
+def detect_faces(app, img, input_size=None):
+    """Run only the detector of a FaceAnalysis session
+
+    Returns (n x 5) boxes with scores and (n x 5 x 2) landmarks, or None for
+    landmarks when the detector does not predict them.
+    """
+    if input_size is None:
+        return app.det_model.detect(img, max_num=0, metric='default')
+    return app.det_model.detect(img, input_size=input_size, max_num=0, metric='default')
+
+
+def detect_tiled(app, img, det_long_side, tile_size, overlap=0.2):
+    """Detect on overlapping tiles of the image scaled to det_long_side, merged by NMS"""
+    height, width = img.shape[:2]
+    scale = det_long_side / max(width, height)
+    scaled = cv2.resize(img, (int(round(width * scale)), int(round(height * scale))),
+                        interpolation=cv2.INTER_AREA) if scale < 1 else img
+    scale = min(scale, 1.0)
+
+    all_boxes, all_kps = [], []
+    for y in tile_origins(scaled.shape[0], tile_size, overlap):
+        for x in tile_origins(scaled.shape[1], tile_size, overlap):
+            tile = scaled[y:y + tile_size, x:x + tile_size]
+            boxes, kpss = detect_faces(app, tile, input_size=(tile_size, tile_size))
+            if not len(boxes):
+                continue
+            boxes = boxes.copy()
+            boxes[:, [0, 2]] += x
+            boxes[:, [1, 3]] += y
+            all_boxes.append(boxes)
+            if kpss is not None:
+                all_kps.append(kpss + np.array([x, y], dtype=np.float32))
+
+    if not all_boxes:
+        return np.zeros((0, 5), dtype=np.float32), np.zeros((0, 5, 2), dtype=np.float32)
+    boxes = np.concatenate(all_boxes)
+    kpss = np.concatenate(all_kps) if len(all_kps) == len(all_boxes) else None
+    keep = nms(boxes[:, :4], boxes[:, 4])
+    boxes = boxes[keep]
+    kpss = kpss[keep] if kpss is not None else None
+
+    # Back to img coordinates
+    boxes[:, :4] /= scale
+    if kpss is not None:
+        kpss = kpss / scale
+    return boxes, kpss
+
+
+def detect_planned(app, img, plan):
+    """Detect faces in a decoded image as the plan says"""
+    if plan.tiled:
+        return detect_tiled(app, img, plan.det_long_side, plan.tile_size,
+                            overlap=getattr(settings, 'DET_TILE_OVERLAP', 0.2))
+    return detect_faces(app, img, input_size=plan.input_size(img.shape[1], img.shape[0]))
+
+
+def align_faces(img, kpss, image_size=112):
+    """Warp every detected face to the canonical ArcFace crop from its five landmarks"""
+    from insightface.utils import face_align
+
+    if kpss is None:
+        raise ValueError("Detector returned no landmarks, faces cannot be aligned")
+    return [face_align.norm_crop(img, landmark=kps, image_size=image_size) for kps in kpss]
+
+
+def embed_faces(app, img, kpss, batch_size=None, timings=None):
+    """Embed all detected faces of an image with batched recognition model calls
+
+    Returns an (n x dim) float32 matrix in detection order.
+    """
+    rec = app.models['recognition']
+    batch_size = batch_size or getattr(settings, 'FACE_EMBED_BATCH_SIZE', 32)
+
+    with timed(timings, 'alignment'):
+        crops = align_faces(img, kpss, image_size=rec.input_size[0])
+    if not crops:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    with timed(timings, 'embedding'):
+        features = [rec.get_feat(crops[i:i + batch_size]) for i in range(0, len(crops), batch_size)]
+        embeddings = np.concatenate(features).astype(np.float32)
+    return embeddings
+
+
+def detect_and_embed(app, img, plan, timings=None):
+    """Detection and batched embedding of one decoded image with one session
+
+    Returns (boxes, landmarks, embeddings), boxes in img coordinates; no
+    embeddings are computed when nothing is detected.
+    """
+    with timed(timings, 'detection'):
+        bboxes, kpss = detect_planned(app, img, plan)
+    if not len(bboxes):
+        return bboxes, kpss, np.zeros((0, 0), dtype=np.float32)
+    return bboxes, kpss, embed_faces(app, img, kpss, timings=timings)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Settings that change which faces are found or how they are embedded
+FINGERPRINT_SETTINGS = (
+    'FACE_ENGINE_MODEL', 'FACE_ENGINE_MODULES', 'FACE_MIN_SIZE_FRACTION', 'DET_MIN_FACE_PX',
+    'DET_SIZE_MIN', 'DET_SIZE_MAX', 'DET_TILING', 'DET_TILE_OVERLAP', 'IMAGE_DECODE_MIN_SIDE',
+)
+
+
+def pipeline_fingerprint():
+    """Short hash of the detection settings; entries made under other settings are misses"""
+    values = {name: getattr(settings, name, None) for name in FINGERPRINT_SETTINGS}
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class EmbeddingCache:
+    """Detected faces and embeddings per image content hash, LRU-bounded and kept on disk
+
+    Each entry is one pickle-free .npz file named after the image's SHA-256.
+    File mtimes record recency, so the LRU order survives restarts, and
+    worker processes sharing the directory see each other's entries.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, fingerprint=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        self._entries = OrderedDict()  # key -> file size, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def _scan(self):
+        """Rebuild the LRU order from the files on disk"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, name[:-len('.npz')], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._bytes += size
+        self._evict()
+
+    def get(self, key):
+        """Cached faces for an image hash, or None on a miss"""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                if str(entry['fingerprint']) != self.fingerprint:
+                    raise KeyError('fingerprint')
+                faces = [{
+                    'bbox': bbox,
+                    'image_bbox': image_bbox,
+                    'embedding': embedding,
+                    'score': float(score)
+                } for bbox, image_bbox, embedding, score in zip(
+                    entry['bboxes'], entry['image_bboxes'], entry['embeddings'], entry['scores'])]
+            os.utime(path)
+        except FileNotFoundError:
+            # Never cached, or evicted by another worker sharing the directory
+            with self._lock:
+                self.stats['misses'] += 1
+                self._bytes -= self._entries.pop(key, 0)
+            return None
+        except (KeyError, ValueError, OSError):
+            # Made under other detection settings, or unreadable; the next put replaces it
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self.stats['hits'] += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return faces
+
+    def put(self, key, faces):
+        """Store the faces of an image; an empty list records an image without faces"""
+        embeddings = np.array([face['embedding'] for face in faces], dtype=np.float32)
+        path = self._path(key)
+        tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            fingerprint=np.array(self.fingerprint),
+            bboxes=np.array([face['bbox'] for face in faces], dtype=np.int64).reshape(-1, 4),
+            image_bboxes=np.array([face.get('image_bbox', face['bbox']) for face in faces],
+                                  dtype=np.int64).reshape(-1, 4),
+            embeddings=embeddings.reshape(len(faces), -1),
+            scores=np.array([face['score'] for face in faces], dtype=np.float32),
+        )
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self._bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits (lock held)"""
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.stats['evictions'] += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """Return the process-wide embedding cache, or None when it is disabled"""
+    global _cache
+    if not getattr(settings, 'EMBEDDING_CACHE_ENABLED', True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(
+                    getattr(settings, 'EMBEDDING_CACHE_DIR', None)
+                    or os.path.join(settings.MEDIA_ROOT, 'embedding_cache'),
+                    max_bytes=getattr(settings, 'EMBEDDING_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+                    fingerprint=pipeline_fingerprint(),
+                )
+    return _cache
@@ -0,0 +1,217 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .metrics import ENGINE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class EnginePool:
+    """Pool of prepared FaceAnalysis sessions shared by every request in the process"""
+
+    def __init__(self, size=1, model_name='buffalo_l', det_size=(640, 640),
+                 providers=('CPUExecutionProvider',), modules=('detection', 'recognition'), session_factory=None,
+                 intra_op_threads=None):
+        self.size = max(1, int(size))
+        # Builds a session in place of FaceAnalysis, e.g. the deterministic stub of the benchmarks
+        self.session_factory = session_factory
+        self.model_name = model_name
+        self.modules = list(modules) if modules else None
+        self.det_size = tuple(det_size)
+        self.providers = list(providers)
+        # onnxruntime threads per session; None keeps its default of one per core
+        self.intra_op_threads = int(intra_op_threads) if intra_op_threads else None
+
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self.created_at = time.time()
+        self.stats = {
+            'sessions_loaded': 0,
+            'session_load_seconds': [],
+            'warmup_seconds': None,
+            'first_request_wait_seconds': None,
+            'seconds_to_first_request': None,
+            'requests_served': 0,
+            'total_wait_seconds': 0.0,
+        }
+
+    def _create_session(self):
+        """Load and prepare one FaceAnalysis session"""
+        start = time.perf_counter()
+        if self.session_factory is not None:
+            app = self.session_factory()
+        else:
+            from insightface.app import FaceAnalysis
+
+            # Only the detector and recognizer; buffalo_l also ships landmark and gender/age models
+            app = FaceAnalysis(name=self.model_name, providers=self.providers, allowed_modules=self.modules,
+                               **self._session_kwargs())
+            app.prepare(ctx_id=-1, det_size=self.det_size)
+        elapsed = time.perf_counter() - start
+
+        with self._stats_lock:
+            self.stats['sessions_loaded'] += 1
+            self.stats['session_load_seconds'].append(round(elapsed, 4))
+        logger.info(f"Loaded face analysis session {self.stats['sessions_loaded']}/{self.size} in {elapsed:.2f}s")
+        return app
+
+    def _session_kwargs(self):
+        if not self.intra_op_threads:
+            return {}
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = 1
+        return {'sess_options': options}
+
+    def _checkout(self, timeout=None):
+        """Take an idle session, creating one lazily while the pool is not full"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            should_create = self._created < self.size
+            if should_create:
+                self._created += 1
+
+        if should_create:
+            try:
+                return self._create_session()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        return self._idle.get(timeout=timeout)
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        """Borrow a session for the duration of the block"""
+        start = time.perf_counter()
+        app = self._checkout(timeout=timeout)
+        waited = time.perf_counter() - start
+
+        ENGINE_WAIT_SECONDS.observe(waited)
+        with self._stats_lock:
+            if self.stats['first_request_wait_seconds'] is None:
+                self.stats['first_request_wait_seconds'] = round(waited, 4)
+                self.stats['seconds_to_first_request'] = round(time.time() - self.created_at, 4)
+            self.stats['requests_served'] += 1
+            self.stats['total_wait_seconds'] += waited
+
+        try:
+            yield app
+        finally:
+            self._idle.put(app)
+
+    def detect_and_embed(self, img, plan, timings=None):
+        """Detect and embed the faces of a decoded image with a pooled session, see detection.detect_and_embed"""
+        from .detection import detect_and_embed
+
+        with self.acquire() as app:
+            return detect_and_embed(app, img, plan, timings=timings)
+
+    def detect(self, img, input_size=None):
+        """Boxes and landmarks of a decoded image, see detection.detect_faces"""
+        from .detection import detect_faces
+
+        with self.acquire() as app:
+            return detect_faces(app, img, input_size=input_size)
+
+    def embed(self, img, kpss, timings=None):
+        """Embeddings of the faces at the given landmarks, see detection.embed_faces"""
+        from .detection import embed_faces
+
+        with self.acquire() as app:
+            return embed_faces(app, img, kpss, timings=timings)
+
+    @property
+    def idle_sessions(self):
+        return self._idle.qsize()
+
+    def warm(self, count=None):
+        """Load sessions ahead of the first request"""
+        count = self.size if count is None else min(int(count), self.size)
+        start = time.perf_counter()
+
+        while True:
+            with self._lock:
+                if self._created >= count:
+                    break
+                self._created += 1
+            try:
+                self._idle.put(self._create_session())
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.stats['warmup_seconds'] = round(elapsed, 4)
+        logger.info(f"Face analysis engine warmed with {count} session(s) in {elapsed:.2f}s")
+
+    def snapshot(self):
+        """Return a copy of the pool statistics"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+            stats['session_load_seconds'] = list(stats['session_load_seconds'])
+        served = stats['requests_served']
+        stats['mean_wait_seconds'] = round(stats.pop('total_wait_seconds') / served, 4) if served else None
+        stats.update({
+            'model_name': self.model_name,
+            'modules': self.modules,
+            'det_size': list(self.det_size),
+            'pool_size': self.size,
+            'intra_op_threads': self.intra_op_threads,
+            'idle_sessions': self._idle.qsize(),
+            'uptime_seconds': round(time.time() - self.created_at, 2),
+        })
+        return stats
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide engine, creating it on first use
+
+    With INFERENCE_SERVER_ADDRESS set this is a client of the inference
+    server, which holds the models, instead of an in-process pool.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None and getattr(settings, 'INFERENCE_SERVER_ADDRESS', None):
+                from .inference_server import RemoteEngine
+                _engine = RemoteEngine.from_settings()
+            elif _engine is None:
+                _engine = EnginePool(
+                    size=getattr(settings, 'FACE_ENGINE_POOL_SIZE', 1),
+                    model_name=getattr(settings, 'FACE_ENGINE_MODEL', 'buffalo_l'),
+                    det_size=getattr(settings, 'FACE_ENGINE_DET_SIZE', (640, 640)),
+                    providers=getattr(settings, 'FACE_ENGINE_PROVIDERS', ['CPUExecutionProvider']),
+                    modules=getattr(settings, 'FACE_ENGINE_MODULES', ['detection', 'recognition']),
+                    intra_op_threads=getattr(settings, 'FACE_ENGINE_INTRA_OP_THREADS', None),
+                )
+    return _engine
+
+
+def install_engine(pool):
+    """Make `pool` the process-wide engine, returning the one it replaces"""
+    global _engine
+    with _engine_lock:
+        previous, _engine = _engine, pool
+    return previous
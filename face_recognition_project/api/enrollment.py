@@ -0,0 +1,206 @@
+import io
+import json
+import logging
+import os
+import zipfile
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from core.models import Student
+from .gallery import get_gallery_cache
+from .model_store import update_model, write_lock
+from .uploads import commit_staged, discard_staged, stage_many
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMATS = ('.zip', '.npz', '.ndjson', '.jsonl')
+
+
+class EnrollmentError(Exception):
+    """The archive as a whole cannot be read"""
+
+
+def _read_npz(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        # Either one array per student ID, or an 'ids' column next to an 'embeddings' matrix
+        if 'ids' in archive.files and 'embeddings' in archive.files:
+            ids = [str(student_id) for student_id in archive['ids'].tolist()]
+            return ids, list(archive['embeddings'])
+        return list(archive.files), [archive[name] for name in archive.files]
+
+
+def _read_zip(data):
+    ids, vectors = [], []
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for member in archive.infolist():
+            if member.is_dir() or not member.filename.endswith('.npy'):
+                continue
+            ids.append(os.path.splitext(os.path.basename(member.filename))[0])
+            try:
+                vectors.append(np.load(io.BytesIO(archive.read(member)), allow_pickle=False))
+            except Exception as e:
+                vectors.append(e)
+    return ids, vectors
+
+
+def _read_ndjson(data):
+    ids, vectors = [], []
+    for line_number, line in enumerate(data.decode('utf-8').splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            ids.append(str(record['student_id']))
+            vectors.append(record['embedding'])
+        except (ValueError, KeyError, TypeError) as e:
+            ids.append(f'line {line_number}')
+            vectors.append(e)
+    return ids, vectors
+
+
+def read_archive(name, data):
+    """Student IDs and raw embeddings from a zip of .npy files, an .npz or NDJSON
+
+    Entries that could not be parsed carry the exception instead of a vector.
+    """
+    extension = os.path.splitext(name.lower())[1]
+    try:
+        if extension == '.npz':
+            return _read_npz(data)
+        if extension == '.zip':
+            return _read_zip(data)
+        if extension in ('.ndjson', '.jsonl'):
+            return _read_ndjson(data)
+    except (ValueError, OSError, zipfile.BadZipFile, UnicodeDecodeError) as e:
+        raise EnrollmentError(f"Could not read {name}: {str(e)}")
+    raise EnrollmentError(f"Unsupported archive format {extension or name!r}, "
+                          f"expected one of {', '.join(ARCHIVE_FORMATS)}")
+
+
+def validate_embeddings(ids, vectors, dim):
+    """Check all entries at once; returns (ids, normalized template sets, rejected)
+
+    An entry is one embedding or a (templates x dim) set of them. Shape,
+    dtype, NaN/inf and zero-norm checks run on one stacked matrix of all
+    templates rather than per vector, and a student is rejected when any
+    of its templates is. Duplicate IDs are rejected, since it is unclear
+    which embedding is meant.
+    """
+    max_id_length = Student._meta.get_field('student_id').max_length
+    max_templates = getattr(settings, 'TEMPLATES_MAX_PER_STUDENT', 10)
+    rejected = []
+    candidates = []
+    rows = []
+
+    counts = {}
+    for student_id in ids:
+        counts[student_id] = counts.get(student_id, 0) + 1
+
+    for position, (student_id, vector) in enumerate(zip(ids, vectors)):
+        reason = None
+        if isinstance(vector, Exception):
+            reason = f'unreadable: {str(vector)}'
+        elif not student_id or len(student_id) > max_id_length:
+            reason = f'student_id must be 1-{max_id_length} characters'
+        elif os.path.basename(student_id) != student_id or student_id in ('.', '..'):
+            reason = 'student_id must not contain path separators'
+        elif student_id.endswith('_embedding'):
+            reason = "student_id must not end with '_embedding'"
+        elif counts[student_id] > 1:
+            reason = 'duplicate student_id'
+        else:
+            try:
+                # Ragged NDJSON lists fail here rather than give an object array
+                array = np.asarray(vector)
+                if array.dtype.kind not in 'fiu':
+                    reason = f'dtype {array.dtype} is not numeric'
+                elif array.size == 0 or array.ndim > 2 or array.shape[-1] != dim:
+                    reason = f'expected {dim} values per template, got shape {list(array.shape)}'
+                elif array.size // dim > max_templates:
+                    reason = f'at most {max_templates} templates per student, got {array.size // dim}'
+                else:
+                    block = array.reshape(-1, dim).astype(np.float32)
+                    candidates.append((position, student_id))
+                    rows.append(block)
+                    continue
+            except (TypeError, ValueError) as e:
+                reason = f'unreadable: {str(e)}'
+        rejected.append({'index': position, 'student_id': student_id, 'reason': reason})
+
+    if not rows:
+        return [], [], rejected
+
+    sizes = np.array([len(block) for block in rows])
+    owner = np.repeat(np.arange(len(rows)), sizes)
+    matrix = np.concatenate(rows)
+    norms = np.linalg.norm(matrix, axis=1)
+    finite = np.isfinite(matrix).all(axis=1)
+
+    # A student is only as good as its worst template
+    finite = np.bincount(owner, weights=~finite, minlength=len(rows)) == 0
+    nonzero = np.bincount(owner, weights=norms <= 0, minlength=len(rows)) == 0
+    usable = finite & nonzero
+
+    for (position, student_id), is_finite in zip(
+            [candidates[i] for i in np.flatnonzero(~usable)], finite[~usable]):
+        rejected.append({'index': position, 'student_id': student_id,
+                         'reason': 'contains NaN or infinite values' if not is_finite else 'zero vector'})
+    rejected.sort(key=lambda entry: entry['index'])
+
+    accepted_ids = [student_id for (_, student_id), ok in zip(candidates, usable) if ok]
+    if not accepted_ids:
+        return [], [], rejected
+    keep = usable[owner]
+    matrix = matrix[keep] / norms[keep, np.newaxis]
+    templates = np.split(matrix, np.cumsum(sizes[usable])[:-1])
+    return accepted_ids, templates, rejected
+
+
+def expected_dim():
+    """Embedding size of the current gallery, or the configured default for an empty one"""
+    gallery = get_gallery_cache().get()
+    if gallery is not None and len(gallery) and gallery.matrix.ndim == 2 and gallery.matrix.shape[1]:
+        return int(gallery.matrix.shape[1])
+    return getattr(settings, 'ENROLLMENT_EMBEDDING_DIM', 512)
+
+
+def enroll(ids, templates):
+    """Upsert Student rows, write their embedding files and apply one gallery update, in one transaction
+
+    `templates` holds one (templates x dim) matrix per ID. Returns
+    (global_model, created, updated).
+    """
+    existing = set(Student.objects.filter(student_id__in=ids).values_list('student_id', flat=True))
+    students = [Student(student_id=student_id, embedding_file=f'embeddings/{student_id}.npy')
+                for student_id in ids]
+
+    # Per-student files are what reaggregation rebuilds from. They are written under
+    # temporary names first and only replace the current files once the transaction
+    # commits, so a failed enrollment leaves rows, model and files as they were
+    items = []
+    for student_id, rows in zip(ids, templates):
+        buffer = io.BytesIO()
+        # Single embeddings keep the 1-D layout older clients wrote
+        np.save(buffer, rows[0] if len(rows) == 1 else rows, allow_pickle=False)
+        items.append((f'embeddings/{student_id}.npy', buffer.getvalue()))
+    staged = stage_many(items)
+
+    try:
+        with write_lock, transaction.atomic():
+            Student.objects.bulk_create(
+                students,
+                update_conflicts=True,
+                unique_fields=['student_id'],
+                update_fields=['embedding_file', 'updated_at'],
+                batch_size=getattr(settings, 'ENROLLMENT_BATCH_SIZE', 500),
+            )
+            # A failed model update rolls the Student rows back with it
+            global_model, _ = update_model(dict(zip(ids, templates)))
+            transaction.on_commit(lambda: commit_staged(staged))
+    except Exception:
+        discard_staged(staged)
+        raise
+
+    return global_model, len(ids) - len(existing), len(existing)
@@ -0,0 +1,360 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Max
+
+from core.models import GlobalModel, GlobalModelDelta
+from .index import FlatIndex, load_index_for_model
+from .matching import StackedRows, normalize_rows, pool_templates, row_scores
+from .quantization import encode_for_matching, load_quantized_for_model, match_dtype
+from .storage import is_gallery_header, read_gallery
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_model_path(model_file_name):
+    """Find a global model file on disk from its FileField name"""
+    # Rows written on Windows store backslash separators
+    model_file_name = str(model_file_name).replace('\\', '/')
+    possible_paths = [
+        os.path.join(settings.MEDIA_ROOT, model_file_name),  # Full path
+        os.path.join(settings.MEDIA_ROOT, 'global_model', model_file_name),  # In global_model dir
+        os.path.join(settings.MEDIA_ROOT, 'global_model', os.path.basename(model_file_name))  # Just filename
+    ]
+    for path in possible_paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class Gallery:
+    """Immutable snapshot of one global model version plus its applied deltas"""
+
+    def __init__(self, ids, matrix, version=None, model_id=None, path=None, mtime=None, index=None,
+                 removed=None, delta_sequence=0, quantized=None):
+        self.ids = np.asarray(ids)
+        self.matrix = matrix
+        self.version = version
+        self.model_id = model_id
+        self.path = path
+        self.mtime = mtime
+        self.delta_sequence = delta_sequence
+        self.loaded_at = time.time()
+
+        # Removed students keep their row so index positions stay stable until compaction
+        self.removed = removed if removed is not None else np.zeros(len(self.ids), dtype=bool)
+
+        # Legacy models also hold "<id>_embedding" duplicates that must never match
+        self.valid = ~np.char.endswith(self.ids.astype(str), '_embedding') & ~self.removed
+        # Compact copy the flat index scans when GALLERY_MATCH_DTYPE is not float32
+        self.quantized = quantized if quantized is not None else encode_for_matching(self.matrix)
+        self.index = index if index is not None else FlatIndex(self.matrix, valid=self.valid,
+                                                               quantized=self.quantized)
+        self.pooling = getattr(settings, 'TEMPLATE_POOLING', 'max')
+        self._build_templates()
+
+        # Snapshots are shared between threads, so never let anyone write to them
+        self.matrix.setflags(write=False)
+
+    def _build_templates(self):
+        """Group valid rows into per-student template sets
+
+        A student may own several rows (templates). `owner` maps each row
+        to its index in `student_ids` (-1 for rows that never match), and
+        `template_rows` lists valid rows grouped by student, each student's
+        templates being the slice starting at `template_starts`. Students
+        keep the order in which they first appear, so a snapshot written
+        grouped needs no reordering at match time.
+        """
+        valid_rows = np.flatnonzero(self.valid)
+        names, first, inverse = np.unique(self.ids[valid_rows].astype(str), return_index=True,
+                                          return_inverse=True)
+        by_appearance = np.argsort(first, kind='stable')
+        rank = np.empty_like(by_appearance)
+        rank[by_appearance] = np.arange(len(by_appearance))
+        owner = rank[inverse.ravel()]
+
+        self.student_ids = names[by_appearance]
+        self.owner = np.full(len(self.ids), -1, dtype=np.intp)
+        self.owner[valid_rows] = owner
+        self.template_counts = np.bincount(owner, minlength=len(self.student_ids))
+        self.template_starts = np.zeros(len(self.student_ids), dtype=np.intp)
+        np.cumsum(self.template_counts[:-1], out=self.template_starts[1:])
+        self.template_rows = valid_rows[np.argsort(owner, kind='stable')]
+        self.max_templates = int(self.template_counts.max()) if len(self.template_counts) else 0
+        self.has_templates = self.max_templates > 1
+        # Grouped snapshots without tombstones score straight off the matrix, no column gather
+        self._rows_in_order = len(self.template_rows) == len(self.ids) and bool(
+            np.all(self.template_rows == np.arange(len(self.ids))))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_students(self):
+        return len(self.student_ids)
+
+    def student_scores(self, probes, students=None):
+        """(faces x students) similarity pooled over each student's templates
+
+        All templates are scored with one matrix multiply and reduced per
+        student with TEMPLATE_POOLING ('max' or 'mean'). `students` limits
+        the columns to those student indices, in that order.
+        """
+        if students is None:
+            scores = row_scores(probes, self.matrix)
+            if not self._rows_in_order:
+                scores = scores[:, self.template_rows]
+            return pool_templates(scores, self.template_starts, self.template_counts, self.pooling)
+
+        students = np.asarray(students, dtype=np.intp)
+        counts = self.template_counts[students]
+        starts = np.zeros(len(students), dtype=np.intp)
+        np.cumsum(counts[:-1], out=starts[1:])
+        # Positions of the selected students' templates within template_rows
+        positions = np.repeat(self.template_starts[students] - starts, counts) + np.arange(int(counts.sum()))
+        scores = probes @ self.matrix[self.template_rows[positions]].T
+        return pool_templates(scores, starts, counts, self.pooling)
+
+    @property
+    def key(self):
+        return (self.model_id, self.version, self.mtime)
+
+    @property
+    def num_entries(self):
+        """Number of stored IDs, including _embedding duplicates"""
+        return int(np.count_nonzero(~self.removed))
+
+    def as_dict(self):
+        """Student ID to embedding mapping, for code that still works per student
+
+        Students with several templates keep only their last one here; use
+        as_templates() to keep them all.
+        """
+        active = ~self.removed
+        return dict(zip(self.ids[active].tolist(), self.matrix[active]))
+
+    def as_templates(self):
+        """Student ID to (templates x dim) matrix of all its active rows"""
+        templates = {}
+        active = np.flatnonzero(~self.removed)
+        for student_id, row in zip(self.ids[active].tolist(), active.tolist()):
+            templates.setdefault(student_id, []).append(row)
+        return {student_id: self.matrix[rows] for student_id, rows in templates.items()}
+
+    def apply_delta(self, delta_ids, delta_matrix, delta_removed, delta_sequence):
+        """Return a new snapshot with one delta segment applied, without touching this one
+
+        Updated students get fresh rows at the end and all their old rows
+        are marked removed, so index lists built for the base never go
+        stale. Repeated IDs within one delta are the templates of one
+        student and replace its whole template set. The memory-mapped base
+        rows are never copied: appended rows are kept apart (StackedRows)
+        until compaction writes a new base.
+        """
+        removed = self.removed | np.isin(self.ids, delta_ids) if len(delta_ids) else self.removed.copy()
+
+        ids = self.ids
+        matrix = self.matrix
+        quantized = self.quantized
+        if len(delta_ids):
+            ids = np.concatenate([self.ids, np.asarray(delta_ids, dtype=str)])
+            matrix = StackedRows.append(self.matrix, delta_matrix)
+            removed = np.concatenate([removed, np.zeros(len(delta_ids), dtype=bool)])
+            if quantized is not None:
+                quantized = quantized.append(delta_matrix)
+
+        if len(delta_removed):
+            removed |= np.isin(ids, delta_removed)
+
+        gallery = Gallery(ids, matrix, version=self.version, model_id=self.model_id, path=self.path,
+                          mtime=self.mtime, removed=removed, delta_sequence=delta_sequence, quantized=quantized)
+        if self.index.kind != 'flat':
+            gallery.index = self.index.rebind(gallery.matrix, gallery.valid)
+        return gallery
+
+
+def load_gallery_file(path):
+    """Read a model file into an ID array and normalized matrix
+
+    Galleries in the pickle-free format are memory-mapped, so workers share
+    the page cache instead of each holding a private copy.
+    """
+    if is_gallery_header(path):
+        ids, matrix, header = read_gallery(path, mmap=getattr(settings, 'GALLERY_MMAP', True))
+        if matrix.dtype != np.float32 and match_dtype() == 'float32':
+            # Exact scans multiply the rows themselves, so reduced-precision
+            # storage is widened once per process. With a match encoding the
+            # stored rows are only read for re-ranking and stay mapped.
+            matrix = np.array(matrix, dtype=np.float32)
+        return ids, matrix
+
+    # Legacy global_model_*.npz with a pickled dict
+    with np.load(path, allow_pickle=True) as model_data:
+        embeddings = model_data['student_embeddings'].item()
+
+    ids = np.array(list(embeddings.keys()), dtype=str)
+    if not embeddings:
+        return ids, np.zeros((0, 0), dtype=np.float32)
+
+    matrix = np.ascontiguousarray(
+        np.stack([np.asarray(e).ravel() for e in embeddings.values()]),
+        dtype=np.float32,
+    )
+    return ids, normalize_rows(matrix)
+
+
+def load_delta_file(path):
+    """Read a delta segment: upserted IDs, their normalized rows and removed IDs"""
+    with np.load(path, allow_pickle=False) as delta_data:
+        return delta_data['ids'], delta_data['embeddings'], delta_data['removed']
+
+
+def load_model_gallery(model_id, version, path, mtime=None, up_to_sequence=None):
+    """Load a base model file and apply its delta segments in order"""
+    ids, matrix = load_gallery_file(path)
+    gallery = Gallery(ids, matrix, version=version, model_id=model_id, path=path, mtime=mtime,
+                      quantized=load_quantized_for_model(path, matrix))
+    gallery.index = load_index_for_model(path, gallery.matrix, gallery.valid, quantized=gallery.quantized)
+    return apply_model_deltas(gallery, up_to_sequence)
+
+
+def apply_model_deltas(gallery, up_to_sequence=None):
+    """Apply the deltas of the gallery's base model that it has not seen yet"""
+    deltas = GlobalModelDelta.objects.filter(base_id=gallery.model_id, sequence__gt=gallery.delta_sequence)
+    if up_to_sequence is not None:
+        deltas = deltas.filter(sequence__lte=up_to_sequence)
+
+    for sequence, delta_file in deltas.order_by('sequence').values_list('sequence', 'delta_file'):
+        delta_path = resolve_model_path(delta_file)
+        if delta_path is None:
+            raise FileNotFoundError(f"Delta segment {delta_file} not found")
+        gallery = gallery.apply_delta(*load_delta_file(delta_path), delta_sequence=sequence)
+    return gallery
+
+
+def lease_dir():
+    return os.path.join(settings.MEDIA_ROOT, 'global_model', 'leases')
+
+
+def lease_model_id(name):
+    """Model ID a lease file was taken for, from its '<model_id>.<host>.<pid>' name"""
+    model_id = name.split('.', 1)[0]
+    return int(model_id) if model_id.isdigit() else None
+
+
+class GalleryCache:
+    """Process-wide cache holding the gallery of the newest GlobalModel
+
+    While it serves a model, the cache keeps a lease file for it under
+    global_model/leases, refreshed every MODEL_LEASE_REFRESH seconds.
+    Model retention does not delete files of a model with a fresh lease,
+    since this process may still have them mapped.
+    """
+
+    def __init__(self, check_interval=0.0):
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._lease_path = None
+        self._leased_at = 0.0
+
+    def _renew_lease(self, snapshot):
+        lease_path = os.path.join(lease_dir(), f"{snapshot.model_id}.{socket.gethostname()}.{os.getpid()}")
+        if (lease_path == self._lease_path
+                and time.monotonic() - self._leased_at < getattr(settings, 'MODEL_LEASE_REFRESH', 60)):
+            return
+        try:
+            os.makedirs(lease_dir(), exist_ok=True)
+            with open(lease_path, 'a'):
+                os.utime(lease_path)
+            # The previous model's lease, unless it belongs to the process we were forked from
+            previous = self._lease_path
+            if previous not in (None, lease_path) and previous.endswith(f".{os.getpid()}"):
+                if os.path.exists(previous):
+                    os.remove(previous)
+        except OSError as e:
+            logger.error(f"Error renewing lease on model {snapshot.model_id}: {str(e)}")
+            return
+        self._lease_path = lease_path
+        self._leased_at = time.monotonic()
+
+    def _latest_key(self):
+        """Cheap lookup of the newest model row, its file mtime and last delta"""
+        latest = (GlobalModel.objects.order_by('-created_at', '-id')
+                  .annotate(delta_sequence=Max('deltas__sequence'))
+                  .values_list('id', 'version', 'model_file', 'delta_sequence').first())
+        if latest is None:
+            return None, 0, None
+        model_id, version, model_file, delta_sequence = latest
+        path = resolve_model_path(model_file)
+        mtime = os.path.getmtime(path) if path else None
+        return (model_id, version, mtime), delta_sequence or 0, path
+
+    @property
+    def current(self):
+        """Gallery snapshot served right now, without checking for a newer model"""
+        return self._snapshot
+
+    def get(self):
+        """Return the current gallery snapshot, reloading only when a newer model exists"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return snapshot
+
+        key, delta_sequence, path = self._latest_key()
+        self._checked_at = time.monotonic()
+        if key is None:
+            logger.error("No model found in database")
+            return None
+        if snapshot is not None and snapshot.key == key and snapshot.delta_sequence == delta_sequence:
+            self._renew_lease(snapshot)
+            return snapshot
+        if path is None:
+            logger.error("Model file not found in any location")
+            return snapshot
+
+        with self._lock:
+            # Another thread may have loaded it while we waited
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.key == key and snapshot.delta_sequence == delta_sequence:
+                return snapshot
+
+            start = time.perf_counter()
+            model_id, version, mtime = key
+            if snapshot is not None and snapshot.key == key and snapshot.delta_sequence < delta_sequence:
+                # Same base model, only apply the new delta segments
+                snapshot = apply_model_deltas(snapshot, delta_sequence)
+                action = 'Applied deltas to'
+            else:
+                snapshot = load_model_gallery(model_id, version, path, mtime=mtime, up_to_sequence=delta_sequence)
+                action = 'Loaded'
+            self._snapshot = snapshot
+            self._renew_lease(snapshot)
+            logger.info(f"{action} gallery v{version}+{snapshot.delta_sequence} with {snapshot.num_students} students "
+                        f"({snapshot.index.kind} index) in {time.perf_counter() - start:.3f}s")
+        return snapshot
+
+    def invalidate(self):
+        """Force the next get() to re-check the database"""
+        self._checked_at = 0.0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_gallery_cache():
+    """Return the process-wide gallery cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = GalleryCache(check_interval=getattr(settings, 'GALLERY_CACHE_CHECK_INTERVAL', 0.0))
+    return _cache
@@ -0,0 +1,190 @@
+import logging
+import os
+
+import numpy as np
+from django.conf import settings
+
+from .matching import rerank, row_scores, top_k
+from .storage import model_stem
+
+logger = logging.getLogger(__name__)
+
+
+class FlatIndex:
+    """Exact search: one matrix multiply against every gallery row
+
+    With a `quantized` copy of the rows (GALLERY_MATCH_DTYPE) the scan runs
+    on that instead, and the best k * rerank_factor rows per face are
+    re-scored against the stored rows, so returned scores are as exact as
+    the gallery file. Only those shortlisted rows of `matrix` are read.
+    """
+    kind = 'flat'
+
+    def __init__(self, matrix, valid=None, quantized=None, rerank_factor=None):
+        self.matrix = matrix
+        self.valid = valid
+        self.quantized = quantized
+        self.rerank_factor = rerank_factor or getattr(settings, 'GALLERY_RERANK_FACTOR', 4)
+
+    def search(self, probes, k, threshold=None):
+        """Top-k gallery rows per probe, as (indices, scores)"""
+        if self.quantized is None:
+            return top_k(row_scores(probes, self.matrix), k, valid=self.valid, threshold=threshold)
+        shortlist, _ = top_k(self.quantized.scores(probes), k * self.rerank_factor, valid=self.valid)
+        return rerank(probes, self.matrix, shortlist, k, threshold=threshold)
+
+
+class IVFIndex:
+    """Inverted-file index: spherical k-means lists, only the closest lists are scanned
+
+    Rows of `matrix` are grouped by list, so list l is the contiguous slice
+    offsets[l]:offsets[l + 1]. Galleries are saved in that order when the
+    index is built, and `order` is None. Otherwise `order` maps grouped rows
+    back to the caller's row numbers. Rows past offsets[-1] were appended by
+    delta segments after the index was built, and every search scans them.
+    """
+    kind = 'ivf'
+
+    def __init__(self, matrix, centroids, offsets, order=None, valid=None, nprobe=8):
+        self.matrix = matrix
+        self.valid = valid
+        self.centroids = centroids
+        self.offsets = offsets
+        self.order = order
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def rebind(self, matrix, valid):
+        """Same lists over an updated gallery matrix (rows may only be appended)"""
+        return IVFIndex(matrix, self.centroids, self.offsets, order=self.order, valid=valid, nprobe=self.nprobe)
+
+    @classmethod
+    def build(cls, matrix, valid=None, nlist=None, nprobe=8, iterations=10, seed=0, chunk_size=65536):
+        """Train centroids on a sample and bucket every row into its nearest list"""
+        num_rows = len(matrix)
+        if nlist is None:
+            nlist = int(np.clip(np.sqrt(num_rows), 1, 4096))
+        nlist = max(1, min(nlist, num_rows))
+        rng = np.random.default_rng(seed)
+
+        sample_size = min(num_rows, nlist * 64)
+        sample = matrix[np.sort(rng.choice(num_rows, size=sample_size, replace=False))]
+        centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=nlist)
+
+            # Re-seed empty lists from random sample points
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        # Assign the full gallery in chunks to bound memory
+        assignment = np.empty(num_rows, dtype=np.int32)
+        for start in range(0, num_rows, chunk_size):
+            block = matrix[start:start + chunk_size]
+            assignment[start:start + chunk_size] = np.argmax(block @ centroids.T, axis=1)
+
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+        grouped_valid = valid[order] if valid is not None else None
+        return cls(matrix[order], centroids, offsets, order=order, valid=grouped_valid, nprobe=nprobe)
+
+    def search(self, probes, k, threshold=None, nprobe=None):
+        """Approximate top-k gallery rows per probe, as (indices, scores)"""
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        num_faces = len(probes)
+        k = min(k, len(self.matrix))
+        idx = np.full((num_faces, k), -1, dtype=np.intp)
+        scores = np.full((num_faces, k), -np.inf, dtype=np.float32)
+        if num_faces == 0 or k == 0:
+            return idx, scores
+
+        coarse = probes @ self.centroids.T
+        probed = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        for face, lists in enumerate(probed):
+            # Score each probed list on its contiguous slice, no row gathering
+            bounds = [(self.offsets[l], self.offsets[l + 1]) for l in lists]
+            if len(self.matrix) > self.offsets[-1]:
+                bounds.append((self.offsets[-1], len(self.matrix)))
+            rows = np.concatenate([np.arange(start, stop) for start, stop in bounds])
+            if rows.size == 0:
+                continue
+            face_scores = np.concatenate([self.matrix[start:stop] @ probes[face] for start, stop in bounds])
+            valid = self.valid[rows] if self.valid is not None else None
+            local_idx, local_scores = top_k(face_scores[np.newaxis, :], k, valid=valid, threshold=threshold)
+            found = local_idx[0] >= 0
+            count = int(found.sum())
+            idx[face, :count] = rows[local_idx[0][found]]
+            scores[face, :count] = local_scores[0][found]
+
+        if self.order is not None:
+            idx = np.where(idx >= 0, self.order[np.maximum(idx, 0)], -1)
+        return idx, scores
+
+    def save(self, path):
+        """Write the index structure (not the vectors) without pickling"""
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets, nprobe=np.int64(self.nprobe))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, matrix, valid=None, nprobe=None):
+        with np.load(path, allow_pickle=False) as data:
+            offsets = data['offsets']
+            if offsets[-1] > len(matrix):
+                raise ValueError(f"Index {path} covers {offsets[-1]} rows, gallery has {len(matrix)}")
+            return cls(matrix, data['centroids'], offsets, valid=valid, nprobe=nprobe or int(data['nprobe']))
+
+
+def index_path_for(model_path):
+    """Sidecar path of the ANN index belonging to a model file"""
+    return f"{model_stem(model_path)}.ivf.npz"
+
+
+def build_index(ids, matrix):
+    """Build the ANN index for a model about to be written, if configured
+
+    Returns the IDs and rows reordered so each IVF list is contiguous in
+    the saved model, along with the index (None when exact search is used).
+    """
+    backend = getattr(settings, 'ANN_INDEX_BACKEND', 'flat')
+    min_size = getattr(settings, 'ANN_MIN_GALLERY_SIZE', 20000)
+    if backend != 'ivf' or len(ids) < min_size:
+        return ids, matrix, None
+
+    valid = ~np.char.endswith(ids, '_embedding')
+    index = IVFIndex.build(matrix, valid=valid, nlist=getattr(settings, 'ANN_NLIST', None),
+                           nprobe=getattr(settings, 'ANN_NPROBE', 8))
+
+    ids, matrix = ids[index.order], index.matrix
+    index.order = None
+    logger.info(f"Built IVF index with {index.nlist} lists for {len(ids)} embeddings")
+    return ids, matrix, index
+
+
+def save_index_for_model(model_path, index):
+    """Persist an index next to its model file"""
+    if index is not None:
+        index.save(index_path_for(model_path))
+
+
+def load_index_for_model(model_path, matrix, valid, quantized=None):
+    """Load the persisted ANN index of a model, or fall back to a flat scan"""
+    path = index_path_for(model_path)
+    if getattr(settings, 'ANN_INDEX_BACKEND', 'flat') == 'ivf' and os.path.exists(path):
+        try:
+            return IVFIndex.load(path, matrix, valid=valid, nprobe=getattr(settings, 'ANN_NPROBE', None))
+        except Exception as e:
+            logger.error(f"Error loading index {path}, using exact search: {str(e)}")
+    return FlatIndex(matrix, valid=valid, quantized=quantized)
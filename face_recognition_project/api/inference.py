@@ -0,0 +1,97 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+REJECTED = REGISTRY.counter('inference_rejected', 'Async requests answered 429 because the inference queue was full')
+
+
+class InferenceBusy(Exception):
+    """The inference queue is full; the client should retry later"""
+
+
+def _call(fn, args, kwargs):
+    # Executor threads outlive requests, so give them the request connection lifecycle
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+class InferencePool:
+    """Bounded executor for the CPU-bound work of async views
+
+    Detection, embedding and matching run on `workers` threads (onnxruntime
+    and NumPy release the GIL), never on the event loop. At most
+    `max_pending` requests are admitted at once, running or waiting;
+    reserve() raises InferenceBusy beyond that, so a spike is answered
+    with 429 instead of piling up behind the pool.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inference')
+        self.pending = 0
+        self.stats = {'admitted': 0, 'rejected': 0}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def reserve(self):
+        """Admit one request for the duration of the block, or raise InferenceBusy"""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.stats['rejected'] += 1
+                REJECTED.inc()
+                raise InferenceBusy(f"{self.pending} requests in progress, at most {self.max_pending}")
+            self.pending += 1
+            self.stats['admitted'] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Await `fn(*args, **kwargs)` on the pool; call within reserve()"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(_call, fn, args, kwargs))
+
+    def snapshot(self):
+        with self._lock:
+            return {'workers': self.workers, 'max_pending': self.max_pending, 'pending': self.pending,
+                    **self.stats}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_inference_pool():
+    """Return the process-wide inference pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = (getattr(settings, 'INFERENCE_WORKERS', None)
+                           or getattr(settings, 'FACE_ENGINE_POOL_SIZE', 1))
+                _pool = InferencePool(workers, getattr(settings, 'INFERENCE_QUEUE_SIZE', 8))
+    return _pool
+
+
+def pending_requests():
+    return _pool.pending if _pool is not None else 0
+
+
+REGISTRY.gauge('inference_pending', 'Async requests admitted to the inference pool, running or waiting',
+               pending_requests)
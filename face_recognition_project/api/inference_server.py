@@ -0,0 +1,449 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import signal
+import stat
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from django.conf import settings
+
+from .engine import EnginePool
+from .metrics import ENGINE_WAIT_SECONDS, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Shared memory segments grow in steps of this size, so similar photos reuse one segment
+SEGMENT_STEP_BYTES = 4 * 1024 * 1024
+
+
+class InferenceServerError(Exception):
+    """The inference server could not be reached or failed to process a frame"""
+
+
+def parse_address(address):
+    """Listener address from a setting: a Unix socket path, 'host:port' or a (host, port) pair"""
+    if isinstance(address, (list, tuple)):
+        return address[0], int(address[1])
+    if ':' in address and not address.startswith(('/', '.')):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+def server_authkey():
+    key = getattr(settings, 'INFERENCE_SERVER_AUTHKEY', None) or settings.SECRET_KEY
+    return key.encode() if isinstance(key, str) else key
+
+
+def attach_shared_memory(name):
+    """Map a segment created by another process without taking ownership of it
+
+    Before Python 3.13 every attach registers the segment with the resource
+    tracker, which unlinks it when this process exits, or drops the
+    creator's registration when the tracker is shared after a fork. The
+    registration is skipped instead; server workers attach from their only
+    thread, so swapping the function is safe there.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def release_segment(shm):
+    try:
+        shm.close()
+        shm.unlink()
+    except (BufferError, OSError):
+        pass
+
+
+class FrameBuffers:
+    """Shared memory segments a client writes decoded frames into for the server to read in place
+
+    Segments are reused across requests, at most one per concurrent call,
+    because creating and mapping a fresh one per image costs more than
+    the copy into it.
+    """
+
+    def __init__(self):
+        self._free = []
+        self._segments = []
+        self._lock = threading.Lock()
+
+    def _checkout(self, nbytes):
+        with self._lock:
+            for i in range(len(self._free) - 1, -1, -1):
+                if self._free[i].size >= nbytes:
+                    return self._free.pop(i)
+            # Replace a free segment that is too small instead of keeping both
+            small = self._free.pop() if self._free else None
+            if small is not None:
+                self._segments.remove(small)
+        if small is not None:
+            release_segment(small)
+
+        size = max(SEGMENT_STEP_BYTES, -(-nbytes // SEGMENT_STEP_BYTES) * SEGMENT_STEP_BYTES)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        with self._lock:
+            self._segments.append(shm)
+        return shm
+
+    @contextmanager
+    def frame(self, img):
+        """Copy img into a segment and yield its description for the server
+
+        The segment is only reused when the block completes. After an error,
+        e.g. a timeout, the server may still be reading it, so it is unlinked
+        instead of being overwritten with the next frame.
+        """
+        shm = self._checkout(img.nbytes)
+        try:
+            np.copyto(np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf), img)
+            yield {'name': shm.name, 'shape': img.shape, 'dtype': img.dtype.str}
+        except BaseException:
+            with self._lock:
+                if shm in self._segments:
+                    self._segments.remove(shm)
+            release_segment(shm)
+            raise
+        with self._lock:
+            self._free.append(shm)
+
+    def close(self):
+        with self._lock:
+            segments, self._segments, self._free = self._segments, [], []
+        for shm in segments:
+            release_segment(shm)
+
+
+class RemoteEngine:
+    """Client of the inference server, standing in for EnginePool in Django processes
+
+    Detection and embedding run in the server processes, which hold the
+    models; frames go over shared memory and only boxes, landmarks and
+    embeddings come back. `size` bounds the calls in flight from this
+    process. The sessions stay in the server: video attendance and
+    single-face embedding go through detect() and embed(), and acquire()
+    raises rather than loading the models into this process.
+    """
+
+    def __init__(self, address, authkey, size=4, timeout=30.0):
+        self.address = address
+        self.authkey = authkey
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.frames = FrameBuffers()
+        atexit.register(self.frames.close)
+
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+
+        self.created_at = time.time()
+        self.stats = {
+            'requests_served': 0,
+            'errors': 0,
+            'total_seconds': 0.0,
+        }
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            parse_address(settings.INFERENCE_SERVER_ADDRESS),
+            server_authkey(),
+            size=getattr(settings, 'INFERENCE_SERVER_CONNECTIONS', 4),
+            timeout=getattr(settings, 'INFERENCE_SERVER_TIMEOUT', 30.0),
+        )
+
+    def call(self, op, payload=None, timeout=None):
+        """Send one request on a fresh connection and return the server's result"""
+        timeout = timeout or self.timeout
+        try:
+            conn = Client(self.address, authkey=self.authkey)
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+            raise InferenceServerError(f"Inference server at {self.address} unavailable: {str(e)}")
+        try:
+            conn.send((op, payload))
+            if not conn.poll(timeout):
+                raise InferenceServerError(f"No answer from the inference server within {timeout}s")
+            status, result = conn.recv()
+        except (OSError, EOFError) as e:
+            raise InferenceServerError(f"Inference server connection lost: {str(e)}")
+        finally:
+            conn.close()
+        if status != 'ok':
+            raise InferenceServerError(result)
+        return result
+
+    @contextmanager
+    def _slot(self):
+        start = time.perf_counter()
+        self._slots.acquire()
+        ENGINE_WAIT_SECONDS.observe(time.perf_counter() - start)
+        with self._lock:
+            self._in_use += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def _frame_call(self, op, img, payload):
+        """Run `op` on `img` in the server; returns the result and the wall time of the call"""
+        start = time.perf_counter()
+        try:
+            with self._slot():
+                with self.frames.frame(img) as frame:
+                    result = self.call(op, {'frame': frame, **payload})
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats['requests_served'] += 1
+            self.stats['total_seconds'] += elapsed
+        return result, elapsed
+
+    def detect_and_embed(self, img, plan, timings=None):
+        """detection.detect_and_embed on the server
+
+        The server's stage times go into `timings` and the stage histogram as
+        they are; 'inference_server' is only what the hand-off adds on top
+        (waiting for a slot, the frame copy, the socket and queueing), so the
+        stages still sum to the wall time.
+        """
+        result, elapsed = self._frame_call('detect_and_embed', img, {'plan': plan})
+        stages = dict(result['timings'])
+        stages['inference_server'] = max(0.0, elapsed - sum(stages.values()))
+        for stage, seconds in stages.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+            if timings is not None:
+                timings[stage] = round(seconds, 4)
+        return result['bboxes'], result['kpss'], result['embeddings']
+
+    def detect(self, img, input_size=None):
+        """EnginePool.detect on the server"""
+        result, _ = self._frame_call('detect', img, {'input_size': input_size})
+        return result['bboxes'], result['kpss']
+
+    def embed(self, img, kpss, timings=None):
+        """EnginePool.embed on the server"""
+        result, _ = self._frame_call('embed', img, {'kpss': kpss})
+        if timings is not None:
+            timings.update(result['timings'])
+        return result['embeddings']
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        """Sessions live in the server processes; there is none to borrow here"""
+        raise InferenceServerError("The face models run in the inference server; use detect(), embed() "
+                                   "or detect_and_embed() instead of a session")
+        yield
+
+    @property
+    def idle_sessions(self):
+        return self.size - self._in_use
+
+    def warm(self, count=None, timeout=60.0):
+        """Wait until the server answers, instead of failing the first requests while it starts"""
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                info = self.call('ping', timeout=timeout)
+                logger.info(f"Inference server at {self.address} ready, worker {info['worker']} answered")
+                return info
+            except InferenceServerError:
+                if time.perf_counter() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+    def snapshot(self):
+        """Client statistics, and those of the server process that answers"""
+        with self._lock:
+            stats = dict(self.stats)
+        served = stats['requests_served']
+        stats['mean_seconds'] = round(stats.pop('total_seconds') / served, 4) if served else None
+        stats.update({
+            'backend': 'inference_server',
+            'address': self.address if isinstance(self.address, str) else ':'.join(map(str, self.address)),
+            'pool_size': self.size,
+            'idle_sessions': self.idle_sessions,
+            'uptime_seconds': round(time.time() - self.created_at, 2),
+        })
+        try:
+            stats['server'] = self.call('stats', timeout=5.0)
+        except InferenceServerError as e:
+            stats['server'] = {'error': str(e)}
+        return stats
+
+
+def run_on_frame(frame, fn):
+    """Call fn on a frame in the client's shared memory, reading it in place"""
+    shm = attach_shared_memory(frame['name'])
+    try:
+        img = np.ndarray(frame['shape'], dtype=np.dtype(frame['dtype']), buffer=shm.buf)
+        result = fn(img)
+        del img
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            # A failed call's traceback still holds a view; the mapping goes away with it
+            pass
+    return result
+
+
+def analyze_frame(engine, frame, plan):
+    """Detect and embed the faces of a frame in the client's shared memory"""
+    timings = {}
+    bboxes, kpss, embeddings = run_on_frame(
+        frame, lambda img: engine.detect_and_embed(img, plan, timings=timings))
+    return {'bboxes': bboxes, 'kpss': kpss, 'embeddings': embeddings, 'timings': timings}
+
+
+def handle_connection(conn, engine, worker):
+    """Answer the requests of one client connection until it closes"""
+    with conn:
+        while True:
+            try:
+                op, payload = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if op == 'detect_and_embed':
+                    result = analyze_frame(engine, payload['frame'], payload['plan'])
+                elif op == 'detect':
+                    bboxes, kpss = run_on_frame(
+                        payload['frame'], lambda img: engine.detect(img, input_size=payload.get('input_size')))
+                    result = {'bboxes': bboxes, 'kpss': kpss}
+                elif op == 'embed':
+                    timings = {}
+                    embeddings = run_on_frame(
+                        payload['frame'], lambda img: engine.embed(img, payload['kpss'], timings=timings))
+                    result = {'embeddings': embeddings, 'timings': timings}
+                elif op == 'ping':
+                    result = {'worker': worker, 'pid': os.getpid()}
+                elif op == 'stats':
+                    result = {'worker': worker, 'pid': os.getpid(), 'engine': engine.snapshot()}
+                else:
+                    raise ValueError(f"Unknown operation {op}")
+                response = ('ok', result)
+            except Exception as e:
+                logger.error(f"Error in inference worker {worker} handling {op}: {str(e)}")
+                response = ('error', str(e))
+            try:
+                conn.send(response)
+            except OSError:
+                return
+
+
+def _worker_main(listener, worker, make_engine, ready):
+    # Ctrl+C reaches the whole process group; the parent terminates the children
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    engine = make_engine()
+    engine.warm()
+    ready.set()
+    while True:
+        try:
+            conn = listener.accept()
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+            logger.warning(f"Inference worker {worker} rejected a connection: {str(e)}")
+            continue
+        handle_connection(conn, engine, worker)
+
+
+class InferenceServer:
+    """Pre-forked inference processes, each loading the models once, sharing one listening socket
+
+    Idle processes wait in accept(), so the kernel hands every connection
+    to a free process and the backlog queues the rest. `threads` sets the
+    onnxruntime intra-op threads of each process; processes x threads
+    should not exceed the cores. Frames arrive over shared memory, so
+    clients must run on the same host.
+    """
+
+    def __init__(self, address, authkey, processes=2, threads=None, session_factory=None, backlog=128):
+        self.address = address
+        self.authkey = authkey
+        self.processes = max(1, int(processes))
+        self.threads = threads
+        self.session_factory = session_factory
+        self.backlog = backlog
+        self.listener = None
+        self.workers = []
+        self._ready = []
+
+    def make_engine(self):
+        """One session per process: a process handles one connection at a time"""
+        return EnginePool(
+            size=1,
+            model_name=getattr(settings, 'FACE_ENGINE_MODEL', 'buffalo_l'),
+            det_size=getattr(settings, 'FACE_ENGINE_DET_SIZE', (640, 640)),
+            providers=getattr(settings, 'FACE_ENGINE_PROVIDERS', ['CPUExecutionProvider']),
+            modules=getattr(settings, 'FACE_ENGINE_MODULES', ['detection', 'recognition']),
+            session_factory=self.session_factory,
+            intra_op_threads=self.threads,
+        )
+
+    def start(self):
+        from django.db import connections
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            if not stat.S_ISSOCK(os.stat(self.address).st_mode):
+                raise InferenceServerError(f"{self.address} exists and is not a socket")
+            # Left behind by a server that did not shut down cleanly
+            os.unlink(self.address)
+        self.listener = Listener(self.address, backlog=self.backlog, authkey=self.authkey)
+
+        # The listener is inherited, so children are forked; they must not share database connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        self._ready = [context.Event() for _ in range(self.processes)]
+        self.workers = [
+            context.Process(target=_worker_main, args=(self.listener, i, self.make_engine, self._ready[i]),
+                            name=f'inference-worker-{i}', daemon=True)
+            for i in range(self.processes)
+        ]
+        for process in self.workers:
+            process.start()
+        logger.info(f"Started {self.processes} inference workers on {self.address} "
+                    f"with {self.threads or 'default'} intra-op threads each")
+        return self
+
+    def wait_ready(self, timeout=None):
+        """True once every worker has loaded its models"""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for ready, process in zip(self._ready, self.workers):
+            while not ready.wait(0.1):
+                if not process.is_alive():
+                    raise InferenceServerError(f"{process.name} exited while loading models")
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return False
+        return True
+
+    def join(self):
+        for process in self.workers:
+            process.join()
+
+    def stop(self):
+        for process in self.workers:
+            process.terminate()
+        for process in self.workers:
+            process.join()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
@@ -0,0 +1,106 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import TestImage
+from .pipeline import GlobalModelTester, RecognitionError, run_recognition
+
+logger = logging.getLogger(__name__)
+
+
+def queue_depth():
+    """Number of recognition jobs waiting for a worker"""
+    return TestImage.objects.filter(status=TestImage.STATUS_QUEUED).count()
+
+
+def enqueue(test_image):
+    """Mark a saved TestImage as waiting for a worker"""
+    depth = queue_depth()
+    test_image.status = TestImage.STATUS_QUEUED
+    test_image.stats = {
+        'queued_at': time.time(),
+        'queue_depth_at_enqueue': depth,
+    }
+    test_image.save(update_fields=['status', 'stats'])
+    return depth + 1
+
+
+def claim_next():
+    """Atomically take the oldest queued job, or return None when the queue is empty
+
+    The status check is part of the UPDATE, so two workers racing for the
+    same row cannot both claim it.
+    """
+    while True:
+        job_id = (TestImage.objects.filter(status=TestImage.STATUS_QUEUED)
+                  .order_by('created_at', 'id').values_list('id', flat=True).first())
+        if job_id is None:
+            return None
+        with transaction.atomic():
+            claimed = (TestImage.objects.filter(id=job_id, status=TestImage.STATUS_QUEUED)
+                       .update(status=TestImage.STATUS_RUNNING, started_at=timezone.now()))
+        if claimed:
+            return TestImage.objects.get(id=job_id)
+
+
+def run_job(test_image, tester=None):
+    """Run the recognition pipeline for a claimed job and record the outcome"""
+    stats = dict(test_image.stats or {})
+    queued_at = stats.get('queued_at')
+    if queued_at is not None:
+        stats['queue_wait_seconds'] = round(time.time() - queued_at, 4)
+    stats['queue_depth_at_start'] = queue_depth()
+    test_image.stats = stats
+
+    timings = {}
+    try:
+        run_recognition(test_image, tester=tester, timings=timings)
+    except Exception as e:
+        if not isinstance(e, RecognitionError):
+            logger.exception(f"Error processing job {test_image.id}")
+        test_image.status = TestImage.STATUS_FAILED
+        test_image.error = e.msg if isinstance(e, RecognitionError) else str(e)
+        test_image.stats = {**stats, 'timings': timings}
+        test_image.finished_at = timezone.now()
+        test_image.save(update_fields=['status', 'error', 'stats', 'finished_at'])
+        return False
+
+    test_image.finished_at = timezone.now()
+    test_image.save(update_fields=['finished_at'])
+    logger.info(f"Job {test_image.id} done in {sum(timings.values()):.3f}s")
+    return True
+
+
+def requeue_stale(timeout=None):
+    """Put jobs back in the queue whose worker died while running them"""
+    if timeout is None:
+        timeout = getattr(settings, 'RECOGNITION_JOB_TIMEOUT', 300)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    requeued = (TestImage.objects.filter(status=TestImage.STATUS_RUNNING, started_at__lt=cutoff)
+                .update(status=TestImage.STATUS_QUEUED, started_at=None))
+    if requeued:
+        logger.warning(f"Requeued {requeued} stale recognition jobs")
+    return requeued
+
+
+def work(poll_interval=1.0, drain=False, stop=None):
+    """Claim and run jobs until stopped, sleeping while the queue is empty
+
+    With drain=True the worker returns as soon as the queue is empty.
+    """
+    tester = GlobalModelTester()
+    done = 0
+    while stop is None or not stop.is_set():
+        test_image = claim_next()
+        if test_image is None:
+            if drain:
+                break
+            time.sleep(poll_interval)
+            continue
+        run_job(test_image, tester=tester)
+        done += 1
+    return done
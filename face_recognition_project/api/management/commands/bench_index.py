@@ -0,0 +1,83 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.index import FlatIndex, IVFIndex
+from api.matching import normalize_rows
+
+
+def synthetic_gallery(rng, size, dim, clusters=0, spread=1.0, chunk_size=65536):
+    """Random unit vectors, generated in chunks to keep peak memory at one copy
+
+    With clusters > 0 rows are drawn around that many random centers, which is
+    closer to real face embeddings than uniform noise (the worst case for IVF).
+    """
+    centers = normalize_rows(rng.standard_normal((clusters, dim), dtype=np.float32)) if clusters else None
+    matrix = np.empty((size, dim), dtype=np.float32)
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        block = rng.standard_normal((stop - start, dim), dtype=np.float32)
+        if centers is not None:
+            block *= spread / np.sqrt(dim)
+            block += centers[rng.integers(0, clusters, size=stop - start)]
+        matrix[start:stop] = block
+    return normalize_rows(matrix)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark recall@k and latency of the IVF index against exact search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--dim', type=int, default=512)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--k', type=int, default=10)
+        parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+        parser.add_argument('--nlist', type=int, default=None)
+        parser.add_argument('--clusters', type=int, default=0,
+                            help='Draw the gallery around this many centers, 0 for uniform random vectors')
+        parser.add_argument('--spread', type=float, default=1.0,
+                            help='Norm of the within-cluster noise relative to the unit centers')
+        parser.add_argument('--noise', type=float, default=0.03,
+                            help='Std of the noise added to gallery rows to form queries')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        k = options['k']
+
+        for size in options['sizes']:
+            matrix = synthetic_gallery(rng, size, options['dim'], clusters=options['clusters'],
+                                       spread=options['spread'])
+
+            # Queries are noisy copies of known gallery rows, like a re-photographed student
+            truth = rng.choice(size, size=options['queries'], replace=False)
+            probes = matrix[truth] + options['noise'] * rng.standard_normal(
+                (options['queries'], options['dim'])).astype(np.float32)
+            probes = normalize_rows(probes)
+
+            flat = FlatIndex(matrix)
+            start = time.perf_counter()
+            exact_idx, _ = flat.search(probes, k)
+            exact_ms = (time.perf_counter() - start) * 1000 / options['queries']
+
+            start = time.perf_counter()
+            ivf = IVFIndex.build(matrix, nlist=options['nlist'])
+            build_s = time.perf_counter() - start
+
+            self.stdout.write(f"\ngallery={size} dim={options['dim']} clusters={options['clusters']} "
+                              f"queries={options['queries']} "
+                              f"k={k} nlist={ivf.nlist} build={build_s:.2f}s")
+            self.stdout.write(f"{'backend':<14}{'ms/query':>10}{'recall@1':>10}{'recall@k':>10}")
+            self.stdout.write(f"{'flat':<14}{exact_ms:>10.3f}{np.mean(exact_idx[:, 0] == truth):>10.3f}{1.0:>10.3f}")
+
+            for nprobe in options['nprobe']:
+                start = time.perf_counter()
+                approx_idx, _ = ivf.search(probes, k, nprobe=nprobe)
+                approx_ms = (time.perf_counter() - start) * 1000 / options['queries']
+
+                recall_k = np.mean([len(np.intersect1d(a[a >= 0], e)) / k
+                                    for a, e in zip(approx_idx, exact_idx)])
+                recall_1 = np.mean(approx_idx[:, 0] == truth)
+                self.stdout.write(f"{f'ivf nprobe={nprobe}':<14}{approx_ms:>10.3f}{recall_1:>10.3f}{recall_k:>10.3f}")
@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmark import StubFaceAnalysis, environment_info, face_palette, run_load, synthetic_photo
+from api.detection import decode_image, image_size, plan_detection
+from api.engine import EnginePool
+from api.inference_server import InferenceServer, RemoteEngine
+from api.matching import normalize_rows
+
+
+def parse_config(value):
+    """'4x2' as (4 processes, 2 threads); '4' or '4x0' leaves onnxruntime's thread default"""
+    processes, _, threads = value.lower().partition('x')
+    return int(processes), int(threads) if threads and int(threads) else None
+
+
+class Command(BaseCommand):
+    help = ('Benchmark inference server throughput and latency across process x thread configurations, '
+            'against running the models in the calling process')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--configs', nargs='+', default=['1x4', '2x2', '4x1'],
+                            help='Server configurations as PROCESSESxTHREADS')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8],
+                            help='Client threads submitting images at once')
+        parser.add_argument('--images', type=int, default=40, help='Images per configuration and concurrency')
+        parser.add_argument('--image-dir', help='Use the photos in this directory instead of synthetic ones')
+        parser.add_argument('--width', type=int, default=1920)
+        parser.add_argument('--height', type=int, default=1080)
+        parser.add_argument('--faces', type=int, default=30, help='Faces in each synthetic photo')
+        parser.add_argument('--stub', action='store_true',
+                            help='Use the deterministic stub model instead of loading the face models')
+        parser.add_argument('--detect-ms', type=float, default=0.0, help='Simulated stub detector time per image')
+        parser.add_argument('--embed-ms', type=float, default=0.0, help='Simulated stub recognition time per face')
+        parser.add_argument('--no-baseline', action='store_true',
+                            help='Skip the in-process engine pool the configurations are compared with')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            configs = [parse_config(value) for value in options['configs']]
+        except ValueError:
+            raise CommandError('Configurations look like 4x2: processes x intra-op threads')
+
+        rng = np.random.default_rng(options['seed'])
+        frames = self.frames(rng, options)
+        session_factory = self.stub_factory(rng, options) if options['stub'] else None
+
+        runs = []
+        if not options['no_baseline']:
+            self.stderr.write("in-process engine pool")
+            runs.append(self.measure_local(frames, session_factory, options))
+        for processes, threads in configs:
+            self.stderr.write(f"server {processes} processes x {threads or 'default'} threads")
+            runs.append(self.measure_server(frames, session_factory, processes, threads, options))
+
+        results = {
+            'benchmark': 'bench_inference_server',
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'seconds': round(time.perf_counter() - started, 2),
+            'options': {name: options[name] for name in (
+                'configs', 'concurrency', 'images', 'image_dir', 'width', 'height', 'faces', 'stub',
+                'detect_ms', 'embed_ms', 'seed')},
+            'environment': environment_info(),
+            'runs': runs,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stderr.write(f"Wrote {options['output']}")
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'configuration':<24}{'clients':>8}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}"
+                          f"{'img/s':>9}")
+        for run in runs:
+            for level in run['load']:
+                self.stdout.write(f"{run['name']:<24}{level['concurrency']:>8}{level['errors']:>5}"
+                                  f"{level.get('p50_ms', 0):>10.2f}{level.get('p95_ms', 0):>10.2f}"
+                                  f"{level['requests_per_second'] or 0:>9.2f}")
+
+    def frames(self, rng, options):
+        """Decoded images and their detection plans; decoding is not part of the numbers"""
+        if options['image_dir']:
+            paths = sorted(os.path.join(options['image_dir'], name) for name in os.listdir(options['image_dir']))
+            sources = [path for path in paths if os.path.isfile(path)]
+        else:
+            palette = face_palette(options['faces'])
+            sources = [synthetic_photo(rng, palette, options['width'], options['height']) for _ in range(8)]
+
+        frames = []
+        for source in sources:
+            size = image_size(source)
+            if size is None:
+                continue
+            plan = plan_detection(*size)
+            img, _ = decode_image(source, plan)
+            if img is not None:
+                frames.append((img, plan))
+        if not frames:
+            raise CommandError('No readable images')
+        return frames
+
+    def stub_factory(self, rng, options):
+        palette = face_palette(options['faces'])
+        embeddings = normalize_rows(rng.standard_normal((options['faces'], 512), dtype=np.float32))
+        return lambda: StubFaceAnalysis(palette, embeddings, detect_ms=options['detect_ms'],
+                                        embed_ms=options['embed_ms'])
+
+    def load_levels(self, engine, frames, options):
+        levels = []
+        for concurrency in options['concurrency']:
+            def send(client, n):
+                img, plan = frames[n % len(frames)]
+                start = time.perf_counter()
+                try:
+                    engine.detect_and_embed(img, plan)
+                    failed = False
+                except Exception as e:
+                    self.stderr.write(f"request {n} failed: {str(e)}")
+                    failed = True
+                return time.perf_counter() - start, None, failed
+
+            # One untimed round, so every session has seen an image before it is measured
+            run_load(send, concurrency, concurrency)
+            levels.append(run_load(send, options['images'], concurrency))
+        return levels
+
+    def measure_local(self, frames, session_factory, options):
+        engine = EnginePool(size=max(options['concurrency']), session_factory=session_factory)
+        start = time.perf_counter()
+        engine.warm()
+        return {
+            'name': f"in-process x{engine.size}",
+            'mode': 'local',
+            'sessions': engine.size,
+            'load_seconds': round(time.perf_counter() - start, 3),
+            'load': self.load_levels(engine, frames, options),
+        }
+
+    def measure_server(self, frames, session_factory, processes, threads, options):
+        directory = tempfile.mkdtemp(prefix='bench_inference_')
+        address = os.path.join(directory, 'server.sock')
+        authkey = os.urandom(16)
+        server = InferenceServer(address, authkey, processes=processes, threads=threads,
+                                 session_factory=session_factory)
+        start = time.perf_counter()
+        server.start()
+        engine = RemoteEngine(address, authkey, size=max(options['concurrency']))
+        try:
+            server.wait_ready()
+            load_seconds = time.perf_counter() - start
+            return {
+                'name': f"server {processes}x{threads or 'default'}",
+                'mode': 'server',
+                'processes': processes,
+                'threads': threads,
+                'load_seconds': round(load_seconds, 3),
+                'load': self.load_levels(engine, frames, options),
+                'client': {key: value for key, value in engine.snapshot().items() if key != 'server'},
+            }
+        finally:
+            engine.frames.close()
+            server.stop()
+            shutil.rmtree(directory, ignore_errors=True)
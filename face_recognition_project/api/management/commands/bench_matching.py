@@ -0,0 +1,84 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.gallery import Gallery
+from api.matching import SIMILARITY_THRESHOLD, normalize_rows, normalize_probes, match_faces, assign_faces, hungarian
+
+
+def legacy_compare(test_embedding, student_embeddings):
+    """Per-student loop as test_image used to run it for each face"""
+    matches = {}
+    test_embedding = test_embedding / np.linalg.norm(test_embedding)
+    for student_id, student_embedding in student_embeddings.items():
+        student_embedding = student_embedding / np.linalg.norm(student_embedding)
+        matches[student_id] = np.dot(test_embedding, student_embedding)
+    return matches
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the batched face matcher against the per-student loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--faces', type=int, default=60)
+        parser.add_argument('--students', type=int, default=3000)
+        parser.add_argument('--dim', type=int, default=512)
+        parser.add_argument('--top-k', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        num_faces, num_students, dim = options['faces'], options['students'], options['dim']
+
+        matrix = normalize_rows(rng.standard_normal((num_students, dim)).astype(np.float32))
+        ids = np.array([f'student{i}' for i in range(num_students)])
+        gallery = Gallery(ids, matrix, version='bench')
+        student_embeddings = gallery.as_dict()
+
+        # Probes are noisy copies of random students so some pass the threshold
+        truth = rng.choice(num_students, size=num_faces, replace=False)
+        faces = matrix[truth] + 0.04 * rng.standard_normal((num_faces, dim)).astype(np.float32)
+
+        legacy_times = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            legacy = [sorted(legacy_compare(face, student_embeddings).items(), key=lambda x: x[1], reverse=True)
+                      for face in faces]
+            legacy_times.append(time.perf_counter() - start)
+
+        batched_times = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            probes = normalize_probes(faces)
+            idx, scores = match_faces(probes, gallery, k=options['top_k'], threshold=SIMILARITY_THRESHOLD)
+            batched_times.append(time.perf_counter() - start)
+
+        assign_times = []
+        fallback_times = []
+        for _ in range(options['repeat']):
+            idx, _ = match_faces(probes, gallery, k=options['top_k'], threshold=SIMILARITY_THRESHOLD)
+            start = time.perf_counter()
+            students, _ = assign_faces(probes, gallery, idx)
+            assign_times.append(time.perf_counter() - start)
+
+            # Time the pure NumPy solver on the same candidate problem
+            columns = np.unique(idx[idx >= 0])
+            start = time.perf_counter()
+            hungarian(-np.maximum(probes @ matrix[columns].T - SIMILARITY_THRESHOLD, 0.0))
+            fallback_times.append(time.perf_counter() - start)
+
+        agree = sum(1 for face_legacy, face_idx in zip(legacy, idx)
+                    if face_idx[0] >= 0 and face_legacy[0][0] == ids[face_idx[0]])
+
+        legacy_ms = np.median(legacy_times) * 1000
+        batched_ms = np.median(batched_times) * 1000
+        self.stdout.write(f"faces={num_faces} students={num_students} dim={dim} top_k={options['top_k']}")
+        self.stdout.write(f"legacy loop:  {legacy_ms:9.2f} ms (median of {options['repeat']})")
+        self.stdout.write(f"batched:      {batched_ms:9.2f} ms (median of {options['repeat']})")
+        self.stdout.write(f"speedup:      {legacy_ms / batched_ms:9.1f}x")
+        self.stdout.write(f"top-1 agreement: {agree}/{num_faces}")
+        self.stdout.write(f"assignment:   {np.median(assign_times) * 1000:9.2f} ms "
+                          f"({np.count_nonzero(students >= 0)}/{num_faces} faces assigned)")
+        self.stdout.write(f"numpy solver: {np.median(fallback_times) * 1000:9.2f} ms")
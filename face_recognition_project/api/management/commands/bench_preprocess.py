@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from api.detection import (DetectionPlan, box_iou, decode_image, detect_faces, detect_planned, image_size,
+                           plan_detection)
+from api.engine import get_engine
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def legacy_detect(app, path):
+    """What process_test_image used to do: full decode, full cvtColor, square 640 input"""
+    img = cv2.imread(path)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    boxes, _ = detect_faces(app, img, input_size=(640, 640))
+    return boxes, 1.0
+
+
+def planned_detect(app, path, reduced=True, **plan_options):
+    size = image_size(path)
+    plan = plan_detection(*size, **plan_options) if size else DetectionPlan(0, 0)
+    if not reduced:
+        plan.reduction = 1
+    img, scale = decode_image(path, plan)
+    boxes, _ = detect_planned(app, img, plan)
+    return boxes, scale
+
+
+def recall(found, reference, iou_threshold=0.5):
+    """Share of reference faces overlapped by some found face"""
+    if not len(reference):
+        return 1.0
+    if not len(found):
+        return 0.0
+    return float(np.mean(box_iou(reference, found).max(axis=1) >= iou_threshold))
+
+
+class Command(BaseCommand):
+    help = 'Benchmark decode/detection settings over a folder of images: latency and recall per setting'
+
+    def add_arguments(self, parser):
+        parser.add_argument('folder', help='Folder of sample classroom photos')
+        parser.add_argument('--fractions', type=float, nargs='+', default=[0.05, 0.03, 0.015],
+                            help='FACE_MIN_SIZE_FRACTION values to try')
+        parser.add_argument('--det-size-max', type=int, nargs='+', default=[640, 960])
+        parser.add_argument('--reference-fraction', type=float, default=0.008,
+                            help='Smallest face fraction of the exhaustive tiled reference run')
+        parser.add_argument('--repeat', type=int, default=1)
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        folder = options['folder']
+        if not os.path.isdir(folder):
+            raise CommandError(f"{folder} is not a directory")
+        paths = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                       if name.lower().endswith(IMAGE_EXTENSIONS))
+        if not paths:
+            raise CommandError(f"No images found in {folder}")
+
+        settings_grid = [('legacy 640', legacy_detect, {})]
+        for det_size_max in options['det_size_max']:
+            for fraction in options['fractions']:
+                for tiling in (False, True):
+                    name = f"f={fraction} max={det_size_max}{' tiled' if tiling else ''}"
+                    settings_grid.append((name, planned_detect, {
+                        'min_face_fraction': fraction, 'det_size_max': det_size_max, 'tiling': tiling}))
+        settings_grid.append(('full decode f=0.03', planned_detect, {'reduced': False, 'min_face_fraction': 0.03}))
+
+        with get_engine().acquire() as app:
+            # Ground truth is the most exhaustive setting: full resolution, small faces, tiled
+            reference = {}
+            for path in paths:
+                boxes, scale = planned_detect(app, path, reduced=False, tiling=True,
+                                              min_face_fraction=options['reference_fraction'])
+                reference[path] = boxes[:, :4] * scale
+
+            results = []
+            for name, detect, kwargs in settings_grid:
+                latencies, recalls, faces = [], [], 0
+                for path in paths:
+                    for _ in range(options['repeat']):
+                        start = time.perf_counter()
+                        boxes, scale = detect(app, path, **kwargs)
+                        latencies.append((time.perf_counter() - start) * 1000)
+                    recalls.append(recall(boxes[:, :4] * scale, reference[path]))
+                    faces += len(boxes)
+                results.append({
+                    'setting': name,
+                    'mean_ms': round(float(np.mean(latencies)), 2),
+                    'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+                    'recall': round(float(np.mean(recalls)), 4),
+                    'faces': faces,
+                })
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'images': len(paths),
+                'reference_faces': int(sum(len(boxes) for boxes in reference.values())),
+                'results': results,
+            }, indent=2))
+            return
+
+        self.stdout.write(f"{len(paths)} images, {sum(len(b) for b in reference.values())} reference faces")
+        self.stdout.write(f"{'setting':<28}{'mean ms':>10}{'p95 ms':>10}{'recall':>10}{'faces':>8}")
+        for result in results:
+            self.stdout.write(f"{result['setting']:<28}{result['mean_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                              f"{result['recall']:>10.3f}{result['faces']:>8}")
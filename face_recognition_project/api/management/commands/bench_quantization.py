@@ -0,0 +1,93 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.index import FlatIndex
+from api.management.commands.bench_index import synthetic_gallery
+from api.matching import normalize_rows, top_k
+from api.quantization import QuantizedMatrix
+
+
+class Command(BaseCommand):
+    help = 'Benchmark float16/int8 gallery encodings against float32: memory, latency and accuracy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--dim', type=int, default=512)
+        parser.add_argument('--faces', type=int, default=40, help='Faces per query batch (one class photo)')
+        parser.add_argument('--k', type=int, default=5)
+        parser.add_argument('--rerank-factor', type=int, nargs='+', default=[1, 4])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--clusters', type=int, default=1000,
+                            help='Draw the gallery around this many centers, 0 for uniform random vectors')
+        parser.add_argument('--spread', type=float, default=1.0)
+        parser.add_argument('--noise', type=float, default=0.03,
+                            help='Std of the noise added to gallery rows to form queries')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def timed_search(self, index, probes, k, repeat):
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            idx, scores = index.search(probes, k)
+            latencies.append((time.perf_counter() - start) * 1000)
+        return idx, scores, float(np.mean(latencies))
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        k, dim = options['k'], options['dim']
+
+        runs = []
+        for size in options['sizes']:
+            matrix = synthetic_gallery(rng, size, dim, clusters=options['clusters'], spread=options['spread'])
+
+            # Queries are noisy copies of known gallery rows, like a re-photographed student
+            truth = rng.choice(size, size=options['faces'], replace=False)
+            probes = normalize_rows(matrix[truth] + options['noise'] * rng.standard_normal(
+                (options['faces'], dim)).astype(np.float32))
+
+            exact_idx, exact_scores, exact_ms = self.timed_search(FlatIndex(matrix), probes, k, options['repeat'])
+            results = [{
+                'mode': 'float32',
+                'scan_bytes': int(matrix.nbytes),
+                'ms_per_batch': round(exact_ms, 3),
+                'recall_at_1': round(float(np.mean(exact_idx[:, 0] == truth)), 4),
+                'overlap_at_k': 1.0,
+                'max_score_error': 0.0,
+            }]
+
+            for dtype in ('float16', 'int8'):
+                quantized = QuantizedMatrix.encode(matrix, dtype)
+                # How far the compact scores are from float32 before any re-rank
+                _, approx = top_k(quantized.scores(probes), k)
+                raw_error = float(np.max(np.abs(approx - exact_scores)))
+
+                for factor in options['rerank_factor']:
+                    index = FlatIndex(matrix, quantized=quantized, rerank_factor=factor)
+                    idx, scores, ms = self.timed_search(index, probes, k, options['repeat'])
+                    overlap = np.mean([len(np.intersect1d(a[a >= 0], e)) / k for a, e in zip(idx, exact_idx)])
+                    results.append({
+                        'mode': f'{dtype} rerank x{factor}',
+                        'scan_bytes': quantized.nbytes,
+                        'ms_per_batch': round(ms, 3),
+                        'recall_at_1': round(float(np.mean(idx[:, 0] == truth)), 4),
+                        'overlap_at_k': round(float(overlap), 4),
+                        'max_score_error': round(raw_error, 5),
+                    })
+            runs.append({'gallery': size, 'results': results})
+
+        if options['json']:
+            self.stdout.write(json.dumps({'dim': dim, 'faces': options['faces'], 'k': k, 'runs': runs}, indent=2))
+            return
+
+        for run in runs:
+            self.stdout.write(f"\ngallery={run['gallery']} dim={dim} faces={options['faces']} k={k}")
+            self.stdout.write(f"{'mode':<20}{'scan MB':>10}{'ms/batch':>10}{'recall@1':>10}"
+                              f"{'overlap@k':>11}{'score err':>11}")
+            for result in run['results']:
+                self.stdout.write(f"{result['mode']:<20}{result['scan_bytes'] / 2 ** 20:>10.1f}"
+                                  f"{result['ms_per_batch']:>10.3f}{result['recall_at_1']:>10.3f}"
+                                  f"{result['overlap_at_k']:>11.3f}{result['max_score_error']:>11.5f}")
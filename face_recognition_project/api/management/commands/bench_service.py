@@ -0,0 +1,179 @@
+import json
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from api.benchmark import (class_embeddings, environment_info, face_palette, install_stub_engine,
+                           isolated_environment, npy_bytes, reset_data, run_load, summarize, synthetic_photo,
+                           timed_request)
+from api.engine import install_engine
+from api.enrollment import enroll
+from api.management.commands.bench_index import synthetic_gallery
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the recognition endpoints end to end on synthetic galleries and photos, '
+            'with a stub face model, sequentially and under concurrent load')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--dim', type=int, default=512)
+        parser.add_argument('--faces', type=int, default=30, help='Students in each synthetic class photo')
+        parser.add_argument('--width', type=int, default=1920)
+        parser.add_argument('--height', type=int, default=1080)
+        parser.add_argument('--requests', type=int, default=20, help='Sequential requests per endpoint')
+        parser.add_argument('--batch-images', type=int, default=4, help='Photos per test_images request')
+        parser.add_argument('--enroll-files', type=int, default=20,
+                            help='Embedding files per receive_embeddings request')
+        parser.add_argument('--reaggregate-runs', type=int, default=2)
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+        parser.add_argument('--load-requests', type=int, default=40, help='test_image requests per load level')
+        parser.add_argument('--engine-size', type=int, default=2, help='Stub sessions in the engine pool')
+        parser.add_argument('--detect-ms', type=float, default=0.0, help='Simulated detector time per image')
+        parser.add_argument('--embed-ms', type=float, default=0.0, help='Simulated recognition time per face')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        runs = []
+        with isolated_environment(), override_settings(RECOGNITION_ASYNC_DEFAULT=False):
+            for size in options['gallery_sizes']:
+                self.stderr.write(f"gallery={size}: seeding")
+                runs.append(self.run_gallery(size, options))
+
+        results = {
+            'benchmark': 'bench_service',
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'seconds': round(time.perf_counter() - started, 2),
+            'options': {name: options[name] for name in (
+                'gallery_sizes', 'dim', 'faces', 'width', 'height', 'requests', 'batch_images',
+                'enroll_files', 'reaggregate_runs', 'concurrency', 'load_requests', 'engine_size',
+                'detect_ms', 'embed_ms', 'seed')},
+            'environment': environment_info(),
+            'runs': runs,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stderr.write(f"Wrote {options['output']}")
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        for run in runs:
+            self.stdout.write(f"\ngallery={run['gallery']} dim={options['dim']} faces/photo={options['faces']} "
+                              f"photo={options['width']}x{options['height']}")
+            self.stdout.write(f"{'endpoint':<24}{'req':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}"
+                              f"{'p99 ms':>10}{'req/s':>9}")
+            rows = [(name, summary) for name, summary in run['endpoints'].items()]
+            rows += [(f"load x{level['concurrency']}", level) for level in run['load']]
+            for name, summary in rows:
+                self.stdout.write(f"{name:<24}{summary['requests']:>6}{summary['errors']:>5}"
+                                  f"{summary.get('p50_ms', 0):>10.2f}{summary.get('p95_ms', 0):>10.2f}"
+                                  f"{summary.get('p99_ms', 0):>10.2f}{summary['requests_per_second'] or 0:>9.2f}")
+
+    def run_gallery(self, size, options):
+        """Seed a fresh gallery of `size` students, then measure every endpoint against it"""
+        rng = np.random.default_rng([options['seed'], size])
+        dim = options['dim']
+
+        reset_data()
+        matrix = synthetic_gallery(rng, size, dim)
+        ids = [f'student{i}' for i in range(size)]
+        enroll(ids, [row[np.newaxis] for row in matrix])
+
+        # The photographed class: its students' colors map to noisy copies of their gallery rows
+        palette = face_palette(options['faces'])
+        present = rng.choice(size, size=options['faces'], replace=False)
+        previous_engine = install_stub_engine(palette, class_embeddings(rng, matrix[present]),
+                                              size=options['engine_size'], detect_ms=options['detect_ms'],
+                                              embed_ms=options['embed_ms'])
+        try:
+            return {
+                'gallery': size,
+                'endpoints': self.measure_endpoints(rng, palette, ids, options),
+                'load': self.measure_load(rng, palette, options),
+            }
+        finally:
+            install_engine(previous_engine)
+
+    def photos(self, rng, palette, count, options):
+        return [synthetic_photo(rng, palette, options['width'], options['height']) for _ in range(count)]
+
+    def measure_endpoints(self, rng, palette, ids, options):
+        client = Client()
+        endpoints = {}
+
+        # A first request loads the gallery and the stub sessions; it is not part of the numbers
+        timed_request(client, 'post', '/api/aggregation/test_image/',
+                      {'image': SimpleUploadedFile('warmup.jpg', self.photos(rng, palette, 1, options)[0])})
+
+        latencies, errors, matched, result_urls = [], 0, [], []
+        for n, photo in enumerate(self.photos(rng, palette, options['requests'], options)):
+            seconds, response, failed = timed_request(client, 'post', '/api/aggregation/test_image/',
+                                                      {'image': SimpleUploadedFile(f'photo{n}.jpg', photo)})
+            latencies.append(seconds)
+            errors += failed
+            if not failed:
+                data = response.json()['data']
+                matched.append(data['total_matches'] / max(1, data['total_faces']))
+                result_urls.append(data['result_image_url'])
+        endpoints['test_image'] = {**summarize(latencies, errors),
+                                   'match_rate': round(float(np.mean(matched)), 4) if matched else None}
+
+        # Lazily rendered result images: the first GET draws, the second serves the cached file
+        for name in ('result_image_render', 'result_image_cached'):
+            latencies, errors = [], 0
+            for url in filter(None, result_urls):
+                seconds, _, failed = timed_request(client, 'get', url)
+                latencies.append(seconds)
+                errors += failed
+            endpoints[name] = summarize(latencies, errors)
+
+        latencies, errors = [], 0
+        for n in range(max(1, options['requests'] // options['batch_images'])):
+            files = [SimpleUploadedFile(f'batch{n}_{i}.jpg', photo)
+                     for i, photo in enumerate(self.photos(rng, palette, options['batch_images'], options))]
+            seconds, _, failed = timed_request(client, 'post', '/api/aggregation/test_images/', {'images': files})
+            latencies.append(seconds)
+            errors += failed
+        endpoints['test_images'] = summarize(latencies, errors)
+
+        # Re-enrollments of existing students, each request one delta segment
+        latencies, errors = [], 0
+        for n in range(options['requests']):
+            chosen = rng.choice(len(ids), size=min(options['enroll_files'], len(ids)), replace=False)
+            vectors = rng.standard_normal((len(chosen), options['dim']), dtype=np.float32)
+            files = [SimpleUploadedFile(f'{ids[i]}.npy', npy_bytes(vector)) for i, vector in zip(chosen, vectors)]
+            seconds, _, failed = timed_request(client, 'post', '/api/aggregation/receive_embeddings/',
+                                               {'embedding_files': files})
+            latencies.append(seconds)
+            errors += failed
+        endpoints['receive_embeddings'] = summarize(latencies, errors)
+
+        latencies, errors = [], 0
+        for _ in range(options['reaggregate_runs']):
+            seconds, _, failed = timed_request(client, 'post', '/api/aggregation/reaggregate/', {'resume': 'false'})
+            latencies.append(seconds)
+            errors += failed
+        endpoints['reaggregate'] = summarize(latencies, errors)
+        return endpoints
+
+    def measure_load(self, rng, palette, options):
+        """test_image under concurrent clients, like a lecture start"""
+        levels = []
+        for concurrency in options['concurrency']:
+            photos = self.photos(rng, palette, options['load_requests'], options)
+
+            def send(client, n):
+                return timed_request(client, 'post', '/api/aggregation/test_image/',
+                                     {'image': SimpleUploadedFile(f'load{concurrency}_{n}.jpg', photos[n])})
+
+            levels.append(run_load(send, len(photos), concurrency))
+        return levels
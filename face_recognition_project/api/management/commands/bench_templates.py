@@ -0,0 +1,89 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.gallery import Gallery
+from api.management.commands.bench_index import synthetic_gallery
+from api.matching import SIMILARITY_THRESHOLD, assign_faces, match_faces, normalize_rows
+
+
+def noisy_views(rng, centers, count, spread):
+    """`count` normalized views per center, like photos of a student under different conditions"""
+    dim = centers.shape[1]
+    views = np.repeat(centers, count, axis=0)
+    views += (spread / np.sqrt(dim)) * rng.standard_normal(views.shape, dtype=np.float32)
+    return normalize_rows(views)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark template-set matching: cost against total templates and accuracy per pooling mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=5000)
+        parser.add_argument('--templates', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help='Templates per student to try')
+        parser.add_argument('--dim', type=int, default=512)
+        parser.add_argument('--faces', type=int, default=40, help='Faces per query batch (one class photo)')
+        parser.add_argument('--top-k', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--spread', type=float, default=1.0,
+                            help='Norm of the per-view noise relative to the unit student centers')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        num_students, dim, k = options['students'], options['dim'], options['top_k']
+        centers = synthetic_gallery(rng, num_students, dim)
+        ids = np.array([f'student{i}' for i in range(num_students)])
+
+        # The same probes for every setting: a fresh view of known students
+        truth = rng.choice(num_students, size=options['faces'], replace=False)
+        probes = noisy_views(rng, centers[truth], 1, options['spread'])
+
+        results = []
+        for count in options['templates']:
+            matrix = noisy_views(rng, centers, count, options['spread'])
+            # Templates of a student are stored contiguously, as snapshots write them
+            gallery = Gallery(np.repeat(ids, count), matrix, version='bench')
+
+            for pooling in ('max', 'mean'):
+                gallery.pooling = pooling
+                latencies = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    idx, _ = match_faces(probes, gallery, k=k, threshold=SIMILARITY_THRESHOLD)
+                    students, _ = assign_faces(probes, gallery, idx)
+                    latencies.append((time.perf_counter() - start) * 1000)
+
+                mean_ms = float(np.mean(latencies))
+                results.append({
+                    'templates_per_student': count,
+                    'total_templates': len(matrix),
+                    'pooling': pooling,
+                    'mean_ms': round(mean_ms, 3),
+                    'us_per_1k_templates': round(mean_ms * 1000 / (len(matrix) / 1000), 3),
+                    'accuracy': round(float(np.mean(students == truth)), 4),
+                })
+                if count == 1:
+                    # Pooling over one template is the same either way
+                    break
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'students': num_students,
+                'dim': dim,
+                'faces': options['faces'],
+                'results': results,
+            }, indent=2))
+            return
+
+        self.stdout.write(f"students={num_students} dim={dim} faces={options['faces']} top_k={k}")
+        self.stdout.write(f"{'templates':>10}{'total':>10}{'pooling':>9}{'ms/batch':>10}"
+                          f"{'us/1k tmpl':>12}{'accuracy':>10}")
+        for result in results:
+            self.stdout.write(f"{result['templates_per_student']:>10}{result['total_templates']:>10}"
+                              f"{result['pooling']:>9}{result['mean_ms']:>10.3f}"
+                              f"{result['us_per_1k_templates']:>12.3f}{result['accuracy']:>10.3f}")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.model_store import compact
+from core.models import GlobalModel
+
+
+class Command(BaseCommand):
+    help = 'Fold the delta segments of the latest global model into a new full snapshot'
+
+    def handle(self, *args, **options):
+        try:
+            base = GlobalModel.objects.latest('created_at')
+        except GlobalModel.DoesNotExist:
+            raise CommandError('No global model found')
+
+        num_deltas = base.deltas.count()
+        if not num_deltas:
+            self.stdout.write(f"Model v{base.version} has no deltas, nothing to compact")
+            return
+
+        new_base = compact(base)
+        if new_base is None:
+            raise CommandError(f"Model v{base.version} was replaced while compacting")
+        self.stdout.write(self.style.SUCCESS(
+            f"Compacted v{base.version} and {num_deltas} deltas into v{new_base.version} "
+            f"({new_base.num_students} students)"))
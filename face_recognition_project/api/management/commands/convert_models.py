@@ -0,0 +1,47 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.gallery import get_gallery_cache, load_gallery_file, resolve_model_path
+from api.quantization import save_quantized_for_model
+from api.storage import is_gallery_header, model_stem, read_gallery, write_gallery
+from core.models import GlobalModel
+
+
+class Command(BaseCommand):
+    help = 'Convert pickled global_model_*.npz files to the memory-mappable gallery format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dtype', default=getattr(settings, 'GALLERY_STORAGE_DTYPE', 'float32'),
+                            choices=['float32', 'float16'])
+        parser.add_argument('--delete-old', action='store_true',
+                            help='Remove each .npz file once its converted copy has been verified')
+
+    def handle(self, *args, **options):
+        converted = 0
+        for model in GlobalModel.objects.order_by('created_at'):
+            if is_gallery_header(model.model_file.name):
+                continue
+
+            path = resolve_model_path(model.model_file.name)
+            if path is None:
+                self.stderr.write(f"Model v{model.version}: file {model.model_file.name} not found, skipped")
+                continue
+
+            # Same row order as the .npz, so an existing IVF sidecar stays valid
+            ids, matrix = load_gallery_file(path)
+            header_path = write_gallery(model_stem(path), ids, matrix, dtype=options['dtype'])
+            read_gallery(header_path, mmap=False, verify=True)
+            save_quantized_for_model(header_path, matrix)
+
+            model.model_file.name = os.path.relpath(header_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+            model.save(update_fields=['model_file'])
+            converted += 1
+
+            if options['delete_old']:
+                os.remove(path)
+            self.stdout.write(f"Model v{model.version}: {len(ids)} embeddings -> {model.model_file.name}")
+
+        get_gallery_cache().invalidate()
+        self.stdout.write(self.style.SUCCESS(f"Converted {converted} model(s)"))
@@ -0,0 +1,43 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.enrollment import EnrollmentError, enroll, expected_dim, read_archive, validate_embeddings
+
+
+class Command(BaseCommand):
+    help = 'Enroll many students from a zip of .npy files, an .npz or an NDJSON file in one transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive')
+        parser.add_argument('--strict', action='store_true', help='Enroll nothing if any entry is invalid')
+        parser.add_argument('--dry-run', action='store_true', help='Only validate the archive')
+
+    def handle(self, *args, **options):
+        path = options['archive']
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        try:
+            ids, vectors = read_archive(path, data)
+        except EnrollmentError as e:
+            raise CommandError(str(e))
+
+        accepted, templates, rejected = validate_embeddings(ids, vectors, expected_dim())
+        for entry in rejected:
+            self.stdout.write(f"  rejected #{entry['index']} {entry['student_id']}: {entry['reason']}")
+        self.stdout.write(f"{len(accepted)} accepted, {len(rejected)} rejected")
+
+        if options['dry_run']:
+            return
+        if not accepted:
+            raise CommandError('No valid embeddings in archive')
+        if options['strict'] and rejected:
+            raise CommandError('Archive has invalid entries, nothing enrolled')
+
+        global_model, created, updated = enroll(accepted, templates)
+        self.stdout.write(self.style.SUCCESS(
+            f"Enrolled {len(accepted)} students ({created} new, {updated} updated) "
+            f"into model {global_model.id} with {global_model.num_students} students"))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from api.model_store import collect_garbage
+
+
+class Command(BaseCommand):
+    help = 'Remove global model versions and files outside the retention policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=None, help='Newest versions to keep (MODEL_RETENTION_KEEP)')
+        parser.add_argument('--grace', type=int, default=None,
+                            help='Seconds before unreferenced files are removed (MODEL_ORPHAN_GRACE)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed')
+
+    def handle(self, *args, **options):
+        report = collect_garbage(keep=options['keep'], grace=options['grace'], dry_run=options['dry_run'])
+        for path in report['skipped_files']:
+            self.stdout.write(f"  could not remove {path}, retried on the next run")
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {len(report['deleted_models'])} model(s) and {report['deleted_files']} file(s), "
+            f"{report['freed_bytes'] / 2 ** 20:.1f} MB; kept {', '.join(report['kept']) or 'nothing'}"))
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.inference_server import InferenceServer, parse_address, server_authkey
+
+
+class Command(BaseCommand):
+    help = ('Run the inference server: a pool of processes that each load the face models once and '
+            'serve detection and embedding to the Django workers over shared memory')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=getattr(settings, 'INFERENCE_SERVER_ADDRESS', None),
+                            help="Unix socket path or host:port, on the host of the Django workers")
+        parser.add_argument('--processes', type=int,
+                            default=getattr(settings, 'INFERENCE_SERVER_PROCESSES', 2))
+        parser.add_argument('--threads', type=int,
+                            default=getattr(settings, 'INFERENCE_SERVER_THREADS', None),
+                            help='onnxruntime intra-op threads per process, default one per core')
+
+    def handle(self, *args, **options):
+        if not options['address']:
+            raise CommandError('Set INFERENCE_SERVER_ADDRESS or pass --address')
+
+        server = InferenceServer(parse_address(options['address']), server_authkey(),
+                                 processes=options['processes'], threads=options['threads']).start()
+        try:
+            server.wait_ready()
+            self.stdout.write(f"Inference server ready on {options['address']} with {options['processes']} "
+                              f"processes x {options['threads'] or 'default'} threads")
+            server.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+        self.stdout.write(self.style.SUCCESS("Inference server stopped"))
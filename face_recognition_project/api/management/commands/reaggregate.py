@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.reaggregation import Reaggregation
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the global model from every student embedding file, optionally resuming an interrupted run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='Loader threads (REAGGREGATE_WORKERS)')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Students between checkpoints (REAGGREGATE_CHUNK_SIZE)')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue an interrupted run from its checkpoint while it is still valid')
+        parser.add_argument('--restart', action='store_true',
+                            help='Discard any checkpoint and start over, the default without --resume')
+
+    def progress(self, report):
+        eta = f", eta {report['eta_seconds']:.0f}s" if report['eta_seconds'] is not None else ''
+        self.stdout.write(f"  {report['done']}/{report['total']} students, {report['failed']} failed, "
+                          f"{report['elapsed_seconds']:.1f}s elapsed, {report['students_per_second']}/s{eta}")
+
+    def handle(self, *args, **options):
+        reaggregation = Reaggregation(workers=options['workers'], chunk_size=options['chunk_size'],
+                                      progress=self.progress)
+        global_model, report = reaggregation.run(resume=options['resume'] and not options['restart'])
+        if report['resumed_from']:
+            self.stdout.write(f"Resumed after {report['resumed_from']} students from the checkpoint")
+        if global_model is None:
+            raise CommandError('No valid embeddings found')
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote model v{global_model.version} with {global_model.num_students} students "
+            f"({report['rows']} rows, {report['failed']} failed) in {report['elapsed_seconds']:.1f}s"))
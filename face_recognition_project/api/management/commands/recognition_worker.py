@@ -0,0 +1,52 @@
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.jobs import requeue_stale, work
+
+
+def _worker_main(poll_interval, drain):
+    # Ctrl+C reaches the whole process group; the parent terminates the children
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    connections.close_all()
+    work(poll_interval=poll_interval, drain=drain)
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of worker processes that process queued test_image recognition jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int,
+                            default=getattr(settings, 'RECOGNITION_WORKER_PROCESSES', 2))
+        parser.add_argument('--poll-interval', type=float,
+                            default=getattr(settings, 'RECOGNITION_WORKER_POLL_INTERVAL', 1.0),
+                            help='Seconds to sleep while the queue is empty')
+        parser.add_argument('--drain', action='store_true',
+                            help='Exit once the queue is empty instead of waiting for new jobs')
+
+    def handle(self, *args, **options):
+        requeue_stale()
+
+        # Forked children must not share the parent's database connections
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_worker_main, args=(options['poll_interval'], options['drain']),
+                                    name=f'recognition-worker-{i}', daemon=True)
+            for i in range(max(1, options['processes']))
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f"Started {len(processes)} recognition workers")
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
+        self.stdout.write(self.style.SUCCESS("Recognition workers stopped"))
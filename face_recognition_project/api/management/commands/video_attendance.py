@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.engine import get_engine
+from api.gallery import get_gallery_cache
+from api.video import VideoAttendance
+
+
+class Command(BaseCommand):
+    help = 'Take attendance from a video file or camera stream using face tracking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Video file path, stream URL or camera index')
+        parser.add_argument('--max-frames', type=int, default=None)
+        parser.add_argument('--max-seconds', type=float, default=None,
+                            help='Stop after this much wall time, for live streams')
+        parser.add_argument('--json', action='store_true', help='Print the full report as JSON')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        if source.isdigit():
+            source = int(source)
+
+        gallery = get_gallery_cache().get()
+        if gallery is None or not len(gallery):
+            raise CommandError('No global model found')
+
+        try:
+            report = VideoAttendance.from_settings(get_engine()).run(
+                source, gallery, max_frames=options['max_frames'], max_seconds=options['max_seconds'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        stats = report['stats']
+        self.stdout.write(f"frames read={stats['frames_read']} processed={stats['frames_processed']} "
+                          f"decode={stats['decode_fps']} fps processed={stats['processed_fps']} fps")
+        self.stdout.write(f"tracks={stats['tracks']} embeddings={stats['embeddings_computed']} "
+                          f"({stats['embeddings_per_track']} per track)")
+        for track in report['tracks']:
+            self.stdout.write(f"  track {track['track_id']:>3} frames {track['first_frame']}-{track['last_frame']} "
+                              f"hits={track['hits']} embeddings={track['embeddings_computed']} "
+                              f"-> {track['student_id'] or 'unknown'}")
+        self.stdout.write(self.style.SUCCESS(f"{report['total_present']} students present"))
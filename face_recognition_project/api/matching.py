@@ -0,0 +1,278 @@
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # scipy is optional, fall back to the NumPy solver below
+    linear_sum_assignment = None
+
+SIMILARITY_THRESHOLD = 0.5
+
+
+def normalize_rows(matrix):
+    """L2-normalize each row of a float32 matrix in place"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def normalize_probes(embeddings):
+    """Stack face embeddings into an L2-normalized (faces x dim) float32 matrix"""
+    probes = np.array(np.stack([np.asarray(e).ravel() for e in embeddings]), dtype=np.float32)
+    return normalize_rows(probes)
+
+
+class StackedRows:
+    """Read-only rows of a base matrix followed by appended rows, without copying the base
+
+    Delta segments add a handful of rows to a memory-mapped gallery; a
+    concatenated copy would pull the whole base into private memory in
+    every process. Indexing and scoring read the two parts separately.
+    """
+    ndim = 2
+
+    def __init__(self, base, tail):
+        self.base = base
+        self.tail = np.ascontiguousarray(np.asarray(tail).reshape(-1, base.shape[1]), dtype=base.dtype)
+        self.shape = (len(base) + len(self.tail), base.shape[1])
+
+    @classmethod
+    def append(cls, matrix, rows):
+        """`matrix` (an array or StackedRows) with `rows` added; only the tail is ever copied"""
+        if isinstance(matrix, cls):
+            return cls(matrix.base, np.concatenate([matrix.tail, np.asarray(rows, dtype=matrix.dtype)]))
+        return cls(matrix, rows)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.base.nbytes + self.tail.nbytes
+
+    def setflags(self, write):
+        self.base.setflags(write=write)
+        self.tail.setflags(write=write)
+
+    def __getitem__(self, key):
+        """Rows by slice, integer array (any shape) or boolean mask, as a new array"""
+        split = len(self.base)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1 and stop <= split:
+                return self.base[start:stop]
+            if step == 1 and start >= split:
+                return self.tail[start - split:stop - split]
+            key = np.arange(start, stop, step)
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        rows = np.empty(key.shape + (self.shape[1],), dtype=self.dtype)
+        in_base = key < split
+        rows[in_base] = self.base[key[in_base]]
+        rows[~in_base] = self.tail[key[~in_base] - split]
+        return rows
+
+    def scores(self, probes):
+        """probes @ rows.T, one matrix multiply per part into one result"""
+        split = len(self.base)
+        scores = np.empty((len(probes), len(self)), dtype=np.result_type(probes, self.dtype))
+        np.matmul(probes, self.base.T, out=scores[:, :split])
+        np.matmul(probes, self.tail.T, out=scores[:, split:])
+        return scores
+
+
+def row_scores(probes, matrix):
+    """(faces x rows) similarities against a matrix or StackedRows"""
+    if isinstance(matrix, StackedRows):
+        return matrix.scores(probes)
+    return probes @ matrix.T
+
+
+def top_k(scores, k, valid=None, threshold=None):
+    """Pick the k best columns per row of a (faces x students) score matrix
+
+    Returns (indices, scores), both (faces x k) and sorted best first. Slots
+    that are masked out or not above the threshold have index -1 and score -inf.
+    """
+    num_faces, num_students = scores.shape
+    k = min(k, num_students)
+    if num_faces == 0 or k == 0:
+        return np.empty((num_faces, 0), dtype=np.intp), np.empty((num_faces, 0), dtype=np.float32)
+
+    if valid is not None:
+        scores = np.where(valid[np.newaxis, :], scores, -np.inf)
+
+    # Unordered top-k in O(students), then sort only those k
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1, kind='stable')
+    idx = np.take_along_axis(idx, order, axis=1)
+    top = np.take_along_axis(top, order, axis=1).astype(np.float32)
+
+    rejected = ~np.isfinite(top)
+    if threshold is not None:
+        rejected |= top <= threshold
+    idx[rejected] = -1
+    top[rejected] = -np.inf
+    return idx, top
+
+
+def rerank(probes, matrix, shortlist, k, threshold=None):
+    """Exact float32 scores for a per-face shortlist of rows, cut to the top k
+
+    `shortlist` is (faces x n) row indices from an approximate pass, -1 for
+    empty slots. Only those rows of `matrix` are read.
+    """
+    rows = np.asarray(matrix[np.maximum(shortlist, 0)], dtype=np.float32)
+    exact = np.einsum('fd,fnd->fn', probes, rows)
+    exact[shortlist < 0] = -np.inf
+    local, top = top_k(exact, k, threshold=threshold)
+    idx = np.take_along_axis(shortlist, np.maximum(local, 0), axis=1)
+    return np.where(local >= 0, idx, -1), top
+
+
+def pool_templates(scores, starts, counts=None, pooling='max'):
+    """Reduce (faces x templates) scores to (faces x students)
+
+    Columns of each student are the contiguous slice starting at
+    starts[s], so the reduction is one segmented reduceat per pooling
+    mode instead of a Python loop over students.
+    """
+    if len(starts) == 0:
+        return np.empty((len(scores), 0), dtype=np.float32)
+    if pooling == 'max':
+        return np.maximum.reduceat(scores, starts, axis=1)
+    if pooling == 'mean':
+        return (np.add.reduceat(scores, starts, axis=1) / counts).astype(np.float32)
+    raise ValueError(f"Unknown template pooling {pooling!r}")
+
+
+def match_faces(probes, gallery, k=5, threshold=SIMILARITY_THRESHOLD):
+    """Match all faces against the gallery through its search index
+
+    `probes` must already be normalized (see normalize_probes). With the
+    default flat index this is one matrix multiply over the whole gallery.
+    Returns top-k student indices (into gallery.student_ids) and scores
+    per face.
+    """
+    if not gallery.has_templates:
+        idx, top = gallery.index.search(probes, k, threshold=threshold)
+        return np.where(idx >= 0, gallery.owner[np.maximum(idx, 0)], -1), top
+
+    if gallery.index.kind == 'flat' and gallery.quantized is None:
+        return top_k(gallery.student_scores(probes), k, threshold=threshold)
+
+    # The index (approximate or quantized) finds candidate templates; their students are then scored exactly
+    idx, _ = gallery.index.search(probes, k * gallery.max_templates, threshold=threshold)
+    students = np.unique(gallery.owner[idx[idx >= 0]])
+    local_idx, top = top_k(gallery.student_scores(probes, students), k, threshold=threshold)
+    return np.where(local_idx >= 0, students[np.maximum(local_idx, 0)], -1), top
+
+
+def candidates_for(gallery, idx, top):
+    """Turn top-k arrays into per-face lists of (student_id, similarity)"""
+    results = []
+    for face_idx, face_scores in zip(idx, top):
+        keep = face_idx >= 0
+        results.append(list(zip(gallery.student_ids[face_idx[keep]].tolist(), face_scores[keep].tolist())))
+    return results
+
+
+def hungarian(cost):
+    """Minimum-cost rectangular assignment (Hungarian algorithm, O(n^2 m))
+
+    Same contract as scipy.optimize.linear_sum_assignment: returns
+    (row_ind, col_ind) with every row of the smaller side assigned.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # Potentials and matching are 1-based, column 0 is a virtual start node
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, dtype=np.intp)
+    way = np.zeros(m + 1, dtype=np.intp)
+
+    for row in range(1, n + 1):
+        owner[0] = row
+        col = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while owner[col] != 0:
+            used[col] = True
+            current = owner[col]
+            reduced = cost[current - 1] - u[current] - v[1:]
+            free = ~used[1:]
+
+            # Relax all free columns at once
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = col
+
+            candidates = np.where(free, minv[1:], np.inf)
+            next_col = int(np.argmin(candidates)) + 1
+            delta = candidates[next_col - 1]
+
+            used_cols = np.flatnonzero(used)
+            u[owner[used_cols]] += delta
+            v[used_cols] -= delta
+            minv[1:][free] -= delta
+            col = next_col
+
+        # Flip the augmenting path
+        while col:
+            prev = way[col]
+            owner[col] = owner[prev]
+            col = prev
+
+    col_ind = np.flatnonzero(owner[1:])
+    row_ind = owner[1:][col_ind] - 1
+    if transposed:
+        row_ind, col_ind = col_ind, row_ind
+    order = np.argsort(row_ind)
+    return row_ind[order], col_ind[order]
+
+
+def assign_faces(probes, gallery, idx, threshold=SIMILARITY_THRESHOLD):
+    """One-to-one assignment of faces to students maximizing total similarity
+
+    Only students that appear among some face's top-k candidates (`idx`
+    from match_faces) are considered, which keeps the problem at most
+    faces x (faces * k) no matter how large the gallery is. Returns
+    (students, scores) per face: the student index or -1 when the face
+    stays unassigned, and the matched (pooled) similarity or -inf.
+    """
+    num_faces = len(probes)
+    students = np.full(num_faces, -1, dtype=np.intp)
+    scores = np.full(num_faces, -np.inf, dtype=np.float32)
+
+    columns = np.unique(idx[idx >= 0])
+    if columns.size == 0:
+        return students, scores
+
+    # Weight is the margin above threshold, so pairs at or below it are worth nothing
+    candidate_scores = gallery.student_scores(probes, columns)
+    weights = np.where(candidate_scores > threshold, candidate_scores - threshold, 0.0)
+
+    solver = linear_sum_assignment or hungarian
+    rows, cols = solver(-weights)
+
+    accepted = weights[rows, cols] > 0
+    rows, cols = rows[accepted], cols[accepted]
+    students[rows] = columns[cols]
+    scores[rows] = candidate_scores[rows, cols]
+    return students, scores
@@ -0,0 +1,357 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Max
+
+from core.models import GlobalModel, GlobalModelDelta
+from .gallery import get_gallery_cache, lease_dir, lease_model_id, load_model_gallery, resolve_model_path
+from .index import build_index, save_index_for_model
+from .matching import normalize_rows
+from .quantization import save_quantized_for_model
+from .storage import HEADER_SUFFIX, model_files, write_gallery
+
+logger = logging.getLogger(__name__)
+
+_compaction_lock = threading.Lock()
+_retention_lock = threading.Lock()
+
+# Serializes enrollment writes and compaction swaps within the process; SQLite
+# fails read-then-write transactions that overlap instead of waiting
+write_lock = threading.RLock()
+
+
+def get_model_dir():
+    model_dir = os.path.join(settings.MEDIA_ROOT, 'global_model')
+    os.makedirs(model_dir, exist_ok=True)
+    return model_dir
+
+
+def stack_embeddings(embeddings):
+    """IDs and normalized float32 rows of an ID-to-embedding mapping
+
+    A (templates x dim) value is a template set: it becomes that many
+    consecutive rows under the same ID.
+    """
+    if not embeddings:
+        return np.array([], dtype=str), np.zeros((0, 0), dtype=np.float32)
+    blocks = [np.asarray(e, dtype=np.float32) for e in embeddings.values()]
+    blocks = [block.reshape(-1, block.shape[-1]) for block in blocks]
+    ids = np.repeat(np.array(list(embeddings.keys()), dtype=str), [len(block) for block in blocks])
+    return ids, normalize_rows(np.concatenate(blocks))
+
+
+def save_snapshot_file(embeddings):
+    """Write a full model file and return its version and relative path"""
+    return save_snapshot_arrays(*stack_embeddings(embeddings))
+
+
+def save_snapshot_arrays(ids, matrix):
+    """Write a full model file from per-row IDs and normalized rows"""
+    # Group rows by index list before saving so search scans contiguous slices
+    ids, matrix, index = build_index(ids, matrix)
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    stem = os.path.join(get_model_dir(), f"global_model_{timestamp}")
+
+    # Two snapshots within the same second (e.g. a compaction) must not overwrite each other
+    suffix = 1
+    while os.path.exists(stem + HEADER_SUFFIX):
+        suffix += 1
+        stem = os.path.join(get_model_dir(), f"global_model_{timestamp}_{suffix}")
+    if suffix > 1:
+        timestamp = f"{timestamp}_{suffix}"
+
+    model_path = write_gallery(stem, ids, matrix, dtype=getattr(settings, 'GALLERY_STORAGE_DTYPE', 'float32'))
+    model_filename = os.path.basename(model_path)
+
+    # Persist the search index and match encoding so requests only have to load them
+    save_index_for_model(model_path, index)
+    save_quantized_for_model(model_path, matrix)
+    logger.info(f"Saved model to {model_path}")
+    return timestamp, f'global_model/{model_filename}'
+
+
+def write_snapshot(embeddings):
+    """Write a full model file plus its GlobalModel row"""
+    return write_snapshot_arrays(*stack_embeddings(embeddings), num_students=len(embeddings))
+
+
+def write_snapshot_arrays(ids, matrix, num_students=None):
+    """Write a full model file from per-row IDs and normalized rows, plus its GlobalModel row"""
+    version, relative_path = save_snapshot_arrays(ids, matrix)
+    global_model = GlobalModel.objects.create(
+        version=version,
+        model_file=relative_path,
+        num_students=num_students if num_students is not None else len(set(np.asarray(ids).tolist()))
+    )
+    get_gallery_cache().invalidate()
+    maybe_collect_garbage()
+    return global_model
+
+
+def write_delta(base, gallery, upserts, removed=()):
+    """Append a delta segment of added/updated and removed students to a base model"""
+    ids, matrix = stack_embeddings(upserts)
+    removed = np.array(list(removed), dtype=str)
+
+    # Student count after the delta, counted like full snapshots (all stored IDs)
+    current = set(gallery.ids[~gallery.removed].tolist()) if gallery is not None else set()
+    num_students = len((current | set(ids.tolist())) - set(removed.tolist()))
+
+    with write_lock, transaction.atomic():
+        # A compaction may have replaced the base since the caller looked it up
+        latest = GlobalModel.objects.order_by('-created_at', '-id').first()
+        if latest is not None and latest.id != base.id:
+            base = latest
+
+        sequence = (base.deltas.aggregate(last=Max('sequence'))['last'] or 0) + 1
+        delta_filename = f"global_model_{base.version}.delta{sequence:04d}.npz"
+        delta_path = os.path.join(get_model_dir(), delta_filename)
+        tmp_path = f"{delta_path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, ids=ids, embeddings=matrix, removed=removed)
+        os.replace(tmp_path, delta_path)
+
+        delta = GlobalModelDelta.objects.create(
+            base=base,
+            sequence=sequence,
+            delta_file=f'global_model/{delta_filename}',
+            num_upserted=len(ids),
+            num_removed=len(removed)
+        )
+        GlobalModel.objects.filter(id=base.id).update(num_students=num_students)
+        base.num_students = num_students
+
+    logger.info(f"Appended delta {sequence} to model v{base.version}: "
+                f"{len(ids)} upserted, {len(removed)} removed")
+    get_gallery_cache().invalidate()
+    return delta
+
+
+def update_model(upserts, removed=()):
+    """Record enrollment changes as a delta on the latest model, or a first snapshot"""
+    cache = get_gallery_cache()
+    cache.invalidate()
+    gallery = cache.get()
+    base = GlobalModel.objects.filter(id=gallery.model_id).first() if gallery is not None else None
+
+    if base is None:
+        return write_snapshot(upserts), 0
+
+    existing_count = gallery.num_entries
+    delta = write_delta(base, gallery, upserts, removed)
+    maybe_compact(delta.base)
+    return delta.base, existing_count
+
+
+def is_latest(base, ignore=None):
+    models = GlobalModel.objects.order_by('-created_at', '-id')
+    if ignore is not None:
+        models = models.exclude(id=ignore.id)
+    return models.values_list('id', flat=True).first() == base.id
+
+
+def compact(base):
+    """Fold the latest base model and its deltas into a new full snapshot"""
+    if not is_latest(base):
+        logger.info(f"Model v{base.version} is no longer the latest, skipping compaction")
+        return None
+
+    last_sequence = base.deltas.aggregate(last=Max('sequence'))['last'] or 0
+    path = resolve_model_path(base.model_file.name)
+    gallery = load_model_gallery(base.id, base.version, path, up_to_sequence=last_sequence)
+    embeddings = gallery.as_templates()
+
+    # Write the file first so the transaction only covers the row updates
+    version, relative_path = save_snapshot_file(embeddings)
+    # The transaction starts with a write so SQLite takes the write lock up front
+    with write_lock, transaction.atomic():
+        new_base = GlobalModel.objects.create(
+            version=version,
+            model_file=relative_path,
+            num_students=len(embeddings)
+        )
+        if not is_latest(base, ignore=new_base):
+            # Another process compacted or reaggregated meanwhile
+            transaction.set_rollback(True)
+            for path in model_files(os.path.join(settings.MEDIA_ROOT, relative_path)):
+                os.remove(path)
+            logger.info(f"Model v{base.version} was replaced during compaction, discarding v{version}")
+            return None
+
+        # Deltas that landed while we were compacting move over to the new base
+        moved = (GlobalModelDelta.objects.filter(base=base, sequence__gt=last_sequence)
+                 .update(base=new_base, sequence=F('sequence') - last_sequence))
+        if moved:
+            num_students = GlobalModel.objects.get(id=base.id).num_students
+            GlobalModel.objects.filter(id=new_base.id).update(num_students=num_students)
+
+    get_gallery_cache().invalidate()
+    logger.info(f"Compacted model v{base.version} with {last_sequence} deltas into v{new_base.version}"
+                + (f", carried over {moved} newer deltas" if moved else ""))
+    maybe_collect_garbage()
+    return new_base
+
+
+def _compact_in_background(base_id):
+    try:
+        base = GlobalModel.objects.get(id=base_id)
+        compact(base)
+    except Exception as e:
+        logger.error(f"Error compacting model {base_id}: {str(e)}")
+    finally:
+        _compaction_lock.release()
+        connection.close()
+
+
+def maybe_compact(base):
+    """Start a background compaction once a base has collected enough deltas"""
+    threshold = getattr(settings, 'GLOBAL_MODEL_COMPACTION_THRESHOLD', 20)
+    if not threshold or base.deltas.count() < threshold:
+        return False
+    if not _compaction_lock.acquire(blocking=False):
+        return False
+
+    thread = threading.Thread(target=_compact_in_background, args=(base.id,), daemon=True)
+    thread.start()
+    return True
+
+
+def leased_model_ids(timeout=None):
+    """IDs of models some process has recently served; stale lease files are removed"""
+    timeout = timeout if timeout is not None else getattr(settings, 'MODEL_LEASE_TIMEOUT', 600)
+    leased = set()
+    if not os.path.isdir(lease_dir()):
+        return leased
+    now = time.time()
+    for name in os.listdir(lease_dir()):
+        path = os.path.join(lease_dir(), name)
+        try:
+            if now - os.path.getmtime(path) > timeout:
+                # The process exited or stopped serving requests long ago
+                os.remove(path)
+                continue
+        except FileNotFoundError:
+            continue
+        model_id = lease_model_id(name)
+        if model_id is not None:
+            leased.add(model_id)
+    return leased
+
+
+def files_of_model(model):
+    """Absolute paths of a model's files on disk: base, sidecars and delta segments"""
+    paths = []
+    path = resolve_model_path(model.model_file.name)
+    if path is not None:
+        paths.extend(model_files(path))
+    for delta_file in model.deltas.values_list('delta_file', flat=True):
+        delta_path = resolve_model_path(delta_file)
+        if delta_path is not None:
+            paths.append(delta_path)
+    return [os.path.abspath(path) for path in paths]
+
+
+def _remove_files(paths, report):
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            # E.g. still mapped on Windows; the orphan sweep retries on the next run
+            logger.error(f"Could not remove {path}: {str(e)}")
+            report['skipped_files'].append(path)
+            continue
+        report['deleted_files'] += 1
+        report['freed_bytes'] += size
+
+
+def collect_garbage(keep=None, grace=None, dry_run=False):
+    """Apply the retention policy to global models and their files
+
+    Keeps the `keep` (MODEL_RETENTION_KEEP) newest models, pinned models
+    and models with a fresh lease; the newest model is always kept. Other
+    models lose their rows and files. Files in the model directory that no
+    row references (failed writes, leftovers of older code) are removed
+    once they are older than `grace` seconds, so snapshots still being
+    written are safe. Returns a report of what was (or would be) removed.
+    """
+    keep = max(1, keep if keep is not None else getattr(settings, 'MODEL_RETENTION_KEEP', 3))
+    grace = grace if grace is not None else getattr(settings, 'MODEL_ORPHAN_GRACE', 3600)
+    report = {'kept': [], 'deleted_models': [], 'deleted_files': 0, 'freed_bytes': 0, 'skipped_files': [],
+              'dry_run': dry_run}
+
+    models = list(GlobalModel.objects.order_by('-created_at', '-id'))
+    leased = leased_model_ids()
+    retained = {model.id for model in models[:keep]} | {model.id for model in models if model.pinned} | leased
+
+    for model in models:
+        if model.id in retained:
+            report['kept'].append(model.version)
+            continue
+        paths = files_of_model(model)
+        if dry_run:
+            report['deleted_models'].append(model.version)
+            report['deleted_files'] += len(paths)
+            report['freed_bytes'] += sum(os.path.getsize(path) for path in paths)
+            continue
+
+        with write_lock, transaction.atomic():
+            # Rows first, so nothing resolves the files once they start disappearing
+            deleted, _ = GlobalModel.objects.filter(id=model.id, pinned=False).delete()
+        if not deleted:
+            report['kept'].append(model.version)
+            continue
+        report['deleted_models'].append(model.version)
+        _remove_files(paths, report)
+
+    # Orphans: anything in the model directory no remaining row points at
+    referenced = set()
+    for model in GlobalModel.objects.all():
+        referenced.update(files_of_model(model))
+    now = time.time()
+    orphans = []
+    for name in os.listdir(get_model_dir()):
+        path = os.path.abspath(os.path.join(get_model_dir(), name))
+        if not os.path.isfile(path) or path in referenced:
+            continue
+        if now - os.path.getmtime(path) > grace:
+            orphans.append(path)
+    if dry_run:
+        report['deleted_files'] += len(orphans)
+        report['freed_bytes'] += sum(os.path.getsize(path) for path in orphans)
+    else:
+        _remove_files(orphans, report)
+
+    logger.info(f"Model retention {'would remove' if dry_run else 'removed'} {len(report['deleted_models'])} "
+                f"models and {report['deleted_files']} files ({report['freed_bytes'] / 2 ** 20:.1f} MB)")
+    return report
+
+
+def _collect_in_background():
+    try:
+        collect_garbage()
+    except Exception as e:
+        logger.error(f"Error collecting old models: {str(e)}")
+    finally:
+        _retention_lock.release()
+        connection.close()
+
+
+def maybe_collect_garbage():
+    """Apply the retention policy in the background after a new snapshot, if enabled"""
+    if not getattr(settings, 'MODEL_RETENTION_AUTO', True):
+        return False
+    if not _retention_lock.acquire(blocking=False):
+        return False
+
+    thread = threading.Thread(target=_collect_in_background, daemon=True)
+    thread.start()
+    return True
@@ -0,0 +1,472 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from core.models import TestImage
+from .detection import DetectionPlan, decode_image, image_size, plan_detection
+from .embedding_cache import get_embedding_cache
+from .engine import get_engine
+from .gallery import get_gallery_cache
+from .inference_server import InferenceServerError
+from .matching import SIMILARITY_THRESHOLD, normalize_probes, match_faces, candidates_for, assign_faces
+from .metrics import record_result, timed
+from .profiling import attach_test_image
+from .rendering import RENDER_EAGER, RENDER_LAZY, draw_face_boxes, prepare_result_image, render_mode, save_result_image
+from .uploads import content_hash, persist_upload, read_upload
+
+logger = logging.getLogger(__name__)
+
+# TestImage columns written by a recognition run
+RESULT_FIELDS = ['result', 'result_image', 'processed', 'status', 'stats']
+
+
+class RecognitionError(Exception):
+    """Recognition failed for a reason the client should see, with its response code"""
+
+    def __init__(self, msg, code=400):
+        super().__init__(msg)
+        self.msg = msg
+        self.code = code
+
+
+class GlobalModelTester:
+    def __init__(self, model_dir=None, test_dir=None):
+        """Initialize with model and test directories"""
+        self.model_dir = model_dir or os.path.join(settings.MEDIA_ROOT, 'global_model')
+        self.test_dir = test_dir or os.path.join(settings.MEDIA_ROOT, 'test_images')
+        
+        # Shared face processor, loaded once per process
+        self.engine = get_engine()
+        
+        # Setup logging
+        logging.basicConfig(level=logging.INFO)
+        self.logger = logging.getLogger(__name__)
+
+    def load_latest_model(self):
+        """Get the gallery of the latest global model from the process cache"""
+        try:
+            return get_gallery_cache().get()
+            
+        except Exception as e:
+            self.logger.error(f"Error loading model: {str(e)}")
+            return None
+
+    def load_image(self, source):
+        """Decode an image path or upload bytes as RGB at the scale detection needs: (img, scale, plan)"""
+        # Plan decode scale, detector size and tiling from the header alone
+        size = image_size(source)
+        plan = plan_detection(*size) if size else DetectionPlan(0, 0)
+        img, scale = decode_image(source, plan)
+        return img, scale, plan
+
+    def analyze_image(self, source, content_hash=None, timings=None):
+        """Faces of an image from the embedding cache, or from detection on a miss
+
+        Returns (faces, img, error, cache_hit). On a hit detection and
+        embedding are skipped, and the image is only decoded when the result
+        is drawn right away (RESULT_IMAGE_MODE 'eager'); otherwise img is None.
+        """
+        timings = timings if timings is not None else {}
+        cache = get_embedding_cache() if content_hash else None
+        if cache is not None:
+            with timed(timings, 'cache_lookup'):
+                faces = cache.get(content_hash)
+            if faces:
+                if render_mode() != RENDER_EAGER:
+                    return faces, None, None, True
+                with timed(timings, 'decode'):
+                    img, _, _ = self.load_image(source)
+                if img is None:
+                    return None, None, "Failed to read image", True
+                return faces, img, None, True
+        
+        faces, img, error = self.process_test_image(source, timings=timings)
+        if cache is not None and not error:
+            cache.put(content_hash, faces)
+        return faces, img, error, False
+
+    def process_test_image(self, source, timings=None):
+        """Process a single test image, given as a path or the upload bytes
+
+        The upload is decoded at reduced scale when it is much larger than
+        detection needs. Boxes are reported in original image coordinates
+        ('bbox') and in coordinates of the returned image ('image_bbox').
+        Per-stage seconds go into `timings` when given.
+        """
+        timings = timings if timings is not None else {}
+        try:
+            # Read and process image, already converted to RGB
+            with timed(timings, 'decode'):
+                img, scale, plan = self.load_image(source)
+            if img is None:
+                return None, None, "Failed to read image"
+            
+            # Detector only, then one recognition call per batch of aligned crops,
+            # in this process or on the inference server (see get_engine)
+            bboxes, kpss, embeddings = self.engine.detect_and_embed(img, plan, timings=timings)
+            if not len(bboxes):
+                return None, None, "No faces detected"
+            
+            # Process each face
+            processed_faces = []
+            for box, embedding in zip(bboxes, embeddings):
+                processed_faces.append({
+                    'bbox': (box[:4] * scale).astype(int),
+                    'image_bbox': box[:4].astype(int),
+                    'embedding': embedding,
+                    'score': box[4]
+                })
+            
+            return processed_faces, img, None
+            
+        except InferenceServerError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Error processing image: {str(e)}")
+            return None, None, str(e)
+
+    def compare_embeddings(self, faces, gallery, k=5):
+        """Compare all faces with the gallery at once and return top matches per face"""
+        try:
+            probes = normalize_probes([face['embedding'] for face in faces])
+            idx, scores = match_faces(probes, gallery, k=k, threshold=SIMILARITY_THRESHOLD)
+            match_results = candidates_for(gallery, idx, scores)
+            
+            # Best match per face, only when asked for: one line per face is costly on the hot path
+            if getattr(settings, 'LOG_MATCH_DETAILS', False):
+                for matches in match_results:
+                    if matches:
+                        student_id, similarity = matches[0]
+                        self.logger.info(f"Face matched with Student {student_id} (similarity: {similarity:.2f})")
+            
+            return match_results
+            
+        except Exception as e:
+            self.logger.error(f"Error comparing embeddings: {str(e)}")
+            return [[] for _ in faces]
+
+    def assign_students(self, faces, gallery, k=5):
+        """Assign each face to at most one student and each student to at most one face"""
+        return self.assign_batch([faces], gallery, k=k)[0]
+
+    def assign_batch(self, faces_per_image, gallery, k=5):
+        """Assign the faces of several images, searching the gallery once for all of them
+
+        The one-to-one constraint holds within each image; the same student
+        may be found again in another photo of the room.
+        """
+        counts = [len(faces) for faces in faces_per_image]
+        if not sum(counts):
+            return [[] for _ in faces_per_image]
+        probes = normalize_probes([face['embedding'] for faces in faces_per_image for face in faces])
+        idx, _ = match_faces(probes, gallery, k=k, threshold=SIMILARITY_THRESHOLD)
+        
+        results = []
+        start = 0
+        for count in counts:
+            stop = start + count
+            students, scores = assign_faces(probes[start:stop], gallery, idx[start:stop],
+                                            threshold=SIMILARITY_THRESHOLD)
+            results.append([None if student < 0 else (str(gallery.student_ids[student]), score)
+                            for student, score in zip(students.tolist(), scores.tolist())])
+            start = stop
+        return results
+
+    def save_result_image(self, image, faces, assignments, result_filename):
+        """Draw the assignments onto the image and write it to test_results"""
+        return os.path.basename(save_result_image(image, faces, assignments, result_filename))
+
+    def draw_face_boxes(self, image, faces, match_results):
+        """Draw boxes and labels on faces"""
+        try:
+            return draw_face_boxes(image, faces, match_results)
+        except Exception as e:
+            self.logger.error(f"Error drawing result: {str(e)}")
+            return image
+
+
+def save_upload(image_file, persist=None):
+    """Create the TestImage for an upload and return it with the upload bytes
+
+    The pipeline decodes the returned bytes directly; the original is
+    stored according to UPLOAD_PERSIST (or `persist`) once the row is
+    committed, and an identical earlier upload's file is reused instead of
+    writing it again.
+    """
+    data = read_upload(image_file)
+    digest = content_hash(data)
+    previous = (TestImage.objects.filter(content_hash=digest).exclude(image='')
+                .order_by('-id').first())
+    if previous is not None and os.path.exists(previous.image.path):
+        test_image = TestImage.objects.create(image=previous.image.name, content_hash=digest)
+        attach_test_image(test_image.id)
+        return test_image, data
+
+    test_image = TestImage.objects.create(image='', content_hash=digest)
+    attach_test_image(test_image.id)
+
+    def on_saved(stored_name):
+        TestImage.objects.filter(id=test_image.id).update(image=stored_name)
+        test_image.image.name = stored_name
+
+    # Callers may create uploads inside a transaction; a background write must not
+    # update the row from another connection before it is committed
+    name = os.path.join('test_images', os.path.basename(image_file.name))
+    transaction.on_commit(lambda: persist_upload(name, data, mode=persist, on_saved=on_saved))
+    return test_image, data
+
+
+async def asave_upload(image_file, persist=None):
+    """save_upload for async views: file reads and writes run in threads, ORM calls are awaited"""
+    data = await sync_to_async(read_upload, thread_sensitive=False)(image_file)
+    digest = content_hash(data)
+    previous = await (TestImage.objects.filter(content_hash=digest).exclude(image='')
+                      .order_by('-id').afirst())
+    if previous is not None and await sync_to_async(os.path.exists, thread_sensitive=False)(previous.image.path):
+        test_image = await TestImage.objects.acreate(image=previous.image.name, content_hash=digest)
+        return test_image, data
+
+    test_image = await TestImage.objects.acreate(image='', content_hash=digest)
+
+    def on_saved(stored_name):
+        TestImage.objects.filter(id=test_image.id).update(image=stored_name)
+        test_image.image.name = stored_name
+
+    await sync_to_async(persist_upload, thread_sensitive=False)(
+        os.path.join('test_images', os.path.basename(image_file.name)), data, mode=persist, on_saved=on_saved)
+    return test_image, data
+
+
+def run_recognition(test_image, tester=None, timings=None, image_data=None):
+    """Run detection, matching and result drawing for a saved TestImage
+
+    Decodes `image_data` when the caller still holds the upload bytes,
+    otherwise reads the stored file. Updates the row with the results and
+    returns the response data. Raises RecognitionError for unreadable
+    images, images without faces and a missing global model.
+    """
+    timings = timings if timings is not None else {}
+    data = recognize_image(test_image, tester=tester, timings=timings, image_data=image_data)
+    
+    # The image column may still be filled in by a background upload write
+    with timed(timings, 'db_save'):
+        test_image.save(update_fields=RESULT_FIELDS)
+    record_recognized(test_image, data)
+    
+    return data
+
+
+def record_recognized(test_image, data):
+    """Count a recognized and saved image in the metrics"""
+    record_result('done', faces=data['total_faces'], matches=data['total_matches'],
+                  cache_hit=test_image.stats.get('embedding_cache') == 'hit')
+
+
+def recognize_image(test_image, tester=None, timings=None, image_data=None):
+    """The work of run_recognition without the final save
+
+    Sets the result fields of `test_image` (RESULT_FIELDS) and returns the
+    response data; the caller saves the row.
+    """
+    tester = tester or GlobalModelTester()
+    timings = timings if timings is not None else {}
+    source = image_data if image_data is not None else test_image.image.path
+    
+    # Process image, or reuse the faces of an identical earlier upload
+    try:
+        faces, img, error, cache_hit = tester.analyze_image(source, test_image.content_hash, timings=timings)
+    except InferenceServerError as e:
+        record_result('failed')
+        raise RecognitionError(str(e), 503)
+    if error:
+        record_result('failed')
+        raise RecognitionError(error, 400)
+    
+    # Load model
+    with timed(timings, 'gallery_load'):
+        gallery = tester.load_latest_model()
+    if gallery is None or not len(gallery):
+        record_result('no_model')
+        raise RecognitionError('No global model found', 404)
+    
+    # Match all faces in one pass and solve the face-to-student assignment
+    with timed(timings, 'matching'):
+        assignments = tester.assign_students(
+            faces, gallery, k=getattr(settings, 'MATCH_TOP_K', 5))
+    
+    # Draw and save result image, unless it is rendered on first request
+    if render_mode() == RENDER_LAZY:
+        result_image_url = prepare_result_image(test_image, img, faces, assignments)
+    else:
+        with timed(timings, 'drawing'):
+            result_image_url = prepare_result_image(test_image, img, faces, assignments)
+    
+    # Prepare clean response
+    clean_results = []
+    unassigned_faces = []
+    total_students = gallery.num_students  # Count unique students
+    
+    for face_index, (face, assigned) in enumerate(zip(faces, assignments)):
+        if assigned is None:
+            unassigned_faces.append({
+                'face_index': face_index,
+                'bbox': [int(v) for v in face['bbox']],
+                'det_score': float(face['score'])
+            })
+            continue
+        
+        student_id, similarity = assigned
+        clean_results.append({
+            'student_id': student_id,
+            'similarity': float(similarity)
+        })
+    
+    # Sort final results by similarity
+    clean_results.sort(key=lambda x: x['similarity'], reverse=True)
+    
+    data = {
+        'total_students_in_database': total_students,
+        'total_faces': len(faces),
+        'total_matches': len(clean_results),
+        'matches': clean_results,
+        'unassigned_faces': unassigned_faces,
+        'result_image_url': result_image_url
+    }
+    
+    # Update test image record
+    test_image.result = clean_results
+    test_image.processed = True
+    test_image.status = test_image.STATUS_DONE
+    test_image.stats = {
+        **(test_image.stats or {}),
+        'timings': dict(timings),
+        'embedding_cache': 'hit' if cache_hit else 'miss',
+        'summary': {k: v for k, v in data.items() if k != 'matches'},
+    }
+    
+    return data
+
+
+def save_batch_results(test_images):
+    with transaction.atomic():
+        for test_image in test_images:
+            test_image.save(update_fields=RESULT_FIELDS + ['error'])
+
+
+def run_batch_recognition(test_images, tester=None, image_data=None, save=True):
+    """Recognize several photos of one room and merge them into one attendance list
+
+    Detection runs on a thread pool sized to the engine pool, all faces are
+    searched against the gallery in one matrix operation and each student
+    is reported once, with the best score over all images. Images that fail
+    are reported with their error instead of failing the batch. `image_data`
+    holds the upload bytes per image when the caller still has them.
+    With save=False the rows are left for the caller to save_batch_results.
+    """
+    tester = tester or GlobalModelTester()
+    timings = {}
+    start = time.perf_counter()
+
+    def detect(item):
+        test_image, data = item
+        image_timings = {}
+        source = data if data is not None else test_image.image.path
+        try:
+            faces, img, error, cache_hit = tester.analyze_image(source, test_image.content_hash,
+                                                                timings=image_timings)
+        except InferenceServerError as e:
+            return None, None, str(e), image_timings, False
+        return faces, img, error, image_timings, cache_hit
+
+    # Decode, detection and embedding, one engine session per thread
+    with timed(timings, 'face_analysis'):
+        workers = min(len(test_images), tester.engine.size)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            detections = list(executor.map(detect, zip(test_images, image_data or [None] * len(test_images))))
+
+    with timed(timings, 'gallery_load'):
+        gallery = tester.load_latest_model()
+    if gallery is None or not len(gallery):
+        record_result('no_model')
+        raise RecognitionError('No global model found', 404)
+
+    # One gallery search for every face of every image
+    faces_per_image = [faces or [] for faces, _, _, _, _ in detections]
+    with timed(timings, 'matching'):
+        assignments_per_image = tester.assign_batch(
+            faces_per_image, gallery, k=getattr(settings, 'MATCH_TOP_K', 5))
+
+    images = []
+    attendance = {}
+    with timed(timings, 'drawing'):
+        for image_index, (test_image, (faces, img, error, image_timings, cache_hit), assignments) in enumerate(
+                zip(test_images, detections, assignments_per_image)):
+            entry = {
+                'image_id': test_image.id,
+                'total_faces': len(faces or []),
+                'total_matches': 0,
+                'timings': image_timings,
+                'embedding_cache': 'hit' if cache_hit else 'miss',
+                'result_image_url': None,
+                'error': error
+            }
+            images.append(entry)
+            if error:
+                test_image.status = TestImage.STATUS_FAILED
+                test_image.error = error
+                record_result('failed')
+                continue
+
+            matches = []
+            for face_index, assigned in enumerate(assignments):
+                if assigned is None:
+                    continue
+                student_id, similarity = assigned
+                matches.append({'student_id': student_id, 'similarity': float(similarity)})
+
+                # Best score per student wins across images
+                best = attendance.get(student_id)
+                if best is None or similarity > best['similarity']:
+                    attendance[student_id] = {
+                        'student_id': student_id,
+                        'similarity': float(similarity),
+                        'image_id': test_image.id,
+                        'face_index': face_index
+                    }
+            matches.sort(key=lambda x: x['similarity'], reverse=True)
+
+            entry['total_matches'] = len(matches)
+            entry['result_image_url'] = prepare_result_image(test_image, img, faces, assignments)
+
+            test_image.result = matches
+            test_image.processed = True
+            test_image.status = TestImage.STATUS_DONE
+            record_result('done', faces=len(faces), matches=len(matches), cache_hit=cache_hit)
+
+    if save:
+        with timed(timings, 'db_save'):
+            save_batch_results(test_images)
+
+    total_seconds = time.perf_counter() - start
+    total_faces = sum(entry['total_faces'] for entry in images)
+    attendance = sorted(attendance.values(), key=lambda x: x['similarity'], reverse=True)
+    return {
+        'total_students_in_database': gallery.num_students,
+        'total_images': len(images),
+        'total_faces': total_faces,
+        'total_present': len(attendance),
+        'attendance': attendance,
+        'images': images,
+        'throughput': {
+            'total_seconds': round(total_seconds, 4),
+            'seconds_per_image': round(total_seconds / len(images), 4) if images else None,
+            'images_per_second': round(len(images) / total_seconds, 2) if total_seconds else None,
+            'faces_per_second': round(total_faces / total_seconds, 2) if total_seconds else None,
+            'timings': timings
+        }
+    }
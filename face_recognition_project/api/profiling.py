@@ -0,0 +1,253 @@
+import cProfile
+import glob
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def profile_dir():
+    return getattr(settings, 'PROFILE_DIR', None) or os.path.join(settings.MEDIA_ROOT, 'profiles')
+
+
+def frame_label(code):
+    """Function label of a stack frame: name and where it is defined, shortened to the last two path parts"""
+    path = '/'.join(code.co_filename.replace('\\', '/').split('/')[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame, max_depth=128):
+    """One stack as 'outer;...;inner', the folded format flame graph tools read"""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Trace:
+    """Profile of one request: sampled stacks, or a full cProfile when forced"""
+
+    def __init__(self, name, method='', path='', forced=False, sample_after=0.0):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.forced = forced
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.sample_from = self.started + sample_after
+        self.samples = Counter()
+        self.test_image_ids = []
+        self.profiler = cProfile.Profile() if forced else None
+
+
+class Sampler:
+    """One background thread sampling the stacks of registered requests
+
+    Requests are only sampled once they have run for PROFILE_SAMPLE_AFTER
+    seconds, so fast requests cost a dict insert and delete; the thread
+    sleeps while nothing is registered.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._traces = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def register(self, trace):
+        with self._lock:
+            self._traces[trace.thread_id] = trace
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+            self._wake.set()
+
+    def unregister(self, trace):
+        with self._lock:
+            if self._traces.get(trace.thread_id) is trace:
+                del self._traces[trace.thread_id]
+            if not self._traces:
+                self._wake.clear()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                due = [trace for trace in self._traces.values() if now >= trace.sample_from]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            for trace in due:
+                frame = frames.get(trace.thread_id)
+                if frame is not None:
+                    trace.samples[collapse_stack(frame)] += 1
+            del frames
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    global _sampler
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                _sampler = Sampler(getattr(settings, 'PROFILE_SAMPLE_INTERVAL', 0.01))
+    return _sampler
+
+
+def attach_test_image(test_image_id):
+    """Link the TestImage a profiled request works on to its trace; a no-op outside profiling"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.test_image_ids.append(test_image_id)
+
+
+@contextmanager
+def profile_request(name, method='', path='', force=False):
+    """Profile the block when PROFILE_ENABLED: a trace is kept for slow runs, or always when forced
+
+    Slow runs keep their sampled stacks (after PROFILE_SAMPLE_AFTER), a
+    forced run, e.g. a request with the PROFILE_HEADER, is traced by
+    cProfile from the start. Only the calling thread is profiled; work it
+    hands to pools shows up as waiting.
+    """
+    if not getattr(settings, 'PROFILE_ENABLED', False):
+        yield None
+        return
+
+    trace = Trace(name, method, path, forced=force, sample_after=getattr(settings, 'PROFILE_SAMPLE_AFTER', 0.5))
+    _local.trace = trace
+    if trace.profiler is not None:
+        trace.profiler.enable()
+    else:
+        get_sampler().register(trace)
+    try:
+        yield trace
+    finally:
+        if trace.profiler is not None:
+            trace.profiler.disable()
+        else:
+            get_sampler().unregister(trace)
+        _local.trace = None
+
+        elapsed = time.perf_counter() - trace.started
+        if trace.forced or (elapsed >= getattr(settings, 'PROFILE_SLOW_SECONDS', 5.0) and trace.samples):
+            try:
+                save_trace(trace, elapsed)
+            except Exception as e:
+                logger.error(f"Error saving profile of {name}: {str(e)}")
+
+
+def save_trace(trace, elapsed):
+    """Write a trace and its metadata to the profile directory and note it on the TestImage rows"""
+    from core.models import TestImage
+
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    created_at = datetime.now(timezone.utc)
+    subject = '_'.join(str(i) for i in trace.test_image_ids[:4]) or str(os.getpid())
+    stem = f"{created_at:%Y%m%dT%H%M%S%f}_{re.sub(r'[^A-Za-z0-9_-]', '', trace.name)}_{subject}"
+
+    if trace.profiler is not None:
+        # Binary stats for snakeviz/pstats and a readable summary beside them
+        trace_file = f'{stem}.prof'
+        trace.profiler.dump_stats(os.path.join(directory, trace_file))
+        summary = io.StringIO()
+        pstats.Stats(trace.profiler, stream=summary).sort_stats('cumulative').print_stats(40)
+        with open(os.path.join(directory, f'{stem}.txt'), 'w') as f:
+            f.write(summary.getvalue())
+        kind, samples = 'cprofile', None
+    else:
+        trace_file = f'{stem}.folded'
+        with open(os.path.join(directory, trace_file), 'w') as f:
+            for stack, count in trace.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        kind, samples = 'sampled', sum(trace.samples.values())
+
+    meta = {
+        'name': stem,
+        'kind': kind,
+        'trace_file': trace_file,
+        'action': trace.name,
+        'method': trace.method,
+        'path': trace.path,
+        'seconds': round(elapsed, 4),
+        'samples': samples,
+        'sample_interval': getattr(settings, 'PROFILE_SAMPLE_INTERVAL', 0.01) if samples else None,
+        'test_image_ids': trace.test_image_ids,
+        'created_at': created_at.isoformat(),
+    }
+    tmp_path = os.path.join(directory, f'{stem}.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(directory, f'{stem}.json'))
+
+    for test_image in TestImage.objects.filter(id__in=trace.test_image_ids):
+        test_image.stats = {**(test_image.stats or {}), 'profile': {
+            'name': stem, 'kind': kind, 'trace_file': trace_file, 'seconds': meta['seconds']}}
+        test_image.save(update_fields=['stats'])
+
+    logger.info(f"Saved {kind} profile of {trace.name} ({elapsed:.2f}s) as {trace_file}")
+    prune_traces(directory)
+    return meta
+
+
+def prune_traces(directory=None, keep=None):
+    """Remove the oldest traces beyond PROFILE_MAX_TRACES"""
+    directory = directory or profile_dir()
+    keep = keep if keep is not None else getattr(settings, 'PROFILE_MAX_TRACES', 200)
+    metas = sorted(glob.glob(os.path.join(directory, '*.json')), reverse=True)
+    for meta_path in metas[keep:]:
+        stem = meta_path[:-len('.json')]
+        for path in glob.glob(glob.escape(stem) + '.*'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def trace_url(meta):
+    directory = profile_dir()
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    if os.path.commonpath([os.path.abspath(directory), media_root]) != media_root:
+        return None
+    relative = os.path.relpath(os.path.join(directory, meta['trace_file']), media_root).replace('\\', '/')
+    return f"{settings.MEDIA_URL.rstrip('/')}/{relative}"
+
+
+def list_traces(limit=50, test_image_id=None):
+    """Metadata of the stored traces, newest first"""
+    traces = []
+    # Names start with the UTC timestamp, so name order is age order
+    for meta_path in sorted(glob.glob(os.path.join(profile_dir(), '*.json')), reverse=True):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if test_image_id is not None and test_image_id not in meta.get('test_image_ids', []):
+            continue
+        traces.append({**meta, 'url': trace_url(meta)})
+        if len(traces) >= limit:
+            break
+    return traces
@@ -0,0 +1,131 @@
+import logging
+import os
+
+import numpy as np
+from django.conf import settings
+
+from .matching import StackedRows
+from .storage import CODES_SUFFIX, SCALES_SUFFIX, model_stem, save_array
+
+logger = logging.getLogger(__name__)
+
+MATCH_DTYPES = ('float32', 'float16', 'int8')
+
+
+class QuantizedMatrix:
+    """Compact copy of the gallery rows that full scans run against
+
+    'float16' stores half the bytes of float32; 'int8' stores each row as
+    int8 codes times one float32 scale, a quarter of the size. The gain is
+    memory, not speed: only these codes are read by every scan, while the
+    memory-mapped gallery rows are read just for the shortlist that
+    matching.rerank re-scores. NumPy has no float16/int8 matrix multiply,
+    so a scan is somewhat slower than a float32 one (see bench_quantization).
+    """
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def dtype(self):
+        return str(self.codes.dtype)
+
+    @property
+    def nbytes(self):
+        return int(self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def encode(cls, matrix, dtype):
+        """Quantize rows; int8 uses a symmetric per-row scale"""
+        if dtype == 'float16':
+            # float16 storage is used as it is, a mapped file stays mapped
+            return cls(np.asarray(matrix, dtype=np.float16).reshape(len(matrix), -1))
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(len(matrix), -1)
+        if dtype != 'int8':
+            raise ValueError(f"Unknown match dtype {dtype!r}, expected one of {', '.join(MATCH_DTYPES)}")
+        scales = np.abs(matrix).max(axis=1) / 127.0 if matrix.size else np.zeros(len(matrix), dtype=np.float32)
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(matrix / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+        return cls(codes, scales.astype(np.float32))
+
+    def append(self, matrix):
+        """New encoding with rows added at the end, as delta segments do"""
+        added = QuantizedMatrix.encode(matrix, self.dtype)
+        # Scales are one float per row; the codes of the base stay where they are mapped
+        scales = np.concatenate([self.scales, added.scales]) if self.scales is not None else None
+        return QuantizedMatrix(StackedRows.append(self.codes, added.codes), scales)
+
+    def scores(self, probes, chunk_size=4096):
+        """Approximate (faces x rows) similarities
+
+        Rows are widened into one reused float32 buffer a chunk at a time,
+        so only that chunk is ever held at full precision. The widening is
+        extra work on top of the float32 multiply.
+        """
+        scores = np.empty((len(probes), len(self.codes)), dtype=np.float32)
+        buffer = np.empty((min(chunk_size, len(self.codes)), self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.codes), chunk_size):
+            block = self.codes[start:start + chunk_size]
+            widened = buffer[:len(block)]
+            np.copyto(widened, block, casting='unsafe')
+            np.matmul(probes, widened.T, out=scores[:, start:start + len(block)])
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def save(self, model_path):
+        stem = model_stem(model_path)
+        # Scales first: a visible codes file means its scales are complete too
+        if self.scales is not None:
+            save_array(stem + SCALES_SUFFIX, self.scales)
+        save_array(stem + CODES_SUFFIX, self.codes)
+
+    @classmethod
+    def load(cls, model_path, mmap=True):
+        stem = model_stem(model_path)
+        codes = np.load(stem + CODES_SUFFIX, mmap_mode='r' if mmap else None, allow_pickle=False)
+        scales = None
+        if codes.dtype == np.int8:
+            scales = np.load(stem + SCALES_SUFFIX, allow_pickle=False)
+        return cls(codes, scales)
+
+
+def match_dtype():
+    dtype = getattr(settings, 'GALLERY_MATCH_DTYPE', 'float32')
+    if dtype not in MATCH_DTYPES:
+        raise ValueError(f"Unknown GALLERY_MATCH_DTYPE {dtype!r}, expected one of {', '.join(MATCH_DTYPES)}")
+    return dtype
+
+
+def encode_for_matching(matrix):
+    """Encoding of a gallery matrix for GALLERY_MATCH_DTYPE, or None for exact float32 scans"""
+    dtype = match_dtype()
+    if dtype == 'float32' or matrix.ndim != 2 or not matrix.size:
+        return None
+    return QuantizedMatrix.encode(matrix, dtype)
+
+
+def save_quantized_for_model(model_path, matrix):
+    """Write the match encoding next to a model file so workers can memory-map it"""
+    quantized = encode_for_matching(matrix)
+    if quantized is not None:
+        quantized.save(model_path)
+
+
+def load_quantized_for_model(model_path, matrix):
+    """Memory-map the match encoding of a model, encoding in memory when the sidecar is missing or stale"""
+    dtype = match_dtype()
+    if dtype == 'float32':
+        return None
+    if os.path.exists(model_stem(model_path) + CODES_SUFFIX):
+        try:
+            quantized = QuantizedMatrix.load(model_path, mmap=getattr(settings, 'GALLERY_MMAP', True))
+            if quantized.dtype == dtype and len(quantized) == len(matrix):
+                return quantized
+        except Exception as e:
+            logger.error(f"Error loading match encoding of {model_path}, re-encoding: {str(e)}")
+    return encode_for_matching(matrix)
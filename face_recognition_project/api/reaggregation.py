@@ -0,0 +1,252 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from core.models import GlobalModel, Student
+from .enrollment import expected_dim
+from .matching import normalize_rows
+from .model_store import write_snapshot_arrays
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_dir():
+    return (getattr(settings, 'REAGGREGATE_CHECKPOINT_DIR', None)
+            or os.path.join(settings.MEDIA_ROOT, 'reaggregate_checkpoint'))
+
+
+def load_embedding_file(name, dim):
+    """Normalized (templates x dim) rows of one per-student .npy file"""
+    path = os.path.join(settings.MEDIA_ROOT, str(name).replace('\\', '/'))
+    embedding = np.load(path, allow_pickle=False)
+    if embedding.dtype.kind not in 'fiu' or embedding.size == 0 or embedding.shape[-1] != dim:
+        raise ValueError(f"expected {dim} values per template, got shape {list(embedding.shape)}")
+    rows = np.array(embedding.reshape(-1, dim), dtype=np.float32)
+    if not np.isfinite(rows).all():
+        raise ValueError("contains NaN or infinite values")
+    return normalize_rows(rows)
+
+
+class Reaggregation:
+    """Rebuild the global model from every student's embedding file
+
+    Student rows are streamed in primary key order and processed in
+    chunks; within a chunk files are loaded by a bounded thread pool and
+    copied straight into one preallocated matrix. Each finished chunk's
+    rows and last primary key are appended to the checkpoint directory as
+    one segment file, so an interrupted rebuild can resume where it stopped
+    instead of reloading everything. The checkpoint is stamped with the
+    start time and latest GlobalModel id of its run and only resumed while
+    no covered Student row has changed or gone since, see _restore.
+    `progress(report)` is called after each chunk.
+    """
+
+    def __init__(self, workers=None, chunk_size=None, checkpoint=None, progress=None):
+        self.workers = workers or getattr(settings, 'REAGGREGATE_WORKERS', 8)
+        self.chunk_size = chunk_size or getattr(settings, 'REAGGREGATE_CHUNK_SIZE', 1000)
+        self.checkpoint = checkpoint or checkpoint_dir()
+        self.progress = progress
+
+        self.dim = None
+        self.ids = None
+        self.matrix = None
+        self.rows = 0
+        self.last_pk = 0
+        self.failed = []
+        self.total = 0
+        self.done = 0
+        self.resumed_from = 0
+        self.started_at = None
+        self._lock = threading.Lock()
+
+    def _reserve(self, count):
+        """Grow the output arrays when template sets need more rows than there are students (lock held)"""
+        if self.rows + count <= len(self.matrix):
+            return
+        capacity = max(self.rows + count, 2 * len(self.matrix))
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        matrix[:self.rows] = self.matrix[:self.rows]
+        ids = np.empty(capacity, dtype=self.ids.dtype)
+        ids[:self.rows] = self.ids[:self.rows]
+        self.matrix, self.ids = matrix, ids
+
+    def _load(self, student_id, embedding_file):
+        try:
+            rows = load_embedding_file(embedding_file, self.dim)
+        except Exception as e:
+            logger.error(f"Error loading embedding for student {student_id}: {str(e)}")
+            with self._lock:
+                self.failed.append(student_id)
+            return
+        with self._lock:
+            # A student's templates stay contiguous, so the gallery needs no regrouping
+            self._reserve(len(rows))
+            self.matrix[self.rows:self.rows + len(rows)] = rows
+            self.ids[self.rows:self.rows + len(rows)] = student_id
+            self.rows += len(rows)
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.checkpoint, 'segment_*.npz')))
+
+    def _stamp_path(self):
+        return os.path.join(self.checkpoint, 'checkpoint.json')
+
+    def _clear_checkpoint(self):
+        for path in self._segments():
+            os.remove(path)
+        if os.path.exists(self._stamp_path()):
+            os.remove(self._stamp_path())
+
+    def _write_stamp(self):
+        """Record when this run started and from which model, before its first segment"""
+        os.makedirs(self.checkpoint, exist_ok=True)
+        stamp = {
+            'started_at': self.started_at.isoformat(),
+            'model_id': GlobalModel.objects.aggregate(latest=Max('id'))['latest'],
+            'dim': self.dim,
+        }
+        tmp_path = f"{self._stamp_path()}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(stamp, f)
+        os.replace(tmp_path, self._stamp_path())
+
+    def _stale_reason(self, stamp, covered):
+        """Why a checkpoint may not be resumed, or None when it still matches the Student rows"""
+        started_at = datetime.fromisoformat(stamp['started_at'])
+        max_age = getattr(settings, 'REAGGREGATE_CHECKPOINT_MAX_AGE', 24 * 3600)
+        if timezone.now() - started_at > timedelta(seconds=max_age):
+            return f"started {started_at.isoformat()}, more than {max_age}s ago"
+        if stamp.get('dim') != self.dim:
+            return f"rows of dim {stamp.get('dim')}, expected {self.dim}"
+        latest_model = GlobalModel.objects.aggregate(latest=Max('id'))['latest']
+        if stamp.get('model_id') is not None and (latest_model or 0) < stamp['model_id']:
+            return f"model {stamp['model_id']} it started from no longer exists"
+        students = Student.objects.filter(id__lte=self.last_pk)
+        if students.filter(updated_at__gt=started_at).exists():
+            return "students it covers were enrolled again since"
+        if students.count() != covered:
+            return "students it covers were removed since"
+        return None
+
+    def _restore(self):
+        """Pick up rows from an interrupted run; returns False when there is nothing to resume"""
+        segments = self._segments()
+        if not segments:
+            return False
+        covered = set()
+        try:
+            with open(self._stamp_path()) as f:
+                stamp = json.load(f)
+            for path in segments:
+                with np.load(path, allow_pickle=False) as segment:
+                    ids, matrix = segment['ids'], segment['matrix']
+                    if len(matrix) and matrix.shape[1] != self.dim:
+                        raise ValueError(f"rows of dim {matrix.shape[1]}, expected {self.dim}")
+                    self._reserve(len(matrix))
+                    self.matrix[self.rows:self.rows + len(matrix)] = matrix
+                    self.ids[self.rows:self.rows + len(ids)] = ids
+                    self.rows += len(matrix)
+                    self.failed.extend(segment['failed'].tolist())
+                    self.last_pk = int(segment['last_pk'])
+                    covered.update(ids.tolist())
+            covered.update(self.failed)
+            reason = self._stale_reason(stamp, len(covered))
+            if reason:
+                raise ValueError(reason)
+        except Exception as e:
+            logger.error(f"Ignoring unusable reaggregation checkpoint in {self.checkpoint}: {str(e)}")
+            self.rows, self.last_pk, self.failed = 0, 0, []
+            return False
+
+        # Rows changed after the original start would invalidate the resumed ones, so keep its stamp
+        self.started_at = datetime.fromisoformat(stamp['started_at'])
+        self.resumed_from = Student.objects.filter(id__lte=self.last_pk).count()
+        self.done = self.resumed_from
+        return True
+
+    def _save_segment(self, first_row, failed_before):
+        """Append the rows of the chunk just finished to the checkpoint"""
+        os.makedirs(self.checkpoint, exist_ok=True)
+        path = os.path.join(self.checkpoint, f"segment_{self.last_pk:012d}.npz")
+        tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, ids=self.ids[first_row:self.rows], matrix=self.matrix[first_row:self.rows],
+                 last_pk=np.int64(self.last_pk), failed=np.array(self.failed[failed_before:], dtype=str))
+        os.replace(tmp_path, path)
+
+    def report(self, started):
+        elapsed = time.perf_counter() - started
+        loaded_now = self.done - self.resumed_from
+        rate = loaded_now / elapsed if elapsed > 0 else 0.0
+        return {
+            'total': self.total,
+            'done': self.done,
+            'failed': len(self.failed),
+            'rows': self.rows,
+            'resumed_from': self.resumed_from,
+            'elapsed_seconds': round(elapsed, 3),
+            'students_per_second': round(rate, 1),
+            'eta_seconds': round((self.total - self.done) / rate, 1) if rate > 0 else None,
+        }
+
+    def run(self, resume=False):
+        """Load every student and write a new snapshot; returns (global_model, report)
+
+        With resume a valid checkpoint of an interrupted run is continued.
+        global_model is None when no embedding could be loaded.
+        """
+        started = time.perf_counter()
+        self.dim = expected_dim()
+        self.total = Student.objects.count()
+        self.matrix = np.empty((self.total, self.dim), dtype=np.float32)
+        self.ids = np.empty(self.total, dtype=f"<U{Student._meta.get_field('student_id').max_length}")
+
+        if not (resume and self._restore()):
+            self._clear_checkpoint()
+            self.started_at = timezone.now()
+            self._write_stamp()
+
+        students = (Student.objects.filter(id__gt=self.last_pk).order_by('id')
+                    .values_list('id', 'student_id', 'embedding_file')
+                    .iterator(chunk_size=self.chunk_size))
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='reaggregate') as executor:
+            chunk = []
+            for row in students:
+                chunk.append(row)
+                if len(chunk) == self.chunk_size:
+                    self._run_chunk(executor, chunk, started)
+                    chunk = []
+            if chunk:
+                self._run_chunk(executor, chunk, started)
+
+        report = self.report(started)
+        if not self.rows:
+            return None, report
+
+        global_model = write_snapshot_arrays(self.ids[:self.rows], self.matrix[:self.rows],
+                                             num_students=self.done - len(self.failed))
+        self._clear_checkpoint()
+        report = self.report(started)
+        logger.info(f"Reaggregated {report['done'] - report['failed']} of {report['total']} students "
+                    f"into model v{global_model.version} in {report['elapsed_seconds']}s "
+                    f"({report['failed']} failed, {report['resumed_from']} from checkpoint)")
+        return global_model, report
+
+    def _run_chunk(self, executor, chunk, started):
+        first_row, failed_before = self.rows, len(self.failed)
+        # Bounded: at most one chunk of files is in flight
+        list(executor.map(lambda row: self._load(row[1], row[2]), chunk))
+        self.last_pk = chunk[-1][0]
+        self.done += len(chunk)
+        self._save_segment(first_row, failed_before)
+        if self.progress is not None:
+            self.progress(self.report(started))
@@ -0,0 +1,204 @@
+import logging
+import os
+import threading
+
+import cv2
+from django.conf import settings
+from django.utils import timezone
+
+from .detection import DetectionPlan, decode_image, image_size
+from .matching import SIMILARITY_THRESHOLD
+from .metrics import timed
+from .uploads import PERSIST_ASYNC, PERSIST_NONE, persist_mode
+
+logger = logging.getLogger(__name__)
+
+RENDER_EAGER = 'eager'
+RENDER_LAZY = 'lazy'
+RENDER_OFF = 'off'
+
+
+class ResultImagePending(Exception):
+    """The original is still being written in the background, so the result cannot be drawn yet"""
+
+
+def render_mode():
+    """RESULT_IMAGE_MODE, rendering eagerly when no original is kept to render from later"""
+    mode = getattr(settings, 'RESULT_IMAGE_MODE', RENDER_LAZY)
+    if mode not in (RENDER_EAGER, RENDER_LAZY, RENDER_OFF):
+        raise ValueError(f"Unknown RESULT_IMAGE_MODE {mode!r}")
+    if mode == RENDER_LAZY and persist_mode() == PERSIST_NONE:
+        return RENDER_EAGER
+    return mode
+
+
+def result_filename_for(test_image):
+    # Rows may share an upload file, so the result name includes the row ID
+    stem = os.path.splitext(os.path.basename(test_image.image.name or 'upload.jpg'))[0]
+    return f"result_{test_image.id}_{stem}.jpg"
+
+
+def result_image_url(test_image):
+    """Where the client fetches the annotated image: the file once rendered, else the rendering endpoint"""
+    if test_image.result_image:
+        return f"{settings.MEDIA_URL.rstrip('/')}/{test_image.result_image.name}"
+    if (test_image.stats or {}).get('annotations') is not None:
+        return f'/api/aggregation/{test_image.id}/result_image/'
+    return None
+
+
+def annotations_for(faces, assignments):
+    """Boxes in original image coordinates and their labels, kept on the row for later rendering"""
+    annotations = []
+    for face, assigned in zip(faces, assignments):
+        annotations.append({
+            'bbox': [int(v) for v in face['bbox']],
+            'student_id': assigned[0] if assigned else None,
+            'similarity': float(assigned[1]) if assigned else None,
+        })
+    return annotations
+
+
+def image_box(face):
+    """Box of a face in decoded image coordinates"""
+    return face['image_bbox'] if 'image_bbox' in face else face['bbox']
+
+
+def draw_face_boxes(image, faces, match_results):
+    """Draw boxes and labels on a copy of an RGB image
+
+    `faces` carry their box in image coordinates as 'image_bbox' (or
+    'bbox'), `match_results` the sorted (student_id, similarity) pairs per
+    face. Line width follows the image size so labels stay legible.
+    """
+    img = image.copy()
+    thickness = max(2, int(round(max(img.shape[:2]) / 800)))
+
+    for face, matches in zip(faces, match_results):
+        x1, y1, x2, y2 = [int(v) for v in image_box(face)]
+
+        # Matches are sorted, best first
+        if matches and matches[0][1] > SIMILARITY_THRESHOLD:
+            student_id, similarity = matches[0]
+            # Green box for match
+            color = (0, 255, 0)
+            text = f"Student {student_id} ({similarity:.2f})"
+        else:
+            # Red box for no or low-similarity matches
+            color = (0, 0, 255)
+            text = "No match"
+
+        # Draw box and label
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, thickness)
+        cv2.putText(img, text, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.3 * thickness, color, thickness)
+
+    return img
+
+
+def fit_to_max_side(img, max_side=None):
+    """Downscale an image so its long side is at most RESULT_IMAGE_MAX_SIDE; returns (img, factor)"""
+    max_side = max_side or getattr(settings, 'RESULT_IMAGE_MAX_SIDE', 1600)
+    long_side = max(img.shape[:2])
+    if long_side <= max_side:
+        return img, 1.0
+    factor = max_side / long_side
+    size = (int(round(img.shape[1] * factor)), int(round(img.shape[0] * factor)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA), factor
+
+
+def write_jpeg(img, result_filename):
+    """Encode an RGB image as JPEG under test_results, renamed into place once complete"""
+    path = os.path.join(settings.MEDIA_ROOT, 'test_results', result_filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    quality = getattr(settings, 'RESULT_IMAGE_JPEG_QUALITY', 85)
+    ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError(f"Could not encode {result_filename}")
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp_path, path)
+    return f'test_results/{result_filename}'
+
+
+def save_result_image(img, faces, assignments, result_filename):
+    """Draw the assignments onto a decoded image and write it at the configured size; returns the media name"""
+    img, factor = fit_to_max_side(img)
+    faces = [{'image_bbox': [v * factor for v in image_box(face)]} for face in faces]
+    match_results = [[assigned] if assigned else [] for assigned in assignments]
+    return write_jpeg(draw_face_boxes(img, faces, match_results), result_filename)
+
+
+def prepare_result_image(test_image, img, faces, assignments):
+    """Record what a recognition run needs to draw and, in eager mode, render it now
+
+    Sets the row's result_image and stats['annotations'] without saving
+    and returns the result_image_url for the response.
+    """
+    mode = render_mode()
+    if mode == RENDER_OFF:
+        return None
+
+    test_image.stats = {**(test_image.stats or {}), 'annotations': annotations_for(faces, assignments)}
+    if mode == RENDER_EAGER:
+        test_image.result_image = save_result_image(img, faces, assignments, result_filename_for(test_image))
+    else:
+        # A re-run must not keep serving the previous rendering
+        test_image.result_image = ''
+    return result_image_url(test_image)
+
+
+def upload_pending(test_image):
+    """Whether a row without a stored original may still get one from the 'async' upload writer"""
+    if persist_mode() != PERSIST_ASYNC:
+        return False
+    age = (timezone.now() - test_image.created_at).total_seconds()
+    return age < getattr(settings, 'UPLOAD_PERSIST_PENDING_SECONDS', 60)
+
+
+def render_result_image(test_image):
+    """Render the annotated result of a processed TestImage once and return the file's absolute path
+
+    The original is decoded straight at (close to) the display size using
+    JPEG DCT scaling, so a 12 MP photo never decodes at full resolution.
+    Raises ResultImagePending while an 'async' upload write may still be
+    running, and FileNotFoundError when the row has no result to draw or
+    its original is not stored (UPLOAD_PERSIST).
+    """
+    if test_image.result_image and os.path.exists(test_image.result_image.path):
+        return test_image.result_image.path
+
+    annotations = (test_image.stats or {}).get('annotations')
+    if annotations is None:
+        raise FileNotFoundError(f"Test image {test_image.id} has no result image")
+    if not test_image.image and upload_pending(test_image):
+        raise ResultImagePending(f"Original of test image {test_image.id} is not stored yet")
+    if not test_image.image or not os.path.exists(test_image.image.path):
+        raise FileNotFoundError(f"Original of test image {test_image.id} is not stored")
+
+    source = test_image.image.path
+    size = image_size(source)
+    if size is None:
+        raise ValueError(f"Could not read {test_image.image.name}")
+    max_side = getattr(settings, 'RESULT_IMAGE_MAX_SIDE', 1600)
+    reduction = 1
+    for factor in (8, 4, 2):
+        if max(size) / factor >= max_side:
+            reduction = factor
+            break
+    img, scale = decode_image(source, DetectionPlan(*size, reduction=reduction))
+    if img is None:
+        raise ValueError(f"Could not decode {test_image.image.name}")
+    img, factor = fit_to_max_side(img, max_side)
+    scale /= factor
+
+    faces = [{'image_bbox': [v / scale for v in annotation['bbox']]} for annotation in annotations]
+    match_results = [[(annotation['student_id'], annotation['similarity'])] if annotation['student_id'] else []
+                     for annotation in annotations]
+    with timed(None, 'drawing'):
+        name = write_jpeg(draw_face_boxes(img, faces, match_results), result_filename_for(test_image))
+
+    test_image.result_image = name
+    type(test_image).objects.filter(id=test_image.id).update(result_image=name)
+    return test_image.result_image.path
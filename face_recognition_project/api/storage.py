@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .matching import normalize_rows
+
+GALLERY_FORMAT = 'gallery-v1'
+HEADER_SUFFIX = '.gallery.json'
+VECTORS_SUFFIX = '.vectors.npy'
+IDS_SUFFIX = '.ids.npy'
+CODES_SUFFIX = '.codes.npy'
+SCALES_SUFFIX = '.scales.npy'
+
+
+def model_stem(path):
+    """Path of a model file without its format suffix, shared by all its sidecars"""
+    for suffix in (HEADER_SUFFIX, '.npz'):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return os.path.splitext(path)[0]
+
+
+def is_gallery_header(path):
+    return str(path).endswith(HEADER_SUFFIX)
+
+
+def matrix_checksum(matrix):
+    """SHA-256 over the raw bytes of a C-contiguous matrix"""
+    return 'sha256:' + hashlib.sha256(memoryview(np.ascontiguousarray(matrix)).cast('B')).hexdigest()
+
+
+def save_array(path, array):
+    """np.save under a temporary name, then rename, so readers never see a partial file"""
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, array, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+def write_gallery(stem, ids, matrix, dtype='float32', normalized=True):
+    """Write a gallery as a raw .npy matrix, an .npy ID table and a JSON header
+
+    Nothing is pickled: both arrays load with allow_pickle=False and the
+    matrix can be memory-mapped, so every worker process shares one
+    page-cached copy. Every file is renamed into place once complete and
+    the header goes last, so a visible header means the gallery is whole.
+    Returns the header path, which is what GlobalModel.model_file points at.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=dtype)
+    ids = np.asarray(ids, dtype=str)
+    if matrix.ndim != 2 or len(matrix) != len(ids):
+        raise ValueError(f"Expected one row per ID, got matrix {matrix.shape} for {len(ids)} IDs")
+
+    save_array(stem + VECTORS_SUFFIX, matrix)
+    save_array(stem + IDS_SUFFIX, ids)
+
+    header = {
+        'format': GALLERY_FORMAT,
+        'count': int(matrix.shape[0]),
+        'dim': int(matrix.shape[1]),
+        'dtype': str(matrix.dtype),
+        'normalized': bool(normalized),
+        'checksum': matrix_checksum(matrix),
+        'vectors': os.path.basename(stem + VECTORS_SUFFIX),
+        'ids': os.path.basename(stem + IDS_SUFFIX),
+    }
+    header_path = stem + HEADER_SUFFIX
+    tmp_path = f"{header_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp_path, header_path)
+    return header_path
+
+
+def model_files(path):
+    """Every file on disk that belongs to the model at `path`, sidecars included"""
+    stem = model_stem(path)
+    candidates = [stem + suffix for suffix in (HEADER_SUFFIX, VECTORS_SUFFIX, IDS_SUFFIX, '.npz', '.ivf.npz',
+                                               CODES_SUFFIX, SCALES_SUFFIX)]
+    return [candidate for candidate in candidates if os.path.exists(candidate)]
+
+
+def read_gallery_header(header_path):
+    with open(header_path) as f:
+        header = json.load(f)
+    if header.get('format') != GALLERY_FORMAT:
+        raise ValueError(f"Unsupported gallery format {header.get('format')!r} in {header_path}")
+    return header
+
+
+def read_gallery(header_path, mmap=True, verify=False):
+    """Open a gallery written by write_gallery, memory-mapping the matrix by default"""
+    header = read_gallery_header(header_path)
+    directory = os.path.dirname(header_path)
+
+    matrix = np.load(os.path.join(directory, header['vectors']), mmap_mode='r' if mmap else None,
+                     allow_pickle=False)
+    ids = np.load(os.path.join(directory, header['ids']), allow_pickle=False)
+
+    expected = (header['count'], header['dim'])
+    if matrix.shape != expected or len(ids) != header['count']:
+        raise ValueError(f"Gallery {header_path} is inconsistent: header says {expected}, "
+                         f"matrix is {matrix.shape} with {len(ids)} IDs")
+    if verify and matrix_checksum(matrix) != header['checksum']:
+        raise ValueError(f"Checksum mismatch for gallery {header_path}")
+
+    if not header['normalized']:
+        matrix = normalize_rows(np.array(matrix, dtype=np.float32))
+    return ids, matrix, header
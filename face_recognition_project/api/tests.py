@@ -1,3 +1,814 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from core.models import GlobalModel, GlobalModelDelta, Student, TestImage
+from . import gallery, model_store, uploads
+from .enrollment import enroll, read_archive, validate_embeddings
+from .matching import StackedRows, assign_faces, hungarian, linear_sum_assignment, normalize_rows, pool_templates
+from .inference import InferenceBusy, InferencePool
+from .inference_server import InferenceServerError, RemoteEngine, attach_shared_memory
+from .jobs import claim_next, enqueue, requeue_stale, run_job
+from .metrics import IMAGES, Registry, record_result
+from .model_store import collect_garbage, compact, leased_model_ids, update_model
+from .pipeline import GlobalModelTester, RecognitionError, save_upload
+from .quantization import QuantizedMatrix, load_quantized_for_model, save_quantized_for_model
+from .reaggregation import Reaggregation
+from .rendering import draw_face_boxes
+from .storage import write_gallery
+
+
+class MediaTestCase(TestCase):
+    """Runs against a scratch MEDIA_ROOT and a fresh process gallery cache"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root, MODEL_RETENTION_AUTO=False)
+        media.enable()
+        self.addCleanup(media.disable)
+        gallery._cache = None
+        self.addCleanup(setattr, gallery, '_cache', None)
+
+
+class HungarianTests(SimpleTestCase):
+    @unittest.skipIf(linear_sum_assignment is None, 'scipy is not installed')
+    def test_matches_scipy(self):
+        rng = np.random.default_rng(0)
+        for shape in [(1, 1), (3, 3), (4, 7), (7, 4), (12, 12), (5, 30)]:
+            for _ in range(20):
+                cost = rng.standard_normal(shape)
+                rows, cols = hungarian(cost)
+                expected_rows, expected_cols = linear_sum_assignment(cost)
+                self.assertEqual(len(rows), min(shape))
+                np.testing.assert_array_equal(rows, np.sort(rows))
+                self.assertAlmostEqual(cost[rows, cols].sum(), cost[expected_rows, expected_cols].sum())
+
+    @unittest.skipIf(linear_sum_assignment is None, 'scipy is not installed')
+    def test_ties_match_scipy_cost(self):
+        cost = np.random.default_rng(1).integers(0, 3, size=(8, 10)).astype(float)
+        rows, cols = hungarian(cost)
+        expected_rows, expected_cols = linear_sum_assignment(cost)
+        self.assertEqual(cost[rows, cols].sum(), cost[expected_rows, expected_cols].sum())
+        self.assertEqual(len(set(cols.tolist())), len(cols))
+
+    def test_empty(self):
+        rows, cols = hungarian(np.empty((0, 4)))
+        self.assertEqual(len(rows), 0)
+        self.assertEqual(len(cols), 0)
+
+
+class AssignFacesTests(SimpleTestCase):
+    def gallery(self, scores):
+        return SimpleNamespace(student_scores=lambda probes, students: scores[:, students])
+
+    def test_global_optimum_beats_greedy(self):
+        # Greedy would give face 0 student 0 and leave face 1 below the threshold
+        scores = np.array([[0.9, 0.8], [0.85, 0.3]], dtype=np.float32)
+        students, matched = assign_faces(np.zeros((2, 4)), self.gallery(scores), np.array([[0, 1], [0, 1]]),
+                                         threshold=0.5)
+        np.testing.assert_array_equal(students, [1, 0])
+        np.testing.assert_allclose(matched, [0.8, 0.85])
+
+    def test_below_threshold_stays_unassigned(self):
+        scores = np.array([[0.9, 0.2], [0.7, 0.4]], dtype=np.float32)
+        students, matched = assign_faces(np.zeros((2, 4)), self.gallery(scores), np.array([[0, 1], [0, 1]]),
+                                         threshold=0.5)
+        np.testing.assert_array_equal(students, [0, -1])
+        self.assertEqual(matched[1], -np.inf)
+
+    def test_no_candidates(self):
+        students, _ = assign_faces(np.zeros((2, 4)), self.gallery(np.zeros((2, 0))), np.full((2, 3), -1))
+        np.testing.assert_array_equal(students, [-1, -1])
+
+
+class PoolTemplatesTests(SimpleTestCase):
+    starts = np.array([0, 2, 3])
+    counts = np.array([2, 1, 3], dtype=np.float32)
+    scores = np.array([[0.1, 0.5, 0.2, 0.9, 0.3, 0.0],
+                       [0.4, 0.4, 0.8, -0.3, 0.6, 0.3]], dtype=np.float32)
+
+    def test_max(self):
+        pooled = pool_templates(self.scores, self.starts, self.counts, 'max')
+        np.testing.assert_allclose(pooled, [[0.5, 0.2, 0.9], [0.4, 0.8, 0.6]])
+
+    def test_mean(self):
+        pooled = pool_templates(self.scores, self.starts, self.counts, 'mean')
+        self.assertEqual(pooled.dtype, np.float32)
+        np.testing.assert_allclose(pooled, [[0.3, 0.2, 0.4], [0.4, 0.8, 0.2]], atol=1e-6)
+
+    def test_no_students(self):
+        self.assertEqual(pool_templates(self.scores, np.array([], dtype=np.intp)).shape, (2, 0))
+
+    def test_unknown_pooling(self):
+        with self.assertRaises(ValueError):
+            pool_templates(self.scores, self.starts, self.counts, 'median')
+
+
+class ValidateEmbeddingsTests(SimpleTestCase):
+    dim = 8
+
+    def reasons(self, ids, vectors):
+        accepted, _, rejected = validate_embeddings(ids, vectors, self.dim)
+        return accepted, {entry['student_id']: entry['reason'] for entry in rejected}
+
+    def test_accepts_and_normalizes(self):
+        vectors = [np.arange(1, 9, dtype=np.float32), np.ones((3, self.dim), dtype=np.float64)]
+        accepted, templates, rejected = validate_embeddings(['s1', 's2'], vectors, self.dim)
+        self.assertEqual(accepted, ['s1', 's2'])
+        self.assertEqual(rejected, [])
+        self.assertEqual([block.shape for block in templates], [(1, self.dim), (3, self.dim)])
+        for block in templates:
+            self.assertEqual(block.dtype, np.float32)
+            np.testing.assert_allclose(np.linalg.norm(block, axis=1), 1.0, rtol=1e-6)
+
+    def test_rejections(self):
+        good = np.ones(self.dim, dtype=np.float32)
+        nan = good.copy()
+        nan[3] = np.nan
+        cases = {
+            'unreadable': ValueError('not a .npy file'),
+            'a/b': good,
+            's_embedding': good,
+            'dup': good,
+            'strings': np.array(['x'] * self.dim),
+            'short': np.ones(self.dim - 1, dtype=np.float32),
+            'cube': np.ones((2, 2, self.dim), dtype=np.float32),
+            'nan': nan,
+            'inf': np.full(self.dim, np.inf, dtype=np.float32),
+            'zero': np.zeros((2, self.dim), dtype=np.float32),
+            'ok': good,
+        }
+        ids = list(cases) + ['dup', '']
+        accepted, reasons = self.reasons(ids, list(cases.values()) + [good, good])
+
+        self.assertEqual(accepted, ['ok'])
+        self.assertTrue(reasons['unreadable'].startswith('unreadable'))
+        self.assertIn('path separators', reasons['a/b'])
+        self.assertIn('_embedding', reasons['s_embedding'])
+        self.assertEqual(reasons['dup'], 'duplicate student_id')
+        self.assertIn('not numeric', reasons['strings'])
+        self.assertIn('values per template', reasons['short'])
+        self.assertIn('values per template', reasons['cube'])
+        self.assertEqual(reasons['nan'], 'contains NaN or infinite values')
+        self.assertEqual(reasons['inf'], 'contains NaN or infinite values')
+        self.assertEqual(reasons['zero'], 'zero vector')
+        self.assertIn('characters', reasons[''])
+
+    def test_ragged_lists_are_unreadable(self):
+        good = [1.0] * self.dim
+        accepted, reasons = self.reasons(['ragged', 'ok'], [[good, good[:-1]], good])
+        self.assertEqual(accepted, ['ok'])
+        self.assertTrue(reasons['ragged'].startswith('unreadable'))
+
+    def test_one_bad_template_rejects_the_student(self):
+        templates = np.ones((3, self.dim), dtype=np.float32)
+        templates[1] = 0
+        accepted, reasons = self.reasons(['s1'], [templates])
+        self.assertEqual(accepted, [])
+        self.assertEqual(reasons['s1'], 'zero vector')
+
+    @override_settings(TEMPLATES_MAX_PER_STUDENT=2)
+    def test_too_many_templates(self):
+        accepted, reasons = self.reasons(['s1'], [np.ones((3, self.dim), dtype=np.float32)])
+        self.assertEqual(accepted, [])
+        self.assertIn('at most 2 templates', reasons['s1'])
+
+
+@override_settings(ENROLLMENT_EMBEDDING_DIM=8)
+class EnrollBulkTests(MediaTestCase):
+    def ndjson(self, records):
+        return '\n'.join(json.dumps(record) for record in records).encode()
+
+    def test_ndjson_with_a_ragged_line(self):
+        data = self.ndjson([
+            {'student_id': 's1', 'embedding': [1.0] * 8},
+            {'student_id': 's2', 'embedding': [[1.0] * 8, [1.0] * 7]},
+            {'student_id': 's3', 'embedding': [0.5] * 8},
+        ])
+        ids, vectors = read_archive('students.ndjson', data)
+        self.assertEqual(ids, ['s1', 's2', 's3'])
+
+        response = self.client.post('/api/aggregation/enroll_bulk/',
+                                    {'archive': SimpleUploadedFile('students.ndjson', data)})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()['data']
+        self.assertEqual(body['accepted'], 2)
+        self.assertEqual([entry['student_id'] for entry in body['rejected']], ['s2'])
+        self.assertTrue(body['rejected'][0]['reason'].startswith('unreadable'))
+        self.assertEqual(sorted(Student.objects.values_list('student_id', flat=True)), ['s1', 's3'])
+
+    def test_strict_rejects_the_archive(self):
+        data = self.ndjson([{'student_id': 's1', 'embedding': [1.0] * 8}, {'student_id': 's2', 'embedding': 'x'}])
+        response = self.client.post('/api/aggregation/enroll_bulk/',
+                                    {'archive': SimpleUploadedFile('students.ndjson', data), 'strict': 'true'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Student.objects.exists())
+
+
+class EnrollFilesTests(MediaTestCase):
+    def enroll(self, value):
+        with self.captureOnCommitCallbacks(execute=True):
+            enroll(['s1'], [np.full((1, 8), value, dtype=np.float32)])
+
+    def stored(self):
+        directory = os.path.join(self.media_root, 'embeddings')
+        self.assertEqual(os.listdir(directory), ['s1.npy'])
+        return np.load(os.path.join(directory, 's1.npy'))
+
+    def test_files_replaced_on_commit(self):
+        self.enroll(1.0)
+        self.enroll(2.0)
+        np.testing.assert_array_equal(self.stored(), np.full(8, 2.0, dtype=np.float32))
+
+    def test_failed_model_update_keeps_previous_files(self):
+        self.enroll(1.0)
+        with mock.patch('api.enrollment.update_model', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                self.enroll(2.0)
+        np.testing.assert_array_equal(self.stored(), np.full(8, 1.0, dtype=np.float32))
+
+
+class StackedRowsTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.base = rng.standard_normal((6, 4)).astype(np.float32)
+        self.tail = rng.standard_normal((3, 4)).astype(np.float32)
+        self.rows = StackedRows(self.base, self.tail)
+        self.whole = np.concatenate([self.base, self.tail])
+
+    def test_indexing(self):
+        self.assertEqual(self.rows.shape, (9, 4))
+        self.assertIs(self.rows[1:4].base, self.base)
+        np.testing.assert_array_equal(self.rows[7:9], self.whole[7:9])
+        np.testing.assert_array_equal(self.rows[4:8], self.whole[4:8])
+        np.testing.assert_array_equal(self.rows[[[0, 8], [6, 2]]], self.whole[[[0, 8], [6, 2]]])
+        mask = np.arange(9) % 2 == 0
+        np.testing.assert_array_equal(self.rows[mask], self.whole[mask])
+
+    def test_scores_and_append(self):
+        probes = np.ones((2, 4), dtype=np.float32)
+        np.testing.assert_allclose(self.rows.scores(probes), probes @ self.whole.T, rtol=1e-6)
+        grown = StackedRows.append(self.rows, self.tail[:1])
+        self.assertIs(grown.base, self.base)
+        self.assertEqual(len(grown), 10)
+
+
+class GalleryDeltaTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.matrix = normalize_rows(rng.standard_normal((4, 8)).astype(np.float32))
+        self.gallery = gallery.Gallery(np.array(['a', 'b', 'b', 'c']), self.matrix)
+        self.rows = normalize_rows(rng.standard_normal((3, 8)).astype(np.float32))
+
+    def test_base_rows_are_not_copied(self):
+        updated = self.gallery.apply_delta(np.array(['b', 'd']), self.rows[:2], np.array([], dtype=str), 1)
+        self.assertIsInstance(updated.matrix, StackedRows)
+        self.assertIs(updated.matrix.base, self.matrix)
+        again = updated.apply_delta(np.array(['e']), self.rows[2:], np.array([], dtype=str), 2)
+        self.assertIs(again.matrix.base, self.matrix)
+        self.assertEqual(again.delta_sequence, 2)
+        # The earlier snapshot is left as it was
+        self.assertEqual(len(updated), 6)
+
+    def test_upsert_replaces_every_template_and_removes(self):
+        updated = self.gallery.apply_delta(np.array(['b', 'd']), self.rows[:2], np.array(['c']), 1)
+        self.assertEqual(updated.student_ids.tolist(), ['a', 'b', 'd'])
+        np.testing.assert_array_equal(updated.template_counts, [1, 1, 1])
+        np.testing.assert_array_equal(updated.removed, [False, True, True, True, False, False])
+
+        probes = self.rows[:2]
+        expected = probes @ np.stack([self.matrix[0], self.rows[0], self.rows[1]]).T
+        np.testing.assert_allclose(updated.student_scores(probes), expected, rtol=1e-5)
+        np.testing.assert_allclose(updated.student_scores(probes, [2, 0]), expected[:, [2, 0]], rtol=1e-5)
+        idx, _ = updated.index.search(probes, 1)
+        np.testing.assert_array_equal(idx[:, 0], [4, 5])
+        self.assertEqual(sorted(updated.as_templates()), ['a', 'b', 'd'])
+
+
+@override_settings(GLOBAL_MODEL_COMPACTION_THRESHOLD=0)
+class DeltaModelTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.rows = normalize_rows(rng.standard_normal((6, 8)).astype(np.float32))
+
+    def test_deltas_apply_to_the_cached_base(self):
+        base, _ = update_model({'a': self.rows[:2], 'b': self.rows[2]})
+        cache = gallery.get_gallery_cache()
+        first = cache.get()
+        self.assertIsInstance(first.matrix, np.memmap)
+
+        update_model({'c': self.rows[3]})
+        update_model({'a': self.rows[4]}, removed=['b'])
+        self.assertEqual(GlobalModel.objects.count(), 1)
+        self.assertEqual(list(base.deltas.values_list('sequence', flat=True)), [1, 2])
+
+        current = cache.get()
+        self.assertEqual(current.delta_sequence, 2)
+        self.assertIs(current.matrix.base, first.matrix)
+        self.assertEqual(current.student_ids.tolist(), ['c', 'a'])
+        np.testing.assert_allclose(current.as_templates()['a'], self.rows[4:5])
+
+    def test_compaction_folds_deltas_into_a_new_base(self):
+        base, _ = update_model({'a': self.rows[:2], 'b': self.rows[2]})
+        update_model({'c': self.rows[3:5]}, removed=['b'])
+        new_base = compact(GlobalModel.objects.get(id=base.id))
+
+        self.assertEqual(new_base.num_students, 2)
+        self.assertFalse(GlobalModelDelta.objects.filter(base=new_base).exists())
+        current = gallery.get_gallery_cache().get()
+        self.assertEqual(current.model_id, new_base.id)
+        self.assertNotIsInstance(current.matrix, StackedRows)
+        self.assertEqual(sorted(current.ids.tolist()), ['a', 'a', 'c', 'c'])
+
+
+@override_settings(GLOBAL_MODEL_COMPACTION_THRESHOLD=0)
+class GalleryCacheTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(1)
+        self.rows = normalize_rows(rng.standard_normal((3, 8)).astype(np.float32))
+
+    def test_no_model(self):
+        self.assertIsNone(gallery.GalleryCache().get())
+
+    def test_snapshot_reused_until_the_model_changes(self):
+        update_model({'a': self.rows[0]})
+        cache = gallery.GalleryCache()
+        first = cache.get()
+        self.assertIs(cache.get(), first)
+
+        update_model({'b': self.rows[1]})
+        self.assertEqual(cache.get().student_ids.tolist(), ['a', 'b'])
+
+    def test_check_interval_until_invalidated(self):
+        update_model({'a': self.rows[0]})
+        cache = gallery.GalleryCache(check_interval=3600)
+        first = cache.get()
+
+        update_model({'b': self.rows[1]})
+        self.assertIs(cache.get(), first)
+        cache.invalidate()
+        self.assertEqual(cache.get().student_ids.tolist(), ['a', 'b'])
+
+    def test_new_base_model_reloads(self):
+        base, _ = update_model({'a': self.rows[0]})
+        cache = gallery.GalleryCache()
+        cache.get()
+
+        new_base = compact(GlobalModel.objects.get(id=base.id))
+        self.assertEqual(cache.get().model_id, new_base.id)
+
+
+@override_settings(GLOBAL_MODEL_COMPACTION_THRESHOLD=0)
+class RetentionTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        rows = normalize_rows(np.random.default_rng(2).standard_normal((2, 8)).astype(np.float32))
+        first, _ = update_model({'a': rows[0], 'b': rows[1]})
+        # A process still serving the first model
+        self.cache = gallery.GalleryCache()
+        self.cache.get()
+        second = compact(first)
+        third = compact(second)
+        self.first, self.second, self.third = [GlobalModel.objects.get(id=m.id) for m in (first, second, third)]
+
+    def test_leased_model_is_kept(self):
+        self.assertEqual(leased_model_ids(), {self.first.id})
+        second_files = model_store.files_of_model(self.second)
+        report = collect_garbage(keep=1, grace=3600)
+
+        self.assertEqual(report['deleted_models'], [self.second.version])
+        self.assertEqual(sorted(GlobalModel.objects.values_list('id', flat=True)), [self.first.id, self.third.id])
+        self.assertTrue(all(os.path.exists(path) for path in model_store.files_of_model(self.first)))
+        self.assertFalse(any(os.path.exists(path) for path in second_files))
+
+    def test_stale_lease_is_dropped(self):
+        stale = time.time() - 3600
+        os.utime(self.cache._lease_path, (stale, stale))
+        self.assertEqual(leased_model_ids(timeout=600), set())
+        self.assertFalse(os.path.exists(self.cache._lease_path))
+
+        collect_garbage(keep=1, grace=3600)
+        self.assertEqual(list(GlobalModel.objects.values_list('id', flat=True)), [self.third.id])
+
+    def test_pinned_model_is_kept(self):
+        GlobalModel.objects.filter(id=self.second.id).update(pinned=True)
+        report = collect_garbage(keep=1, grace=3600, dry_run=True)
+        self.assertEqual(report['deleted_models'], [])
+        self.assertEqual(GlobalModel.objects.count(), 3)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(chunks):
+    reports = []
+
+    def progress(report):
+        reports.append(report)
+        if len(reports) == chunks:
+            raise Interrupted
+    return progress
+
+
+@override_settings(ENROLLMENT_EMBEDDING_DIM=8)
+class ReaggregationTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(3)
+        os.makedirs(os.path.join(self.media_root, 'embeddings'))
+        for i in range(6):
+            # s4's file has the wrong size and is reported as failed
+            embedding = rng.standard_normal(5 if i == 4 else 8).astype(np.float32)
+            np.save(os.path.join(self.media_root, 'embeddings', f's{i}.npy'), embedding)
+            Student.objects.create(student_id=f's{i}', embedding_file=f'embeddings/s{i}.npy')
+
+    def interrupt(self):
+        with self.assertRaises(Interrupted):
+            Reaggregation(chunk_size=2, progress=interrupt_after(2)).run()
+
+    def test_resume_continues_after_the_last_chunk(self):
+        self.interrupt()
+        global_model, report = Reaggregation(chunk_size=2).run(resume=True)
+        self.assertEqual(report['resumed_from'], 4)
+        self.assertEqual((report['done'], report['failed']), (6, 1))
+        self.assertEqual(global_model.num_students, 5)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'reaggregate_checkpoint')), [])
+
+        _, fresh = Reaggregation(chunk_size=2).run()
+        self.assertEqual(fresh['resumed_from'], 0)
+        self.assertEqual(sorted(gallery.get_gallery_cache().get().ids.tolist()), ['s0', 's1', 's2', 's3', 's5'])
+
+    def test_changed_students_restart_the_run(self):
+        self.interrupt()
+        Student.objects.filter(student_id='s1').update(updated_at=timezone.now())
+        _, report = Reaggregation(chunk_size=2).run(resume=True)
+        self.assertEqual(report['resumed_from'], 0)
+
+        self.interrupt()
+        Student.objects.filter(student_id='s2').delete()
+        _, report = Reaggregation(chunk_size=2).run(resume=True)
+        self.assertEqual(report['resumed_from'], 0)
+        self.assertEqual(report['total'], 5)
+
+    @override_settings(REAGGREGATE_CHECKPOINT_MAX_AGE=0)
+    def test_old_checkpoint_is_not_resumed(self):
+        self.interrupt()
+        _, report = Reaggregation(chunk_size=2).run(resume=True)
+        self.assertEqual(report['resumed_from'], 0)
+
+
+class QuantizedMatrixTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.matrix = normalize_rows(rng.standard_normal((300, 512), dtype=np.float32))
+        self.probes = normalize_rows(rng.standard_normal((5, 512), dtype=np.float32))
+        self.exact = self.probes @ self.matrix.T
+
+    def test_float16_scores(self):
+        quantized = QuantizedMatrix.encode(self.matrix, 'float16')
+        self.assertEqual(quantized.dtype, 'float16')
+        self.assertEqual(quantized.nbytes, self.matrix.nbytes // 2)
+        np.testing.assert_allclose(quantized.scores(self.probes), self.exact, atol=2e-3)
+
+    def test_float16_rows_are_used_as_they_are(self):
+        rows = self.matrix.astype(np.float16)
+        self.assertTrue(np.shares_memory(QuantizedMatrix.encode(rows, 'float16').codes, rows))
+
+    def test_int8_scores(self):
+        quantized = QuantizedMatrix.encode(self.matrix, 'int8')
+        self.assertEqual(quantized.dtype, 'int8')
+        self.assertEqual(quantized.nbytes, self.matrix.nbytes // 4 + len(self.matrix) * 4)
+        np.testing.assert_allclose(quantized.scores(self.probes), self.exact, atol=2e-2)
+        # The best row per face survives quantization
+        np.testing.assert_array_equal(quantized.scores(self.probes).argmax(axis=1), self.exact.argmax(axis=1))
+
+    def test_chunked_scores_match(self):
+        quantized = QuantizedMatrix.encode(self.matrix, 'int8')
+        np.testing.assert_allclose(quantized.scores(self.probes, chunk_size=64), quantized.scores(self.probes),
+                                   atol=1e-6)
+
+    def test_append(self):
+        quantized = QuantizedMatrix.encode(self.matrix[:200], 'int8').append(self.matrix[200:])
+        self.assertEqual(len(quantized), len(self.matrix))
+        whole = QuantizedMatrix.encode(self.matrix, 'int8')
+        np.testing.assert_allclose(quantized.scores(self.probes, chunk_size=64), whole.scores(self.probes),
+                                   atol=1e-6)
+
+    def test_save_and_load(self):
+        quantized = QuantizedMatrix.encode(self.matrix, 'int8')
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, 'global_model.npy')
+            quantized.save(model_path)
+            loaded = QuantizedMatrix.load(model_path, mmap=False)
+        np.testing.assert_array_equal(loaded.scores(self.probes), quantized.scores(self.probes))
+
+    def test_unknown_dtype(self):
+        with self.assertRaises(ValueError):
+            QuantizedMatrix.encode(self.matrix, 'int4')
+
+
+class QuantizedGalleryTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.matrix = normalize_rows(rng.standard_normal((400, 64), dtype=np.float32))
+        self.ids = np.array([f's{i}' for i in range(len(self.matrix))])
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def load(self, storage_dtype):
+        path = write_gallery(os.path.join(self.directory, f'model_{storage_dtype}'), self.ids, self.matrix,
+                             dtype=storage_dtype)
+        save_quantized_for_model(path, self.matrix)
+        ids, matrix = gallery.load_gallery_file(path)
+        return gallery.Gallery(ids, matrix, quantized=load_quantized_for_model(path, matrix))
+
+    @override_settings(GALLERY_MATCH_DTYPE='int8', GALLERY_MMAP=True)
+    def test_stored_rows_stay_mapped(self):
+        for storage_dtype in ('float32', 'float16'):
+            loaded = self.load(storage_dtype)
+            self.assertIsInstance(loaded.matrix, np.memmap)
+            self.assertEqual(loaded.matrix.dtype, storage_dtype)
+            self.assertIsInstance(loaded.quantized.codes, np.memmap)
+
+            probes = self.matrix[[3, 250]]
+            idx, scores = loaded.index.search(probes, 2)
+            np.testing.assert_array_equal(idx[:, 0], [3, 250])
+            np.testing.assert_allclose(scores[:, 0], 1.0, atol=1e-3)
+
+    @override_settings(GALLERY_MATCH_DTYPE='float32', GALLERY_MMAP=True)
+    def test_exact_scans_widen_float16_storage(self):
+        loaded = self.load('float16')
+        self.assertEqual(loaded.matrix.dtype, np.float32)
+        self.assertIsNone(loaded.quantized)
+
+
+class CachedAnalysisTests(SimpleTestCase):
+    def setUp(self):
+        self.faces = [{'bbox': np.array([0, 0, 4, 4]), 'embedding': np.ones(8, dtype=np.float32)}]
+        cache = SimpleNamespace(get=lambda key: self.faces)
+        for target, value in (('get_engine', None), ('get_embedding_cache', cache)):
+            patcher = mock.patch(f'api.pipeline.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tester = GlobalModelTester()
+        self.tester.load_image = mock.Mock(return_value=(np.zeros((4, 4, 3), dtype=np.uint8), 1.0, None))
+
+    @override_settings(RESULT_IMAGE_MODE='lazy', UPLOAD_PERSIST='async')
+    def test_lazy_hit_skips_decode(self):
+        faces, img, error, hit = self.tester.analyze_image(b'jpeg', content_hash='abc')
+        self.assertTrue(hit)
+        self.assertIs(faces, self.faces)
+        self.assertIsNone(img)
+        self.assertIsNone(error)
+        self.tester.load_image.assert_not_called()
+
+    @override_settings(RESULT_IMAGE_MODE='eager')
+    def test_eager_hit_decodes_for_drawing(self):
+        faces, img, error, hit = self.tester.analyze_image(b'jpeg', content_hash='abc')
+        self.assertTrue(hit)
+        self.assertEqual(img.shape, (4, 4, 3))
+        self.tester.load_image.assert_called_once_with(b'jpeg')
+
+
+@override_settings(UPLOAD_PERSIST='async')
+class AsyncUploadTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.submitted = []
+        executor = SimpleNamespace(submit=lambda fn, *args: self.submitted.append(args))
+        patcher = mock.patch('api.uploads._get_executor', return_value=executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_write_waits_for_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            test_image, data = save_upload(SimpleUploadedFile('room.jpg', b'jpeg bytes'))
+        self.assertEqual(self.submitted, [])
+
+        for callback in callbacks:
+            callback()
+        (name, written, overwrite, on_saved), = self.submitted
+        self.assertEqual(written, data)
+
+        # What the pool thread does once the file is on disk
+        on_saved(uploads._write(name, written, overwrite))
+        stored = TestImage.objects.get(id=test_image.id).image
+        self.assertTrue(stored.name.startswith('test_images/room'))
+        with open(stored.path, 'rb') as f:
+            self.assertEqual(f.read(), b'jpeg bytes')
+
+    def test_identical_upload_reuses_stored_file(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first, _ = save_upload(SimpleUploadedFile('a.jpg', b'same bytes'))
+        name, data, overwrite, on_saved = self.submitted.pop()
+        on_saved(uploads._write(name, data, overwrite))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second, _ = save_upload(SimpleUploadedFile('b.jpg', b'same bytes'))
+        self.assertEqual(self.submitted, [])
+        self.assertEqual(second.image.name, TestImage.objects.get(id=first.id).image.name)
+
+
+@override_settings(UPLOAD_PERSIST='async', RESULT_IMAGE_MODE='lazy', RESULT_IMAGE_RETRY_AFTER=3)
+class LazyResultImageTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        annotations = [{'bbox': [10, 10, 40, 40], 'student_id': 's1', 'similarity': 0.8}]
+        self.test_image = TestImage.objects.create(image='', processed=True, stats={'annotations': annotations})
+        self.url = f'/api/aggregation/{self.test_image.id}/result_image/'
+
+    def store_original(self):
+        ok, encoded = cv2.imencode('.jpg', np.full((64, 64, 3), 128, dtype=np.uint8))
+        name = uploads._write('test_images/room.jpg', encoded.tobytes(), overwrite=True)
+        TestImage.objects.filter(id=self.test_image.id).update(image=name)
+
+    def test_pending_original_asks_to_retry(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Retry-After'], '3')
+
+    def test_original_never_stored_is_not_found(self):
+        TestImage.objects.filter(id=self.test_image.id).update(
+            created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_renders_once_original_is_stored(self):
+        self.store_original()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        response.close()
+
+        result_image = TestImage.objects.get(id=self.test_image.id).result_image
+        self.assertEqual(result_image.name, f'test_results/result_{self.test_image.id}_room.jpg')
+        self.assertTrue(os.path.exists(result_image.path))
+
+
+class DrawFaceBoxesTests(SimpleTestCase):
+    def box_color(self, similarity):
+        image = np.zeros((60, 60, 3), dtype=np.uint8)
+        drawn = draw_face_boxes(image, [{'image_bbox': [20, 20, 50, 50]}], [[('s1', similarity)]])
+        return tuple(drawn[35, 20])
+
+    def test_threshold_follows_matching(self):
+        with mock.patch('api.rendering.SIMILARITY_THRESHOLD', 0.7):
+            self.assertEqual(self.box_color(0.6), (0, 0, 255))
+            self.assertEqual(self.box_color(0.75), (0, 255, 0))
+
+
+class JobQueueTests(TestCase):
+    def queued(self, count):
+        jobs = [TestImage.objects.create(image=f'test_images/{i}.jpg') for i in range(count)]
+        for job in jobs:
+            enqueue(job)
+        return jobs
+
+    def test_claims_oldest_once(self):
+        first, second = self.queued(2)
+        claimed = claim_next()
+        self.assertEqual(claimed.id, first.id)
+        self.assertEqual(claimed.status, TestImage.STATUS_RUNNING)
+        self.assertIsNotNone(claimed.started_at)
+        self.assertEqual(claim_next().id, second.id)
+        self.assertIsNone(claim_next())
+
+    def test_stale_jobs_are_retried(self):
+        stale, fresh = self.queued(2)
+        claim_next()
+        claim_next()
+        TestImage.objects.filter(id=stale.id).update(started_at=timezone.now() - timedelta(seconds=600))
+
+        self.assertEqual(requeue_stale(timeout=300), 1)
+        self.assertEqual(claim_next().id, stale.id)
+        self.assertEqual(TestImage.objects.get(id=fresh.id).status, TestImage.STATUS_RUNNING)
+
+    def test_failed_job_records_the_error(self):
+        self.queued(1)
+        job = claim_next()
+        with mock.patch('api.jobs.run_recognition', side_effect=RecognitionError('No faces detected')):
+            self.assertFalse(run_job(job, tester=object()))
+        job.refresh_from_db()
+        self.assertEqual(job.status, TestImage.STATUS_FAILED)
+        self.assertEqual(job.error, 'No faces detected')
+        self.assertIsNotNone(job.finished_at)
+        self.assertIn('queue_wait_seconds', job.stats)
+
+
+class MetricsTests(TestCase):
+    def test_exposition_format(self):
+        registry = Registry()
+        registry.counter('jobs', 'Jobs by outcome', ['outcome']).inc(2, outcome='ok')
+        registry.histogram('wait_seconds', 'Wait', buckets=(0.1, 1.0)).observe(0.5)
+        registry.gauge('depth', 'Queue depth', lambda: 3)
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:3], ['# HELP jobs Jobs by outcome', '# TYPE jobs counter',
+                                     'jobs_total{outcome="ok"} 2'])
+        self.assertIn('wait_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('wait_seconds_bucket{le="1.0"} 1', lines)
+        self.assertIn('wait_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('wait_seconds_count 1', lines)
+        self.assertEqual(lines[-1], 'depth 3')
+
+    def test_endpoint(self):
+        before = IMAGES.value(outcome='ok')
+        record_result('ok', faces=2, matches=1, cache_hit=True)
+        self.assertEqual(IMAGES.value(outcome='ok'), before + 1)
+
+        self.client.get('/api/aggregation/metrics/')
+        response = self.client.get('/api/aggregation/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE recognition_stage_seconds histogram', body)
+        self.assertIn(f'recognition_images_total{{outcome="ok"}} {before + 1}', body)
+        self.assertIn('api_request_seconds_count{endpoint="metrics",code="200"}', body)
+
+
+@override_settings(INFERENCE_RETRY_AFTER=2)
+class InferenceAdmissionTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = InferencePool(workers=1, max_pending=1)
+        self.addCleanup(self.pool.executor.shutdown)
+
+    def test_reserve_is_bounded(self):
+        with self.pool.reserve():
+            with self.assertRaises(InferenceBusy):
+                with self.pool.reserve():
+                    pass
+        with self.pool.reserve():
+            self.assertEqual(self.pool.snapshot()['pending'], 1)
+        self.assertEqual(self.pool.stats, {'admitted': 2, 'rejected': 1})
+
+    async def test_full_queue_answers_429(self):
+        with mock.patch('api.async_views.get_inference_pool', return_value=self.pool), self.pool.reserve():
+            response = await self.async_client.post('/api/aggregation/async/test_image/',
+                                                    {'image': SimpleUploadedFile('room.jpg', b'jpeg')})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertEqual(json.loads(response.content)['code'], 429)
+        self.assertEqual(self.pool.stats['rejected'], 1)
+
+
+class RemoteEngineFramesTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = RemoteEngine('/nonexistent.sock', b'key', size=2)
+        self.addCleanup(self.engine.frames.close)
+        self.seen = []
+        self.fail = False
+        self.engine.call = self.call
+
+    def call(self, op, payload):
+        # What a server worker does: read the frame in place from the named segment
+        frame = payload['frame']
+        shm = attach_shared_memory(frame['name'])
+        try:
+            img = np.ndarray(frame['shape'], dtype=frame['dtype'], buffer=shm.buf).copy()
+        finally:
+            shm.close()
+        self.seen.append((frame['name'], int(img[0, 0, 0])))
+        if self.fail:
+            raise InferenceServerError('No answer from the inference server within 30s')
+        return {'bboxes': [], 'kpss': []}
+
+    def detect(self, value):
+        return self.engine.detect(np.full((32, 32, 3), value, dtype=np.uint8))
+
+    def test_segment_reused_between_calls(self):
+        self.detect(1)
+        self.detect(2)
+        (first, one), (second, two) = self.seen
+        self.assertEqual(first, second)
+        self.assertEqual((one, two), (1, 2))
+        self.assertEqual(len(self.engine.frames._segments), 1)
+
+    def test_segment_dropped_after_an_error(self):
+        self.detect(1)
+        self.fail = True
+        with self.assertRaises(InferenceServerError):
+            self.detect(2)
+        self.fail = False
+        self.detect(3)
+
+        names = [name for name, _ in self.seen]
+        self.assertEqual(names[0], names[1])
+        self.assertNotEqual(names[1], names[2])
+        self.assertEqual([value for _, value in self.seen], [1, 2, 3])
+        self.assertEqual(len(self.engine.frames._segments), 1)
+        self.assertEqual(self.engine.stats['errors'], 1)
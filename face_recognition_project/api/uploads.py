@@ -0,0 +1,154 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+PERSIST_SYNC = 'sync'
+PERSIST_ASYNC = 'async'
+PERSIST_NONE = 'none'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def read_upload(upload):
+    """All bytes of an uploaded file, read once from Django's upload buffer"""
+    upload.seek(0)
+    data = upload.read()
+    upload.seek(0)
+    return data
+
+
+def content_hash(data):
+    """SHA-256 hex digest of upload bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def persist_mode(mode=None):
+    mode = mode or getattr(settings, 'UPLOAD_PERSIST', PERSIST_ASYNC)
+    if mode not in (PERSIST_SYNC, PERSIST_ASYNC, PERSIST_NONE):
+        raise ValueError(f"Unknown UPLOAD_PERSIST mode {mode!r}")
+    return mode
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'UPLOAD_PERSIST_WORKERS', 2),
+                                               thread_name_prefix='upload-persist')
+    return _executor
+
+
+def _write(name, data, overwrite):
+    """Write bytes under MEDIA_ROOT and return the stored relative name"""
+    if not overwrite:
+        # The storage picks a free name, atomically with respect to other writers
+        return default_storage.save(name, ContentFile(data))
+
+    tmp_path, path = _stage(name, data)
+    os.replace(tmp_path, path)
+    return name
+
+
+def _stage(name, data):
+    """Write bytes to a temporary file next to their name under MEDIA_ROOT: (tmp_path, path)"""
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as destination:
+        destination.write(data)
+    return tmp_path, path
+
+
+def stage_many(items):
+    """Write (name, bytes) pairs under temporary names; commit_staged moves them into place
+
+    Lets a transaction write files that only replace the current ones once
+    it commits, and leave them untouched when it rolls back.
+    """
+    staged = []
+    try:
+        for name, data in items:
+            staged.append(_stage(name, data))
+    except Exception:
+        discard_staged(staged)
+        raise
+    return staged
+
+
+def commit_staged(staged):
+    for tmp_path, path in staged:
+        os.replace(tmp_path, path)
+
+
+def discard_staged(staged):
+    """Remove staged files that were not committed"""
+    for tmp_path, _ in staged:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_in_background(name, data, overwrite, on_saved):
+    try:
+        stored_name = _write(name, data, overwrite)
+        if on_saved is not None:
+            on_saved(stored_name)
+        return stored_name
+    except Exception as e:
+        logger.error(f"Error persisting upload {name}: {str(e)}")
+        raise
+    finally:
+        # Callbacks may have touched the database from this pool thread
+        connection.close()
+
+
+def persist_upload(name, data, mode=None, overwrite=False, on_saved=None):
+    """Keep a copy of an upload under MEDIA_ROOT according to UPLOAD_PERSIST
+
+    'sync' writes before returning the stored name, 'async' hands the write
+    to a small thread pool so the request does not wait on the media
+    volume, and 'none' keeps no copy. `on_saved(stored_name)` runs once the
+    file is written. Returns the stored name in sync mode, otherwise None.
+    """
+    mode = persist_mode(mode)
+    if mode == PERSIST_NONE:
+        return None
+    if mode == PERSIST_SYNC:
+        stored_name = _write(name, data, overwrite)
+        if on_saved is not None:
+            on_saved(stored_name)
+        return stored_name
+    _get_executor().submit(_write_in_background, name, data, overwrite, on_saved)
+    return None
+
+
+def _write_many_in_background(items, overwrite):
+    for name, data in items:
+        try:
+            _write(name, data, overwrite)
+        except Exception as e:
+            logger.error(f"Error persisting upload {name}: {str(e)}")
+
+
+def persist_many(items, mode=None, overwrite=False):
+    """Persist many (name, bytes) pairs, as a single background task in 'async' mode"""
+    mode = persist_mode(mode)
+    if mode == PERSIST_NONE:
+        return
+    if mode == PERSIST_SYNC:
+        for name, data in items:
+            _write(name, data, overwrite)
+        return
+    _get_executor().submit(_write_many_in_background, list(items), overwrite)
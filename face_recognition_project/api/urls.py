@@ -1,10 +1,18 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import AggregationViewSet
 
 router = DefaultRouter()
 router.register(r'aggregation', AggregationViewSet, basename='aggregation')
 
 urlpatterns = [
+    # Scrapers request the bare path; no redirect to the trailing slash
+    path('aggregation/metrics', AggregationViewSet.as_view({'get': 'metrics'}), name='aggregation-metrics-bare'),
+    # Async variants for ASGI servers, inference on a bounded pool with 429 backpressure
+    path('aggregation/async/test_image/', async_views.test_image, name='aggregation-async-test-image'),
+    path('aggregation/async/test_images/', async_views.test_images, name='aggregation-async-test-images'),
+    path('aggregation/async/receive_embeddings/', async_views.receive_embeddings,
+         name='aggregation-async-receive-embeddings'),
     path('', include(router.urls)),
 ] 
\ No newline at end of file
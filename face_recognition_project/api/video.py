@@ -0,0 +1,262 @@
+import logging
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .detection import box_iou
+from .matching import (SIMILARITY_THRESHOLD, normalize_probes, normalize_rows, match_faces, assign_faces,
+                       hungarian, linear_sum_assignment)
+
+logger = logging.getLogger(__name__)
+
+
+class FaceTrack:
+    """One face followed across frames, embedded only a few times"""
+
+    def __init__(self, track_id, bbox, det_score, frame_index):
+        self.track_id = track_id
+        self.bbox = np.asarray(bbox, dtype=np.float32)
+        self.best_det_score = float(det_score)
+        self.first_frame = frame_index
+        self.last_frame = frame_index
+        self.hits = 1
+        self.missed = 0
+        self.embeddings = []
+        self.embedded_at = None
+
+    def update(self, bbox, det_score, frame_index):
+        self.bbox = np.asarray(bbox, dtype=np.float32)
+        self.best_det_score = max(self.best_det_score, float(det_score))
+        self.last_frame = frame_index
+        self.hits += 1
+        self.missed = 0
+
+    def embedding(self):
+        """Mean of the track's normalized embeddings, renormalized"""
+        if not self.embeddings:
+            return None
+        return normalize_rows(np.mean(normalize_probes(self.embeddings), axis=0, keepdims=True))[0]
+
+
+class FaceTracker:
+    """IoU tracker; detections and live tracks are paired by a one-to-one assignment"""
+
+    def __init__(self, iou_threshold=0.3, max_missed=5):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.active = []
+        self.finished = []
+        self._next_id = 0
+
+    def update(self, bboxes, det_scores, frame_index):
+        """Advance every track by one processed frame
+
+        Returns (tracks, new): the track each detection belongs to and
+        whether that track was started by this frame.
+        """
+        tracks = [None] * len(bboxes)
+        new = [False] * len(bboxes)
+        matched = set()
+
+        if self.active and len(bboxes):
+            iou = box_iou(np.stack([track.bbox for track in self.active]), bboxes)
+            solver = linear_sum_assignment or hungarian
+            rows, cols = solver(-iou)
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                if iou[row, col] < self.iou_threshold:
+                    continue
+                track = self.active[row]
+                track.update(bboxes[col], det_scores[col], frame_index)
+                tracks[col] = track
+                matched.add(row)
+
+        still_active = []
+        for row, track in enumerate(self.active):
+            if row not in matched:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    self.finished.append(track)
+                    continue
+            still_active.append(track)
+        self.active = still_active
+
+        for col, track in enumerate(tracks):
+            if track is None:
+                track = FaceTrack(self._next_id, bboxes[col], det_scores[col], frame_index)
+                self._next_id += 1
+                self.active.append(track)
+                tracks[col] = track
+                new[col] = True
+        return tracks, new
+
+    def all_tracks(self):
+        return sorted(self.finished + self.active, key=lambda track: track.track_id)
+
+
+class VideoAttendance:
+    """Attendance from a video file or camera stream
+
+    Frames are sampled at roughly `sample_fps`; the stride grows while the
+    scene is stable and drops back when faces appear or disappear. Faces
+    are tracked by IoU across sampled frames and each track is embedded at
+    most `embeddings_per_track` times, so recognition cost follows the
+    number of people instead of the number of frames. Tracks, not raw
+    detections, are matched against the gallery.
+    """
+
+    def __init__(self, engine, sample_fps=5.0, max_stride_factor=4, iou_threshold=0.3, max_missed=5,
+                 embeddings_per_track=3, embed_interval=5, min_track_hits=2):
+        self.engine = engine
+        self.sample_fps = sample_fps
+        self.max_stride_factor = max_stride_factor
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.embeddings_per_track = embeddings_per_track
+        self.embed_interval = embed_interval
+        self.min_track_hits = min_track_hits
+
+    @classmethod
+    def from_settings(cls, engine):
+        return cls(
+            engine,
+            sample_fps=getattr(settings, 'VIDEO_SAMPLE_FPS', 5.0),
+            max_stride_factor=getattr(settings, 'VIDEO_MAX_STRIDE_FACTOR', 4),
+            iou_threshold=getattr(settings, 'VIDEO_TRACK_IOU_THRESHOLD', 0.3),
+            max_missed=getattr(settings, 'VIDEO_TRACK_MAX_MISSED', 5),
+            embeddings_per_track=getattr(settings, 'VIDEO_EMBEDDINGS_PER_TRACK', 3),
+            embed_interval=getattr(settings, 'VIDEO_EMBED_INTERVAL', 5),
+            min_track_hits=getattr(settings, 'VIDEO_MIN_TRACK_HITS', 2),
+        )
+
+    def _should_embed(self, track, is_new, det_score):
+        """Embed new tracks, then every few hits while the face is about as sharp as the best seen"""
+        if len(track.embeddings) >= self.embeddings_per_track:
+            return False
+        if is_new or track.embedded_at is None:
+            return True
+        return track.hits - track.embedded_at >= self.embed_interval and det_score >= track.best_det_score * 0.9
+
+    def track(self, source, max_frames=None, max_seconds=None):
+        """Decode `source` and build face tracks; returns (tracks, stats)"""
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise ValueError(f"Could not open video source {source!r}")
+
+        video_fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        if not video_fps or video_fps != video_fps or video_fps > 240:
+            video_fps = 30.0
+        base_stride = max(1, int(round(video_fps / self.sample_fps)))
+        max_stride = base_stride * max(1, self.max_stride_factor)
+        stride = base_stride
+
+        tracker = FaceTracker(iou_threshold=self.iou_threshold, max_missed=self.max_missed)
+        stats = {'frames_read': 0, 'frames_processed': 0, 'detections': 0, 'embeddings_computed': 0,
+                 'video_fps': round(video_fps, 2), 'base_stride': base_stride,
+                 'detect_seconds': 0.0, 'embed_seconds': 0.0}
+        start = time.perf_counter()
+        next_frame = 0
+
+        try:
+            # Per frame through the engine, so frames can also go to the inference server
+            while True:
+                if max_frames is not None and stats['frames_read'] >= max_frames:
+                    break
+                if max_seconds is not None and time.perf_counter() - start >= max_seconds:
+                    break
+
+                # grab() skips decoding of frames we are not going to look at
+                if not capture.grab():
+                    break
+                frame_index = stats['frames_read']
+                stats['frames_read'] += 1
+                if frame_index < next_frame:
+                    continue
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+                detect_start = time.perf_counter()
+                bboxes, kpss = self.engine.detect(img)
+                stats['detect_seconds'] += time.perf_counter() - detect_start
+                stats['frames_processed'] += 1
+                stats['detections'] += len(bboxes)
+
+                live_before = len(tracker.active)
+                tracks, new = tracker.update(bboxes[:, :4], bboxes[:, 4], frame_index)
+
+                # Only the tracks due for an embedding are aligned, in one batch
+                embed_start = time.perf_counter()
+                due = [i for i, track in enumerate(tracks) if self._should_embed(track, new[i], bboxes[i, 4])]
+                if due:
+                    embeddings = self.engine.embed(img, kpss[due] if kpss is not None else None)
+                    for i, embedding in zip(due, embeddings):
+                        tracks[i].embeddings.append(embedding)
+                        tracks[i].embedded_at = tracks[i].hits
+                    stats['embeddings_computed'] += len(due)
+                stats['embed_seconds'] += time.perf_counter() - embed_start
+
+                # Slow down while nothing changes, speed back up when people come or go
+                if any(new) or len(tracker.active) != live_before or len(tracks) != live_before:
+                    stride = base_stride
+                else:
+                    stride = min(stride * 2, max_stride)
+                next_frame = frame_index + stride
+        finally:
+            capture.release()
+
+        elapsed = time.perf_counter() - start
+        stats.update({
+            'seconds': round(elapsed, 4),
+            'decode_fps': round(stats['frames_read'] / elapsed, 2) if elapsed else None,
+            'processed_fps': round(stats['frames_processed'] / elapsed, 2) if elapsed else None,
+            'detect_seconds': round(stats['detect_seconds'], 4),
+            'embed_seconds': round(stats['embed_seconds'], 4),
+        })
+        return tracker.all_tracks(), stats
+
+    def run(self, source, gallery, k=5, max_frames=None, max_seconds=None):
+        """Track faces in `source` and match the tracks against the gallery"""
+        tracks, stats = self.track(source, max_frames=max_frames, max_seconds=max_seconds)
+        usable = [track for track in tracks if track.hits >= self.min_track_hits and track.embeddings]
+
+        assignments = [None] * len(usable)
+        if usable and gallery is not None and len(gallery):
+            probes = normalize_probes([track.embedding() for track in usable])
+            idx, _ = match_faces(probes, gallery, k=k, threshold=SIMILARITY_THRESHOLD)
+            students, scores = assign_faces(probes, gallery, idx, threshold=SIMILARITY_THRESHOLD)
+            assignments = [None if student < 0 else (str(gallery.student_ids[student]), score)
+                           for student, score in zip(students.tolist(), scores.tolist())]
+
+        attendance = []
+        track_reports = []
+        for track, assigned in zip(usable, assignments):
+            report = {
+                'track_id': track.track_id,
+                'first_frame': track.first_frame,
+                'last_frame': track.last_frame,
+                'hits': track.hits,
+                'embeddings_computed': len(track.embeddings),
+                'student_id': assigned[0] if assigned else None,
+                'similarity': float(assigned[1]) if assigned else None
+            }
+            track_reports.append(report)
+            if assigned:
+                attendance.append({'student_id': assigned[0], 'similarity': float(assigned[1]),
+                                   'track_id': track.track_id})
+        attendance.sort(key=lambda x: x['similarity'], reverse=True)
+
+        stats.update({
+            'tracks': len(tracks),
+            'tracks_matched': len(attendance),
+            'embeddings_per_track': round(stats['embeddings_computed'] / len(tracks), 2) if tracks else 0.0,
+        })
+        return {
+            'total_students_in_database': gallery.num_students if gallery is not None else 0,
+            'total_present': len(attendance),
+            'attendance': attendance,
+            'tracks': track_reports,
+            'stats': stats
+        }
@@ -1,3 +1,4 @@
+from django.http import FileResponse, HttpResponse
 from django.shortcuts import render
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
@@ -5,155 +6,70 @@ from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
 from core.models import Student, GlobalModel, TestImage
 from django.conf import settings
+from django.db import transaction
 import numpy as np
 import os
-from datetime import datetime
 import cv2
-from insightface.app import FaceAnalysis
+import io
 import logging
+import tempfile
+import time
+from .engine import get_engine
+from .gallery import get_gallery_cache
+from .model_store import update_model, write_lock
+from .enrollment import EnrollmentError, enroll, expected_dim, read_archive, validate_embeddings
+from .jobs import enqueue, queue_depth
+from .metrics import REGISTRY, REQUEST_SECONDS
+from .profiling import list_traces, profile_request
+from .reaggregation import Reaggregation
+from .rendering import ResultImagePending, render_result_image, result_image_url
+from .pipeline import GlobalModelTester, RecognitionError, run_batch_recognition, run_recognition, save_upload
+from .uploads import PERSIST_SYNC, persist_upload, read_upload
+from .video import VideoAttendance
+from .matching import SIMILARITY_THRESHOLD, normalize_probes, normalize_rows, match_faces, candidates_for
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class GlobalModelTester:
-    def __init__(self, model_dir="data/global_model", test_dir="data/test-images"):
-        """Initialize with model and test directories"""
-        self.model_dir = model_dir
-        self.test_dir = test_dir
-        
-        # Initialize face processor
-        self.app = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
-        self.app.prepare(ctx_id=-1, det_size=(640, 640))
-        
-        # Setup logging
-        logging.basicConfig(level=logging.INFO)
-        self.logger = logging.getLogger(__name__)
 
-    def load_latest_model(self):
-        """Load the latest global model"""
-        try:
-            model_files = [f for f in os.listdir(self.model_dir) if f.startswith("global_model_")]
-            if not model_files:
-                self.logger.error("No global model files found!")
-                return None
-            
-            # Get most recent file
-            latest_model = max(model_files)
-            model_path = os.path.join(self.model_dir, latest_model)
-            
-            # Load model data
-            model_data = np.load(model_path, allow_pickle=True)
-            return model_data['student_embeddings'].item()
-            
-        except Exception as e:
-            self.logger.error(f"Error loading model: {str(e)}")
-            return None
+def gallery_students():
+    gallery = get_gallery_cache().current
+    return gallery.num_students if gallery is not None else None
 
-    def process_test_image(self, image_path):
-        """Process a single test image"""
-        try:
-            # Read and process image
-            img = cv2.imread(image_path)
-            if img is None:
-                return None, None, "Failed to read image"
-            
-            # BGR to RGB
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            
-            # Get faces
-            faces = self.app.get(img)
-            if not faces:
-                return None, None, "No faces detected"
-            
-            # Process each face
-            processed_faces = []
-            for face in faces:
-                bbox = face.bbox.astype(int)
-                embedding = face.embedding
-                processed_faces.append({
-                    'bbox': bbox,
-                    'embedding': embedding,
-                    'score': face.det_score
-                })
-            
-            return processed_faces, img, None
-            
-        except Exception as e:
-            self.logger.error(f"Error processing image: {str(e)}")
-            return None, None, str(e)
 
-    def compare_embeddings(self, test_embedding, student_embeddings):
-        """Compare embeddings and return matches"""
-        matches = {}
-        try:
-            # Normalize test embedding
-            test_embedding = test_embedding / np.linalg.norm(test_embedding)
-            
-            # Compare with each student
-            for student_id, student_embedding in student_embeddings.items():
-                # Normalize student embedding
-                student_embedding = student_embedding / np.linalg.norm(student_embedding)
-                
-                # Calculate similarity
-                similarity = np.dot(test_embedding, student_embedding)
-                matches[student_id] = similarity
-                
-                # Log high matches
-                if similarity > 0.5:
-                    self.logger.info(f"Face matched with Student {student_id} (similarity: {similarity:.2f})")
-            
-            return matches
-            
-        except Exception as e:
-            self.logger.error(f"Error comparing embeddings: {str(e)}")
-            return {}
+REGISTRY.gauge('recognition_queue_depth', 'Recognition jobs waiting for a worker', queue_depth)
+REGISTRY.gauge('engine_idle_sessions', 'Face analysis sessions loaded and not in use',
+               lambda: get_engine().idle_sessions)
+REGISTRY.gauge('gallery_students', 'Students in the gallery this process serves', gallery_students)
 
-    def draw_face_boxes(self, image, faces, match_results):
-        """Draw boxes and labels on faces"""
-        try:
-            img = image.copy()
-            
-            for face, matches in zip(faces, match_results):
-                x1, y1, x2, y2 = face['bbox']
-                
-                # Find best match
-                if matches:
-                    best_match = max(matches.items(), key=lambda x: x[1])
-                    student_id, similarity = best_match
-                    
-                    if similarity > 0.5:
-                        # Green box for match
-                        color = (0, 255, 0)
-                        text = f"Student {student_id} ({similarity:.2f})"
-                    else:
-                        # Red box for low similarity
-                        color = (0, 0, 255)
-                        text = "No match"
-                else:
-                    # Red box for no matches
-                    color = (0, 0, 255)
-                    text = "No match"
-                
-                # Draw box and label
-                cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
-                cv2.putText(img, text, (x1, y1-10),
-                          cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-            
-            return img
-            
-        except Exception as e:
-            self.logger.error(f"Error drawing result: {str(e)}")
-            return image
 
 class AggregationViewSet(viewsets.ViewSet):
     parser_classes = (MultiPartParser, FormParser)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        model_dir = os.path.join(settings.MEDIA_ROOT, 'global_model')
-        test_dir = os.path.join(settings.MEDIA_ROOT, 'test_images')
-        self.tester = GlobalModelTester(model_dir=model_dir, test_dir=test_dir)
+        self.tester = GlobalModelTester()
+
+    def dispatch(self, request, *args, **kwargs):
+        """Run the action under the opt-in profiler (PROFILE_ENABLED)"""
+        force = bool(request.headers.get(getattr(settings, 'PROFILE_HEADER', 'X-Profile')))
+        # self.action is only set once dispatch has wrapped the request
+        action_name = getattr(self, 'action_map', {}).get(request.method.lower(), 'unknown')
+        with profile_request(action_name, request.method, request.path, force=force):
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        self.request_started = time.perf_counter()
+        super().initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        """Record the request latency per endpoint and response code"""
+        started = getattr(self, 'request_started', None)
+        if started is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                    endpoint=self.action or 'unknown', code=response.status_code)
+        return super().finalize_response(request, response, *args, **kwargs)
 
     @action(detail=False, methods=['POST'])
     def test_image(self, request):
@@ -168,87 +84,146 @@ class AggregationViewSet(viewsets.ViewSet):
                     'data': None
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Save test image
-            test_image = TestImage.objects.create(image=image_file)
-            image_path = test_image.image.path
+            run_async = request.data.get('async', getattr(settings, 'RECOGNITION_ASYNC_DEFAULT', False))
+            run_async = str(run_async).lower() in ('1', 'true', 'yes')
             
-            # Process image
-            faces, img, error = self.tester.process_test_image(image_path)
-            if error:
+            # Save test image; queued jobs are read back by worker processes, so write those first
+            test_image, image_data = save_upload(image_file, persist=PERSIST_SYNC if run_async else None)
+            
+            if run_async:
+                # Hand the job to the recognition_worker pool and return right away
+                depth = enqueue(test_image)
+                return Response({
+                    'code': 202,
+                    'msg': 'Image queued for processing',
+                    'data': {
+                        'job_id': test_image.id,
+                        'status': test_image.status,
+                        'queue_depth': depth,
+                        'status_url': f'/api/aggregation/{test_image.id}/job/'
+                    }
+                }, status=status.HTTP_202_ACCEPTED)
+            
+            try:
+                data = run_recognition(test_image, tester=self.tester, image_data=image_data)
+            except RecognitionError as e:
+                return Response({
+                    'code': e.code,
+                    'msg': e.msg,
+                    'data': None
+                }, status=e.code)
+            
+            return Response({
+                'code': 200,
+                'msg': 'Image processed successfully',
+                'data': data
+            })
+            
+        except Exception as e:
+            logger.error(f"Error in test_image: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return Response({
+                'code': 500,
+                'msg': str(e),
+                'data': None
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['POST'])
+    def test_images(self, request):
+        """Test several photos of one room and return a merged attendance list"""
+        try:
+            image_files = request.FILES.getlist('images') or request.FILES.getlist('image')
+            if not image_files:
                 return Response({
                     'code': 400,
-                    'msg': error,
+                    'msg': 'No images provided',
                     'data': None
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Load model
-            student_embeddings = self.tester.load_latest_model()
-            if not student_embeddings:
+            max_images = getattr(settings, 'BATCH_MAX_IMAGES', 20)
+            if len(image_files) > max_images:
+                return Response({
+                    'code': 400,
+                    'msg': f'Too many images, at most {max_images} per request',
+                    'data': None
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            # Save test images
+            with transaction.atomic():
+                uploads = [save_upload(image_file) for image_file in image_files]
+            test_images = [test_image for test_image, _ in uploads]
+            
+            try:
+                data = run_batch_recognition(test_images, tester=self.tester,
+                                             image_data=[image_data for _, image_data in uploads])
+            except RecognitionError as e:
+                return Response({
+                    'code': e.code,
+                    'msg': e.msg,
+                    'data': None
+                }, status=e.code)
+            
+            return Response({
+                'code': 200,
+                'msg': f'{len(test_images)} images processed successfully',
+                'data': data
+            })
+            
+        except Exception as e:
+            logger.error(f"Error in test_images: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return Response({
+                'code': 500,
+                'msg': str(e),
+                'data': None
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['POST'])
+    def test_video(self, request):
+        """Take attendance from a short classroom video using face tracking"""
+        try:
+            video_file = request.FILES.get('video')
+            if not video_file:
+                return Response({
+                    'code': 400,
+                    'msg': 'No video provided',
+                    'data': None
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            gallery = self.tester.load_latest_model()
+            if gallery is None or not len(gallery):
                 return Response({
                     'code': 404,
                     'msg': 'No global model found',
                     'data': None
                 }, status=status.HTTP_404_NOT_FOUND)
             
-            # Compare each face
-            match_results = []
-            for face in faces:
-                matches = self.tester.compare_embeddings(face['embedding'], student_embeddings)
-                match_results.append(matches)
-            
-            # Draw results
-            result_img = self.tester.draw_face_boxes(img, faces, match_results)
-            
-            # Save result image
-            result_filename = f"result_{os.path.basename(image_path)}"
-            result_path = os.path.join(settings.MEDIA_ROOT, 'test_results', result_filename)
-            os.makedirs(os.path.dirname(result_path), exist_ok=True)
-            cv2.imwrite(result_path, cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR))
-            
-            # Prepare clean response
-            clean_results = []
-            seen_students = set()  # Track unique students
-            total_students = len([k for k in student_embeddings.keys() if not k.endswith('_embedding')])  # Count unique students
-            
-            for face, matches in zip(faces, match_results):
-                if matches:
-                    # Sort matches by similarity
-                    sorted_matches = sorted(matches.items(), key=lambda x: x[1], reverse=True)
-                    # Get matches above threshold and remove duplicates
-                    for student_id, similarity in sorted_matches:
-                        # Skip if already seen or if it's a duplicate (_embedding suffix)
-                        if student_id in seen_students or student_id.endswith('_embedding'):
-                            continue
-                        
-                        if similarity > 0.5:  # Threshold check
-                            clean_results.append({
-                                'student_id': student_id,
-                                'similarity': float(similarity)
-                            })
-                            seen_students.add(student_id)
-            
-            # Sort final results by similarity
-            clean_results.sort(key=lambda x: x['similarity'], reverse=True)
-            
-            # Update test image record
-            test_image.result = clean_results
-            test_image.result_image = f'test_results/{result_filename}'
-            test_image.processed = True
-            test_image.save()
+            # OpenCV needs a real file to decode from
+            suffix = os.path.splitext(video_file.name)[1] or '.mp4'
+            with tempfile.NamedTemporaryFile(suffix=suffix) as video_path:
+                for chunk in video_file.chunks():
+                    video_path.write(chunk)
+                video_path.flush()
+                data = VideoAttendance.from_settings(self.tester.engine).run(
+                    video_path.name, gallery, k=getattr(settings, 'MATCH_TOP_K', 5),
+                    max_frames=getattr(settings, 'VIDEO_MAX_FRAMES', None))
             
             return Response({
                 'code': 200,
-                'msg': 'Image processed successfully',
-                'data': {
-                    'total_students_in_database': total_students,
-                    'total_matches': len(clean_results),
-                    'matches': clean_results,
-                    'result_image_url': f'/media/test_results/{result_filename}'
-                }
+                'msg': 'Video processed successfully',
+                'data': data
             })
             
+        except ValueError as e:
+            return Response({
+                'code': 400,
+                'msg': str(e),
+                'data': None
+            }, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
-            logger.error(f"Error in test_image: {str(e)}")
+            logger.error(f"Error in test_video: {str(e)}")
             import traceback
             logger.error(traceback.format_exc())
             return Response({
@@ -260,44 +235,12 @@ class AggregationViewSet(viewsets.ViewSet):
     def load_latest_model(self):
         """Load the latest global model with proper error handling"""
         try:
-            # Get latest model from database
-            latest_model = GlobalModel.objects.latest('created_at')
-            logger.info(f"Found model in database: {latest_model.version}")
-            
-            # Try different possible paths
-            possible_paths = [
-                os.path.join(settings.MEDIA_ROOT, latest_model.model_file.name),  # Full path
-                os.path.join(settings.MEDIA_ROOT, 'global_model', latest_model.model_file.name),  # In global_model dir
-                os.path.join(settings.MEDIA_ROOT, 'global_model', os.path.basename(latest_model.model_file.name))  # Just filename
-            ]
-            
-            # Try each path
-            model_path = None
-            for path in possible_paths:
-                logger.info(f"Checking path: {path}")
-                if os.path.exists(path):
-                    model_path = path
-                    logger.info(f"Found model file at: {path}")
-                    break
-            
-            if not model_path:
-                logger.error("Model file not found in any location")
+            # Cached per process and only reloaded when a newer model is saved
+            gallery = get_gallery_cache().get()
+            if gallery is None:
                 return {}
+            return gallery.as_dict()
             
-            # Load the model
-            model_data = np.load(model_path, allow_pickle=True)
-            embeddings = model_data['student_embeddings'].item()
-            
-            # Convert all embeddings to float32
-            for student_id in embeddings:
-                embeddings[student_id] = np.array(embeddings[student_id]).astype(np.float32)
-            
-            logger.info(f"Successfully loaded model with {len(embeddings)} students")
-            return embeddings
-            
-        except GlobalModel.DoesNotExist:
-            logger.error("No model found in database")
-            return {}
         except Exception as e:
             logger.error(f"Error loading model: {str(e)}")
             import traceback
@@ -315,28 +258,30 @@ class AggregationViewSet(viewsets.ViewSet):
             # Convert BGR to RGB (important!)
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
             
-            # Get faces using buffalo_l model
-            faces = self.tester.app.get(img)
-            if not faces:
+            # Detect with buffalo_l, in this process or on the inference server
+            bboxes, kpss = self.tester.engine.detect(img)
+            if not len(bboxes):
                 return None, None, "No faces detected in test image"
             
             # Get largest face as in test_global_model.py
-            face = max(faces, key=lambda x: (x.bbox[2] - x.bbox[0]) * (x.bbox[3] - x.bbox[1]))
+            largest = int(np.argmax((bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])))
+            det_score = float(bboxes[largest, 4])
             
             # Get face info for drawing
-            x1, y1, x2, y2 = map(int, face.bbox[:4])
+            x1, y1, x2, y2 = map(int, bboxes[largest, :4])
             faces_info = [{
                 'bbox': [x1, y1, x2, y2],
-                'score': face.det_score
+                'score': det_score
             }]
             
-            # Get embedding and normalize exactly as in test_global_model.py
-            embedding = face.embedding.astype(np.float32)
+            # Embed only that face and normalize exactly as in test_global_model.py
+            embedding = self.tester.engine.embed(img, kpss[[largest]])[0].astype(np.float32)
             embedding = embedding / np.linalg.norm(embedding)
             
             # Log embedding stats
-            logger.info(f"Face detection score: {face.det_score}")
-            logger.info(f"Embedding norm: {np.linalg.norm(embedding)}")
+            if getattr(settings, 'LOG_MATCH_DETAILS', False):
+                logger.info(f"Face detection score: {det_score}")
+                logger.info(f"Embedding norm: {np.linalg.norm(embedding)}")
             
             return embedding, faces_info, None
             
@@ -344,35 +289,24 @@ class AggregationViewSet(viewsets.ViewSet):
             logger.error(f"Error processing test image: {str(e)}")
             return None, None, str(e)
 
-    def compare_embeddings(self, test_embedding, student_embeddings):
-        """Compare embeddings using exact implementation from test_global_model.py"""
+    def compare_embeddings(self, test_embedding, gallery):
+        """Compare one embedding with every student in the gallery, best first"""
         results = []
         try:
-            # Remove duplicate student IDs (remove ones with '_embedding' suffix)
-            clean_embeddings = {
-                student_id: emb for student_id, emb in student_embeddings.items() 
-                if not student_id.endswith('_embedding')
-            }
-            
-            for student_id, student_embedding in clean_embeddings.items():
-                # Normalize student embedding
-                student_embedding = student_embedding.astype(np.float32)
-                student_embedding = student_embedding / np.linalg.norm(student_embedding)
-                
-                # Calculate cosine similarity exactly as in test_global_model.py
-                similarity = float(np.dot(test_embedding, student_embedding))
-                
+            # One matrix-vector product over the pre-normalized gallery
+            probes = normalize_probes([test_embedding])
+            idx, scores = match_faces(probes, gallery, k=gallery.num_students, threshold=None)
+            for student_id, similarity in candidates_for(gallery, idx, scores)[0]:
                 results.append({
                     'student_id': student_id,
                     'similarity': similarity
                 })
-                
-                # Log matches as in test_global_model.py
-                if similarity > 0.5:
-                    logger.info(f"Face matched with Student {student_id} (similarity: {similarity:.2f})")
             
-            # Sort by similarity
-            results.sort(key=lambda x: x['similarity'], reverse=True)
+            # Log best match as in test_global_model.py
+            if (getattr(settings, 'LOG_MATCH_DETAILS', False)
+                    and results and results[0]['similarity'] > SIMILARITY_THRESHOLD):
+                logger.info(f"Face matched with Student {results[0]['student_id']} (similarity: {results[0]['similarity']:.2f})")
+            
             return results
             
         except Exception as e:
@@ -380,60 +314,27 @@ class AggregationViewSet(viewsets.ViewSet):
             return []
 
     def aggregate_embeddings(self, new_embeddings):
-        """Aggregate embeddings using server implementation"""
+        """Aggregate embeddings by appending a delta segment to the latest model"""
         try:
-            # Load existing embeddings
-            existing_embeddings = self.load_latest_model()
-            
-            # Convert and normalize all embeddings
-            all_embeddings = {}
-            
-            # Process existing embeddings
-            for student_id, embedding in existing_embeddings.items():
-                try:
-                    embedding = np.array(embedding, dtype=np.float32)
-                    normalized_embedding = embedding / np.linalg.norm(embedding)
-                    all_embeddings[student_id] = normalized_embedding
-                except Exception as e:
-                    logger.error(f"Error processing existing embedding for {student_id}: {str(e)}")
-                    continue
-            
-            # Process new embeddings
+            # Normalize new embeddings
+            normalized_embeddings = {}
             for student_id, embedding in new_embeddings.items():
                 try:
+                    # Several rows are a template set, each template is normalized on its own
                     embedding = np.array(embedding, dtype=np.float32)
-                    normalized_embedding = embedding / np.linalg.norm(embedding)
-                    all_embeddings[student_id] = normalized_embedding
+                    normalized_embeddings[student_id] = normalize_rows(embedding.reshape(-1, embedding.shape[-1]))
                 except Exception as e:
                     logger.error(f"Error processing new embedding for {student_id}: {str(e)}")
                     continue
             
-            # Save new model
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            model_filename = f"global_model_{timestamp}.npz"
-            model_path = os.path.join(self.model_dir, model_filename)
-            
-            # Save with all normalized embeddings
-            np.savez(
-                model_path,
-                student_embeddings=all_embeddings,
-                num_students=len(all_embeddings),
-                timestamp=timestamp
-            )
+            # Only the changed students are written; deltas are compacted in the background
+            global_model, existing_count = update_model(normalized_embeddings)
             
             # Log aggregation results
-            logger.info(f"Aggregated {len(all_embeddings)} total embeddings")
-            logger.info(f"Existing: {len(existing_embeddings)}, New: {len(new_embeddings)}")
+            logger.info(f"Aggregated {global_model.num_students} total embeddings")
+            logger.info(f"Existing: {existing_count}, New: {len(normalized_embeddings)}")
             
-            # Create database entry
-            relative_path = os.path.join('global_model', model_filename)
-            global_model = GlobalModel.objects.create(
-                version=timestamp,
-                model_file=relative_path,
-                num_students=len(all_embeddings)
-            )
-            
-            return global_model, None, len(existing_embeddings)
+            return global_model, None, existing_count
             
         except Exception as e:
             logger.error(f"Error in aggregate_embeddings: {str(e)}")
@@ -458,23 +359,21 @@ class AggregationViewSet(viewsets.ViewSet):
                     # Get student ID from filename (remove .npy extension)
                     student_id = os.path.splitext(file.name)[0]
                     
-                    # Save file
-                    file_path = os.path.join(settings.MEDIA_ROOT, 'embeddings', file.name)
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    with open(file_path, 'wb+') as destination:
-                        for chunk in file.chunks():
-                            destination.write(chunk)
+                    # One embedding, or one row per template; normalized when aggregated
+                    data = read_upload(file)
+                    embedding = np.load(io.BytesIO(data), allow_pickle=False)
                     
-                    # Load and normalize embedding
-                    embedding = np.load(file_path)
-                    normalized_embedding = embedding / np.linalg.norm(embedding)
-                    new_embeddings[student_id] = normalized_embedding
+                    # The original is what reaggregation rebuilds from, so it is written
+                    # before returning whatever UPLOAD_PERSIST says for recognition uploads
+                    persist_upload(f'embeddings/{file.name}', data, mode=PERSIST_SYNC, overwrite=True)
+                    new_embeddings[student_id] = embedding
                     
-                    # Update student record
-                    Student.objects.update_or_create(
-                        student_id=student_id,
-                        defaults={'embedding_file': f'embeddings/{file.name}'}
-                    )
+                    # Update student record (serialized with background model compaction)
+                    with write_lock:
+                        Student.objects.update_or_create(
+                            student_id=student_id,
+                            defaults={'embedding_file': f'embeddings/{file.name}'}
+                        )
                     
                 except Exception as e:
                     logger.error(f"Error processing file {file.name}: {str(e)}")
@@ -514,6 +413,96 @@ class AggregationViewSet(viewsets.ViewSet):
                 'data': None
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['POST'])
+    def enroll_bulk(self, request):
+        """Enroll many students from one zip/npz/NDJSON archive in a single transaction"""
+        try:
+            archive = request.FILES.get('archive')
+            if not archive:
+                return Response({
+                    'code': 400,
+                    'msg': 'No archive provided',
+                    'data': None
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            try:
+                ids, vectors = read_archive(archive.name, read_upload(archive))
+            except EnrollmentError as e:
+                return Response({
+                    'code': 400,
+                    'msg': str(e),
+                    'data': None
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            accepted, templates, rejected = validate_embeddings(ids, vectors, expected_dim())
+            strict = str(request.data.get('strict', '')).lower() in ('1', 'true', 'yes')
+            if not accepted or (strict and rejected):
+                return Response({
+                    'code': 400,
+                    'msg': 'No valid embeddings in archive' if not accepted else 'Archive has invalid entries',
+                    'data': {'accepted': 0, 'rejected': rejected}
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            global_model, created, updated = enroll(accepted, templates)
+            logger.info(f"Bulk enrolled {len(accepted)} students from {archive.name}, rejected {len(rejected)}")
+            
+            return Response({
+                'code': 200,
+                'msg': 'Students enrolled and model updated successfully',
+                'data': {
+                    'model_id': global_model.id,
+                    'total_students': global_model.num_students,
+                    'accepted': len(accepted),
+                    'created': created,
+                    'updated': updated,
+                    'rejected': rejected
+                }
+            })
+            
+        except Exception as e:
+            logger.error(f"Error in enroll_bulk: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return Response({
+                'code': 500,
+                'msg': str(e),
+                'data': None
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['POST'])
+    def remove_students(self, request):
+        """Remove students from the global model"""
+        try:
+            student_ids = request.data.getlist('student_ids')
+            if not student_ids:
+                return Response({
+                    'code': 400,
+                    'msg': 'No student IDs provided',
+                    'data': None
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            with write_lock:
+                global_model, _ = update_model({}, removed=student_ids)
+                deleted, _ = Student.objects.filter(student_id__in=student_ids).delete()
+            
+            return Response({
+                'code': 200,
+                'msg': 'Students removed and model updated successfully',
+                'data': {
+                    'model_id': global_model.id,
+                    'total_students': global_model.num_students,
+                    'removed_students': deleted
+                }
+            })
+            
+        except Exception as e:
+            logger.error(f"Error in remove_students: {str(e)}")
+            return Response({
+                'code': 500,
+                'msg': str(e),
+                'data': None
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
     @action(detail=False, methods=['GET'])
     def latest_model(self, request):
         """Get information about the latest global model"""
@@ -536,6 +525,27 @@ class AggregationViewSet(viewsets.ViewSet):
                 'data': None
             }, status=status.HTTP_404_NOT_FOUND)
 
+    @action(detail=True, methods=['POST'])
+    def pin(self, request, pk=None):
+        """Pin a global model version so retention never removes it, or unpin it with pinned=false"""
+        pinned = str(request.data.get('pinned', 'true')).lower() in ('1', 'true', 'yes')
+        updated = GlobalModel.objects.filter(id=pk).update(pinned=pinned)
+        if not updated:
+            return Response({
+                'code': 404,
+                'msg': f'Model {pk} not found',
+                'data': None
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            'code': 200,
+            'msg': 'Model pinned' if pinned else 'Model unpinned',
+            'data': {
+                'model_id': int(pk),
+                'pinned': pinned
+            }
+        })
+
     @action(detail=False, methods=['GET'])
     def check_model_files(self, request):
         """Debug endpoint to check model files"""
@@ -556,6 +566,7 @@ class AggregationViewSet(viewsets.ViewSet):
                     'db_path': db_path,
                     'full_path_exists': os.path.exists(full_path),
                     'alt_path_exists': os.path.exists(alt_path),
+                    'pinned': model.pinned,
                     'created_at': model.created_at
                 })
             
@@ -629,98 +640,21 @@ class AggregationViewSet(viewsets.ViewSet):
             logger.error(f"Error drawing result: {str(e)}")
             return image
 
-    def reaggregate_all_embeddings(self):
-        """Reaggregate all available embeddings into a new global model"""
-        try:
-            # Get all student embeddings
-            students = Student.objects.all()
-            if not students:
-                return None, "No student embeddings found"
-
-            logger.info(f"Found {len(students)} students in database")
-
-            # Load all embeddings
-            embeddings_dict = {}
-            for student in students:
-                try:
-                    # Get embedding file path
-                    embedding_path = os.path.join(settings.MEDIA_ROOT, student.embedding_file.name)
-                    logger.info(f"Loading embedding for {student.student_id} from {embedding_path}")
-                    
-                    # Load and normalize embedding
-                    embedding = np.load(embedding_path)
-                    embedding = embedding.astype(np.float32)
-                    embedding = embedding / np.linalg.norm(embedding)
-                    embeddings_dict[student.student_id] = embedding
-                    
-                    logger.info(f"Successfully loaded embedding for {student.student_id}")
-                except Exception as e:
-                    logger.error(f"Error loading embedding for student {student.student_id}: {str(e)}")
-                    continue
-
-            if not embeddings_dict:
-                return None, "No valid embeddings found"
-
-            logger.info(f"Successfully loaded {len(embeddings_dict)} embeddings")
-
-            # Save new global model
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            model_filename = f"global_model_{timestamp}.npz"
-            
-            # Ensure directory exists
-            os.makedirs(os.path.join(settings.MEDIA_ROOT, 'global_model'), exist_ok=True)
-            
-            # Save with full path
-            model_path = os.path.join(settings.MEDIA_ROOT, 'global_model', model_filename)
-            
-            # Save numpy array with all embeddings
-            np.savez(
-                model_path,
-                student_embeddings=embeddings_dict,
-                num_students=len(embeddings_dict),
-                timestamp=timestamp
-            )
-            
-            logger.info(f"Saved model to {model_path}")
-            
-            # Create database entry with relative path
-            relative_path = os.path.join('global_model', model_filename)
-            global_model = GlobalModel.objects.create(
-                version=timestamp,
-                model_file=relative_path,
-                num_students=len(embeddings_dict)
-            )
-            
-            logger.info(f"Created database entry for model version {timestamp}")
-            
-            return global_model, None
-            
-        except Exception as e:
-            logger.error(f"Error in reaggregate_all_embeddings: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
-            return None, str(e)
-
     @action(detail=False, methods=['POST'])
     def reaggregate(self, request):
         """Endpoint to reaggregate all embeddings into a new model"""
         try:
-            # Delete old model files
-            model_dir = os.path.join(settings.MEDIA_ROOT, 'global_model')
-            if os.path.exists(model_dir):
-                for file in os.listdir(model_dir):
-                    file_path = os.path.join(model_dir, file)
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-
-            # Reaggregate embeddings
-            global_model, error = self.reaggregate_all_embeddings()
+            # resume=true continues an interrupted rebuild from its checkpoint, if still valid
+            resume = str(request.data.get('resume', 'false')).lower() in ('1', 'true', 'yes')
             
-            if error:
+            # Older versions stay until model retention removes them, other workers may still use them
+            global_model, report = Reaggregation().run(resume=resume)
+            
+            if global_model is None:
                 return Response({
                     'code': 400,
                     'msg': 'Error during reaggregation',
-                    'data': {'error': error}
+                    'data': {'error': 'No valid embeddings found', 'progress': report}
                 }, status=status.HTTP_400_BAD_REQUEST)
             
             return Response({
@@ -730,17 +664,130 @@ class AggregationViewSet(viewsets.ViewSet):
                     'model_id': global_model.id,
                     'version': global_model.version,
                     'num_students': global_model.num_students,
-                    'created_at': global_model.created_at
+                    'created_at': global_model.created_at,
+                    'progress': report
                 }
             })
             
         except Exception as e:
+            logger.error(f"Error in reaggregate: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
             return Response({
                 'code': 500,
                 'msg': str(e),
                 'data': None
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['GET'])
+    def engine_status(self, request):
+        """Report face engine load and first-request latency"""
+        return Response({
+            'code': 200,
+            'msg': 'Engine status retrieved successfully',
+            'data': self.tester.engine.snapshot()
+        })
+
+    @action(detail=False, methods=['GET'])
+    def metrics(self, request):
+        """Stage latency histograms and counters of this process in Prometheus text format"""
+        return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @action(detail=False, methods=['GET'])
+    def profiles(self, request):
+        """Stored profiles of slow or explicitly profiled requests, newest first"""
+        try:
+            limit = int(request.query_params.get('limit', 50))
+            test_image_id = request.query_params.get('test_image_id')
+            test_image_id = int(test_image_id) if test_image_id else None
+        except ValueError:
+            return Response({
+                'code': 400,
+                'msg': 'limit and test_image_id must be integers',
+                'data': None
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'code': 200,
+            'msg': 'Profiles retrieved successfully',
+            'data': {
+                'enabled': getattr(settings, 'PROFILE_ENABLED', False),
+                'slow_seconds': getattr(settings, 'PROFILE_SLOW_SECONDS', 5.0),
+                'profiles': list_traces(limit=limit, test_image_id=test_image_id)
+            }
+        })
+
+    @action(detail=True, methods=['GET'])
+    def job(self, request, pk=None):
+        """Status of a queued test_image job, with its result once processed"""
+        test_image = TestImage.objects.filter(id=pk).first()
+        if test_image is None:
+            return Response({
+                'code': 404,
+                'msg': f'Job {pk} not found',
+                'data': None
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        stats = test_image.stats or {}
+        summary = stats.get('summary', {})
+        return Response({
+            'code': 200,
+            'msg': 'Job status retrieved successfully',
+            'data': {
+                'job_id': test_image.id,
+                'status': test_image.status or (TestImage.STATUS_DONE if test_image.processed else None),
+                'processed': test_image.processed,
+                'queue_depth': queue_depth() if test_image.status == TestImage.STATUS_QUEUED else 0,
+                'result': test_image.result,
+                'unassigned_faces': summary.get('unassigned_faces'),
+                'result_image_url': result_image_url(test_image),
+                'error': test_image.error,
+                'created_at': test_image.created_at,
+                'started_at': test_image.started_at,
+                'finished_at': test_image.finished_at,
+                'stats': stats
+            }
+        })
+
+    @action(detail=True, methods=['GET'])
+    def result_image(self, request, pk=None):
+        """Annotated result image of a processed test image, rendered on the first request"""
+        test_image = TestImage.objects.filter(id=pk).first()
+        if test_image is None:
+            return Response({
+                'code': 404,
+                'msg': f'Test image {pk} not found',
+                'data': None
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            path = render_result_image(test_image)
+        except ResultImagePending as e:
+            response = Response({
+                'code': 202,
+                'msg': str(e),
+                'data': None
+            }, status=status.HTTP_202_ACCEPTED)
+            response['Retry-After'] = str(getattr(settings, 'RESULT_IMAGE_RETRY_AFTER', 1))
+            return response
+        except FileNotFoundError as e:
+            return Response({
+                'code': 404,
+                'msg': str(e),
+                'data': None
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Error rendering result image {pk}: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return Response({
+                'code': 500,
+                'msg': f'Error rendering result image: {str(e)}',
+                'data': None
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return FileResponse(open(path, 'rb'), content_type='image/jpeg')
+
     @action(detail=False, methods=['GET'])
     def check_embeddings(self, request):
         """Debug endpoint to check embeddings"""
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_testimage_result_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GlobalModelDelta',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.IntegerField()),
+                ('delta_file', models.FileField(upload_to='global_model')),
+                ('num_upserted', models.IntegerField()),
+                ('num_removed', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('base', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deltas', to='core.globalmodel')),
+            ],
+            options={
+                'ordering': ['sequence'],
+                'unique_together': {('base', 'sequence')},
+            },
+        ),
+    ]
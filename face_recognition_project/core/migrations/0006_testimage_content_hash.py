@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_testimage_job_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testimage',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_testimage_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='globalmodel',
+            name='pinned',
+            field=models.BooleanField(default=False),
+        ),
+    ]
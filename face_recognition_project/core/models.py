@@ -6,6 +6,7 @@ class Student(models.Model):
     student_id = models.CharField(max_length=50, unique=True)
     embedding_file = models.FileField(upload_to='embeddings')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Re-enrollments invalidate reaggregation checkpoints
 
     def __str__(self):
         return f"Student {self.student_id}"
@@ -15,16 +16,51 @@ class GlobalModel(models.Model):
     model_file = models.FileField(upload_to='global_model')
     num_students = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
+    pinned = models.BooleanField(default=False)  # Never removed by model retention
 
     def __str__(self):
         return f"Model v{self.version} ({self.num_students} students)"
 
 class TestImage(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     image = models.ImageField(upload_to='test_images')
     result_image = models.ImageField(upload_to='test_results', null=True, blank=True)
     processed = models.BooleanField(default=False)
     result = models.JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)  # SHA-256 of the upload
+
+    # Recognition job state, null for rows created before the job queue existed
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, null=True, blank=True, db_index=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    stats = models.JSONField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
 
     def __str__(self):
         return f"Test Image {self.id}"
+
+class GlobalModelDelta(models.Model):
+    base = models.ForeignKey(GlobalModel, on_delete=models.CASCADE, related_name='deltas')
+    sequence = models.IntegerField()
+    delta_file = models.FileField(upload_to='global_model')
+    num_upserted = models.IntegerField()
+    num_removed = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('base', 'sequence')
+        ordering = ['sequence']
+
+    def __str__(self):
+        return f"Delta {self.sequence} of model v{self.base.version}"
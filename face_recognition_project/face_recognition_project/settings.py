@@ -167,3 +167,124 @@ CORS_ALLOW_HEADERS = [
     'x-csrftoken',
     'x-requested-with',
 ]
+
+# Face engine settings
+FACE_ENGINE_MODEL = 'buffalo_l'
+FACE_ENGINE_PROVIDERS = ['CPUExecutionProvider']
+FACE_ENGINE_DET_SIZE = (640, 640)
+FACE_ENGINE_POOL_SIZE = 2  # Sessions per worker process, one per concurrent request
+FACE_ENGINE_PREWARM = False  # Load models in ApiConfig.ready() instead of on first request
+FACE_ENGINE_MODULES = ['detection', 'recognition']  # FaceAnalysis allowed_modules, None loads every model of the pack
+FACE_ENGINE_INTRA_OP_THREADS = None  # onnxruntime threads per session, None uses one per core
+FACE_EMBED_BATCH_SIZE = 32  # Aligned face crops per recognition model call
+
+# Gallery cache settings
+GALLERY_CACHE_CHECK_INTERVAL = 0.0  # Seconds between checks for a newer GlobalModel row, 0 checks every request
+
+# Matching settings
+MATCH_TOP_K = 5  # Candidates kept per detected face
+
+# Search index settings
+ANN_INDEX_BACKEND = 'flat'  # 'flat' for exact search, 'ivf' for an approximate inverted-file index
+ANN_MIN_GALLERY_SIZE = 20000  # Smaller galleries always use exact search
+ANN_NLIST = None  # Number of IVF lists, None picks sqrt(gallery size)
+ANN_NPROBE = 8  # IVF lists scanned per face
+
+# Global model update settings
+GLOBAL_MODEL_COMPACTION_THRESHOLD = 20  # Fold deltas into a new full snapshot once a base has this many, 0 disables
+
+# Gallery file settings
+GALLERY_STORAGE_DTYPE = 'float32'  # 'float16' halves disk and page cache use; float32 matching widens it per process
+GALLERY_MMAP = True  # Memory-map gallery files so worker processes share one copy
+GALLERY_MATCH_DTYPE = 'float32'  # 'float16'/'int8' scan a smaller copy and read only shortlisted rows; saves memory, not time
+GALLERY_RERANK_FACTOR = 4  # Shortlist of top_k times this many rows per face re-scored exactly
+
+# Recognition job queue settings
+RECOGNITION_ASYNC_DEFAULT = False  # Queue test_image requests that do not pass async=true/false
+RECOGNITION_WORKER_PROCESSES = 2  # Default --processes of the recognition_worker command
+RECOGNITION_WORKER_POLL_INTERVAL = 1.0  # Seconds a worker sleeps while the queue is empty
+RECOGNITION_JOB_TIMEOUT = 300  # Running jobs older than this are requeued when the workers start
+
+# Batch recognition settings
+BATCH_MAX_IMAGES = 20  # Images accepted by one test_images request
+
+# Video attendance settings
+VIDEO_SAMPLE_FPS = 5.0  # Frames looked at per second of video while faces come and go
+VIDEO_MAX_STRIDE_FACTOR = 4  # Sampling slows to VIDEO_SAMPLE_FPS divided by this while the scene is stable
+VIDEO_TRACK_IOU_THRESHOLD = 0.3  # Minimum box overlap to continue a track
+VIDEO_TRACK_MAX_MISSED = 5  # Sampled frames a track may go undetected before it ends
+VIDEO_EMBEDDINGS_PER_TRACK = 3  # Recognition runs per track, averaged before matching
+VIDEO_EMBED_INTERVAL = 5  # Track hits between recognition runs
+VIDEO_MIN_TRACK_HITS = 2  # Shorter tracks are treated as false detections
+VIDEO_MAX_FRAMES = 9000  # Frames decoded per uploaded video (5 minutes at 30 fps)
+
+# Detection preprocessing settings
+FACE_MIN_SIZE_FRACTION = 0.03  # Smallest expected face width relative to the image long side, lower for lecture halls
+DET_MIN_FACE_PX = 20  # Face size the detector needs at its input to find it reliably
+DET_SIZE_MIN = 320  # Bounds of the detector input long side chosen per image
+DET_SIZE_MAX = 960
+DET_TILING = True  # Detect on overlapping DET_SIZE_MAX tiles when one pass would miss the smallest faces
+DET_TILE_OVERLAP = 0.2
+IMAGE_DECODE_MIN_SIDE = 1600  # JPEGs decode at 1/2, 1/4 or 1/8 scale while the long side stays at least this
+
+# Embedding cache settings
+EMBEDDING_CACHE_ENABLED = True  # Reuse detected faces and embeddings of re-submitted images
+EMBEDDING_CACHE_DIR = None  # Defaults to MEDIA_ROOT/embedding_cache
+EMBEDDING_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Least recently used entries are evicted beyond this
+
+# Upload settings
+UPLOAD_PERSIST = 'async'  # 'sync' stores originals before processing, 'async' after the response, 'none' not at all
+UPLOAD_PERSIST_WORKERS = 2  # Threads writing originals to the media volume in 'async' mode
+UPLOAD_PERSIST_PENDING_SECONDS = 60  # How long a missing 'async' original counts as still being written
+
+# Bulk enrollment settings
+ENROLLMENT_EMBEDDING_DIM = 512  # Expected embedding size when there is no gallery yet
+ENROLLMENT_BATCH_SIZE = 500  # Student rows per bulk upsert statement
+
+# Template set settings
+TEMPLATE_POOLING = 'max'  # How the scores of a student's templates combine: 'max' (best view) or 'mean'
+TEMPLATES_MAX_PER_STUDENT = 10  # Embeddings one student may enroll
+
+# Model retention settings
+MODEL_RETENTION_KEEP = 3  # Newest global model versions kept besides pinned ones and ones still in use
+MODEL_RETENTION_AUTO = True  # Apply retention in the background after every new snapshot
+MODEL_ORPHAN_GRACE = 3600  # Seconds before unreferenced files in the model directory are removed
+MODEL_LEASE_REFRESH = 60  # Seconds between lease renewals by a process serving a model
+MODEL_LEASE_TIMEOUT = 600  # Leases not renewed for this long no longer protect a model
+
+# Reaggregation settings
+REAGGREGATE_WORKERS = 8  # Threads loading per-student embedding files, mostly waiting on storage
+REAGGREGATE_CHUNK_SIZE = 1000  # Students loaded between checkpoints
+REAGGREGATE_CHECKPOINT_DIR = None  # Defaults to MEDIA_ROOT/reaggregate_checkpoint
+REAGGREGATE_CHECKPOINT_MAX_AGE = 24 * 3600  # Seconds after which an interrupted run is no longer resumed
+
+# Result image settings
+RESULT_IMAGE_MODE = 'lazy'  # 'lazy' draws on the first GET of result_image_url, 'eager' before responding, 'off' never
+RESULT_IMAGE_MAX_SIDE = 1600  # Long side of rendered result images, larger photos are scaled down
+RESULT_IMAGE_JPEG_QUALITY = 85
+RESULT_IMAGE_RETRY_AFTER = 1  # Seconds clients wait on a 202 while the original is still being stored
+
+# Observability settings
+LOG_MATCH_DETAILS = False  # Log every face match and embedding; one line per face is costly under load
+
+# Profiling settings
+PROFILE_ENABLED = False  # Keep stack traces of slow API requests; off, requests only pay one settings lookup
+PROFILE_SLOW_SECONDS = 5.0  # Requests slower than this keep their sampled trace
+PROFILE_SAMPLE_AFTER = 0.5  # Seconds before a request is sampled, so fast requests are never touched
+PROFILE_SAMPLE_INTERVAL = 0.01  # Seconds between stack samples of a running request
+PROFILE_HEADER = 'X-Profile'  # Requests carrying this header are traced with cProfile from the start
+PROFILE_MAX_TRACES = 200  # Oldest traces beyond this are removed
+PROFILE_DIR = None  # Defaults to MEDIA_ROOT/profiles
+
+# Async endpoint settings (api/aggregation/async/..., served by an ASGI server)
+INFERENCE_WORKERS = None  # Threads running detection, embedding and matching; defaults to FACE_ENGINE_POOL_SIZE
+INFERENCE_QUEUE_SIZE = 8  # Requests admitted at once, running or waiting; more are answered with 429
+INFERENCE_RETRY_AFTER = 1  # Seconds clients are asked to wait after a 429
+
+# Inference server settings (manage.py inference_server)
+INFERENCE_SERVER_ADDRESS = None  # Unix socket path or host:port of the server; None runs the models in each Django process
+INFERENCE_SERVER_AUTHKEY = None  # Shared secret of server and clients, None uses SECRET_KEY
+INFERENCE_SERVER_PROCESSES = 2  # Server processes, each with one loaded copy of the models
+INFERENCE_SERVER_THREADS = None  # onnxruntime intra-op threads per server process, None uses one per core
+INFERENCE_SERVER_CONNECTIONS = 4  # Calls in flight from one Django process
+INFERENCE_SERVER_TIMEOUT = 30.0  # Seconds to wait for the server to answer one image